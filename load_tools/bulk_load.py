@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Bulk patient loader
+
+Patient files are parsed and split into per-statement graphs by a pool
+of worker processes; the results are committed to the triplestore by a
+fixed number of writer threads, so parsing and writing overlap and the
+store never sees more than --writers concurrent transactions.
+
+Each record that has been committed is appended to the checkpoint file
+(if given), and files listed there are skipped on the next run.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \
+  DJANGO_SETTINGS_MODULE=settings \
+  /usr/bin/python \
+  load_tools/bulk_load.py --workers 4 --writers 2 \
+  --checkpoint loaded.txt \
+  records/*
+"""
+
+import argparse
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+from rdflib import ConjunctiveGraph
+from smart.common.rdf_tools.util import parse_rdf
+from load_one_patient import record_id_for, segregate_record, write_record
+
+REPORT_EVERY = 100
+
+
+def prepare(filename):
+    """Worker process: parse and segregate one file.
+
+    Returns (filename, record_id, record_node, contexts, seconds, error)
+    where contexts is a list of (context identifier, triples).
+    """
+    st = time.time()
+    try:
+        record_id = record_id_for(filename)
+        data = parse_rdf(open(filename).read())
+        record_node = segregate_record(data, record_id, verbose=False)
+        contexts = [(g.identifier, list(g)) for g in data.contexts()]
+        return (filename, record_id, record_node, contexts, time.time() - st, None)
+    except Exception:
+        return (filename, None, None, None, time.time() - st, traceback.format_exc())
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+
+    def _stage(self, stage):
+        # caller holds the lock
+        return self.stages.setdefault(stage, {'records': 0, 'triples': 0,
+                                              'seconds': 0.0, 'errors': 0})
+
+    def add(self, stage, seconds, triples):
+        with self.lock:
+            s = self._stage(stage)
+            s['records'] += 1
+            s['triples'] += triples
+            s['seconds'] += seconds
+
+    def error(self, stage):
+        with self.lock:
+            self._stage(stage)['errors'] += 1
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            print "--- %.1fs elapsed" % elapsed
+            for stage in ("parse", "write"):
+                s = self.stages.get(stage)
+                if not s:
+                    continue
+                # busy: per worker-second, i.e. the cost of the stage itself
+                busy = s['seconds'] or 1e-9
+                print "%s: %d records (%d errors), %.1f records/s, %.0f triples/s, " \
+                      "%.1f records/s busy" % (
+                          stage, s['records'], s['errors'],
+                          s['records'] / elapsed, s['triples'] / elapsed,
+                          s['records'] / busy)
+            sys.stdout.flush()
+
+
+class Checkpoint(object):
+    """Append-only list of files whose records have been committed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.f = None
+        if path:
+            if os.path.exists(path):
+                self.done = set(l.strip() for l in open(path) if l.strip())
+            self.f = open(path, "a")
+
+    def completed(self, filename):
+        return filename in self.done
+
+    def mark(self, filename):
+        if not self.f:
+            return
+        with self.lock:
+            self.f.write(filename + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+
+class Writer(threading.Thread):
+    def __init__(self, queue, stats, checkpoint):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.stats = stats
+        self.checkpoint = checkpoint
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                self.write(*item)
+        finally:
+            from django.db import connection
+            connection.close()
+
+    def write(self, filename, record_id, record_node, contexts):
+        st = time.time()
+        try:
+            data = ConjunctiveGraph()
+            for identifier, triples in contexts:
+                g = data.get_context(identifier)
+                for t in triples:
+                    g.add(t)
+            write_record(record_id, record_node, data, verbose=False)
+        except Exception:
+            self.stats.error("write")
+            print "Failed to write %s (record %s):\n%s" % (
+                filename, record_id, traceback.format_exc())
+            return
+
+        self.checkpoint.mark(filename)
+        self.stats.add("write", time.time() - st, sum(len(t) for (i, t) in contexts))
+
+
+def find_files(paths):
+    ret = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                ret.extend(os.path.join(root, f) for f in sorted(files))
+        else:
+            ret.append(p)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load many patient records in parallel')
+    parser.add_argument("paths", nargs="+",
+                        help="patient files, or directories to search for them")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="parsing processes (default: one per CPU)")
+    parser.add_argument("--writers", type=int, default=2,
+                        help="concurrent triplestore transactions (default: 2)")
+    parser.add_argument("--checkpoint", default=None,
+                        help="file recording loaded records, used to resume")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    files = [f for f in find_files(args.paths) if not checkpoint.completed(f)]
+    print "Loading %d files (%d already loaded)" % (len(files), len(checkpoint.done))
+
+    stats = Stats()
+    # bounded, so parsing can't run arbitrarily far ahead of the writers
+    queue = Queue.Queue(maxsize=args.writers * 2)
+    writers = [Writer(queue, stats, checkpoint) for i in range(args.writers)]
+    for w in writers:
+        w.start()
+
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for n, result in enumerate(pool.imap_unordered(prepare, files)):
+            filename, record_id, record_node, contexts, seconds, error = result
+            if error:
+                stats.error("parse")
+                print "Failed to parse %s:\n%s" % (filename, error)
+            else:
+                stats.add("parse", seconds, sum(len(t) for (i, t) in contexts))
+                queue.put((filename, record_id, record_node, contexts))
+
+            if (n + 1) % REPORT_EVERY == 0:
+                stats.report()
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    for w in writers:
+        queue.put(None)
+    for w in writers:
+        w.join()
+
+    checkpoint.close()
+    stats.report()
+
+if __name__ == "__main__":
+    main()
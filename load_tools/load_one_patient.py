@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from smart.triplestore import TripleStore 
+from smart.triplestore.cache import RESPONSE_CACHE
 from smart.models.record_object import api_types, Record, RecordObject
 from smart.common.rdf_tools.util import parse_rdf, serialize_rdf, remap_node, bound_graph, URIRef, Literal, BNode, sp, rdf
 from django.conf import settings
@@ -15,25 +16,54 @@ PYTHONPATH=/path/to/smart_server \
   load_tools/load_one_patient.py \
   records/* 
 """
+def record_id_for(filename):
+    return filter(str.isdigit, filename.split("/")[-1].split(".")[0])
+
+def segregate_record(data, target_id, verbose=True):
+    """Splits a parsed patient graph into one context per statement.
+
+    Returns the sp:MedicalRecord node; data is modified in place.
+    """
+    # 1. For each known data type, extract relevant nodes
+    var_bindings = {'record_id': target_id}
+    ro = RecordObject[sp.Statement]
+    ro.prepare_graph(data, None, var_bindings)
+    if verbose:
+        print "Default context", len(data.default_context)
+
+    record_node = list(data.triples((None, rdf.type, sp.MedicalRecord)))
+    assert len(record_node) == 1, "Found statements about >1 patient in file: %s" % record_node
+    record_node = record_node[0][0]
+
+    ro.segregate_nodes(data, record_node)
+    data.remove_context(data.default_context)
+    return record_node
+
+def write_record(target_id, record_node, data, verbose=True):
+    rconn =TripleStore()
+    rconn.transaction_begin() 
+    r, created = Record.objects.get_or_create(id=target_id)
+    if verbose:
+        print "Wiping record", record_node.n3()
+    try:
+        rconn.destroy_context_and_neighbors(record_node)
+    except:
+        pass
+
+    # TODO:  clear any elements in this record that may still exist
+    rconn.replace_conjunctive_graph(data)
+
+    if verbose:
+        print "adds: ",len(data)
+    rconn.transaction_commit() 
+    RESPONSE_CACHE.invalidate(target_id)
+
 class RecordImporter(object):
     def __init__(self, filename, target_id=None):            
         # 0. Read supplied data
         self.target_id = target_id
         self.data = parse_rdf(open(filename).read())
-
-        # 1. For each known data type, extract relevant nodes
-        var_bindings = {'record_id': self.target_id}
-        self.ro = RecordObject[sp.Statement]    
-        self.ro.prepare_graph(self.data, None, var_bindings)
-        print "Default context", len(self.data.default_context)
-        
-        record_node = list(self.data.triples((None, rdf.type, sp.MedicalRecord)))
-        assert len(record_node) == 1, "Found statements about >1 patient in file: %s" % record_node
-        record_node = record_node[0][0]
-
-        self.record_node = record_node
-        self.ro.segregate_nodes(self.data, record_node)
-        self.data.remove_context(self.data.default_context)
+        self.record_node = segregate_record(self.data, self.target_id)
 
         # 2. Copy extracted nodes to permanent RDF store
         self.write_to_record()
@@ -41,24 +71,11 @@ class RecordImporter(object):
             
 
     def write_to_record(self):
-            rconn =TripleStore()
-            rconn.transaction_begin() 
-            r, created = Record.objects.get_or_create(id=self.target_id)
-            print "Wiping record", self.record_node.n3()
-            try:
-                rconn.destroy_context_and_neighbors(self.record_node)
-            except:
-                pass
-
-            # TODO:  clear any elements in this record that may still exist
-            rconn.replace_conjunctive_graph(self.data)
-
-            print "adds: ",len(self.data)
-            rconn.transaction_commit() 
+        write_record(self.target_id, self.record_node, self.data)
 
 if __name__ == "__main__":
     import string
     for v in sys.argv[1:]:
-        rid = filter(str.isdigit, v.split("/")[-1].split(".")[0])
+        rid = record_id_for(v)
         print "Using record id: %s"%rid
         RecordImporter(v, rid)
@@ -308,7 +308,7 @@ def main():
     if args.load_sample_data:
         call_command("cd smart_server && " + 
                      "PYTHONPATH=.:.. DJANGO_SETTINGS_MODULE=settings "+
-                     "python load_tools/load_one_patient.py  " + 
+                     "python load_tools/bulk_load.py  " + 
                      "../smart_sample_patients/generated-data/* ../smart_sample_patients/deidentified-patients/*  && "
                      "cd ..", print_output=True)
 
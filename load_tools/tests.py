@@ -0,0 +1,101 @@
+"""
+Tests for the bulk patient loader's bookkeeping
+
+Parsing and writing are replaced by fakes; what's checked is which files
+count as loaded, so that an interrupted run resumes where it stopped.
+"""
+
+from StringIO import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from rdflib import Literal, URIRef
+
+import bulk_load
+
+S = URIRef("http://localhost:7000/records/123/medications/1")
+P = URIRef("http://purl.org/dc/terms/title")
+
+
+class BulkLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.written = []
+        self.saved_write_record = bulk_load.write_record
+        bulk_load.write_record = self.write_record
+
+    def tearDown(self):
+        bulk_load.write_record = self.saved_write_record
+        shutil.rmtree(self.dir)
+
+    def write_record(self, record_id, record_node, data, verbose=True):
+        if record_id == "666":
+            raise Exception("store is down")
+        self.written.append((record_id, record_node, set(data.quads((None, None, None)))))
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def touch(self, *names):
+        p = self.path(*names)
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+        open(p, "w").close()
+        return p
+
+    def test_find_files_walks_directories_in_order(self):
+        b = self.touch("b", "p2.xml")
+        a2 = self.touch("a", "p9.xml")
+        a1 = self.touch("a", "p10.xml")
+        self.assertEqual(bulk_load.find_files([self.path("a"), b]), [a1, a2, b])
+
+    def test_checkpoint_resumes(self):
+        checkpoint = bulk_load.Checkpoint(self.path("loaded.txt"))
+        checkpoint.mark("records/p1.xml")
+        checkpoint.mark("records/p2.xml")
+        checkpoint.close()
+
+        checkpoint = bulk_load.Checkpoint(self.path("loaded.txt"))
+        self.assertTrue(checkpoint.completed("records/p2.xml"))
+        self.assertFalse(checkpoint.completed("records/p3.xml"))
+        checkpoint.close()
+
+    def test_no_checkpoint_file(self):
+        checkpoint = bulk_load.Checkpoint(None)
+        checkpoint.mark("records/p1.xml")
+        self.assertFalse(checkpoint.completed("records/p1.xml"))
+        checkpoint.close()
+
+    def test_written_records_are_checkpointed(self):
+        checkpoint = bulk_load.Checkpoint(self.path("loaded.txt"))
+        stats = bulk_load.Stats()
+        writer = bulk_load.Writer(None, stats, checkpoint)
+        contexts = [(S, [(S, P, Literal("x"))])]
+        saved_stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            writer.write("records/p123.xml", "123", S, contexts)
+            writer.write("records/p666.xml", "666", S, contexts)
+            self.assertTrue("Failed to write records/p666.xml" in sys.stdout.getvalue())
+        finally:
+            sys.stdout = saved_stdout
+        checkpoint.close()
+
+        [(record_id, record_node, quads)] = self.written
+        self.assertEqual((record_id, record_node), ("123", S))
+        self.assertEqual([(s, p, o, c.identifier) for (s, p, o, c) in quads],
+                         [(S, P, Literal("x"), S)])
+
+        self.assertEqual(open(self.path("loaded.txt")).read(), "records/p123.xml\n")
+        self.assertEqual(stats.stages["write"]["records"], 1)
+        self.assertEqual(stats.stages["write"]["triples"], 1)
+        self.assertEqual(stats.stages["write"]["errors"], 1)
+
+    def test_unparseable_file_is_reported(self):
+        p = self.touch("p7.xml")
+        open(p, "w").write("not rdf")
+        filename, record_id, record_node, contexts, seconds, error = bulk_load.prepare(p)
+        self.assertEqual((filename, contexts), (p, None))
+        self.assertTrue(error)
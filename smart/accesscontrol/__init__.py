@@ -2,6 +2,9 @@ import sys
 import smart
 #from smart import views
 
+# None is a grant without constraints, so it can't mark a missing one
+NOT_GRANTED = object()
+
 
 class PermissionSet(object):
 
@@ -25,11 +28,10 @@ class PermissionSet(object):
         depends on request, but it's provided here as convenience.
         """
 
-        if view_func not in self.grants:
+        callbacks = self.grants.get(view_func, NOT_GRANTED)
+        if callbacks is NOT_GRANTED:
             return (False, 'You are not allowed to request %s' % request.META.get('PATH_INFO', view_func))
 
-        callbacks = self.grants[view_func]
-
         # if callbacks is None, we're done, it's all good
         if callbacks is None:
             return (True, None)
@@ -77,3 +79,4 @@ def grant_baseline(permset):
     permset.grant(smart.views.debug_oauth, None)
     permset.grant(smart.views.smarthacks.get_container_manifest, None)
     permset.grant(smart.views.smarthacks.download_ontology)
+    permset.grant(smart.views.smarthacks.jsonld_context, None)
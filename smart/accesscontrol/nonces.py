@@ -0,0 +1,77 @@
+"""
+Nonce stores for the OAuth servers
+
+The OAuth library refuses requests whose timestamp is more than
+TIMESTAMP_THRESHOLD seconds off, so a nonce only has to be remembered for
+about that long.  Rather than a database row per signed request, nonces
+can be kept in time buckets of TIMESTAMP_THRESHOLD seconds that are
+dropped whole once they're old enough.
+
+Picked by settings.OAUTH_NONCE_STORE:
+  'database' -- a Nonce row per request (the default; pruned by the
+                cleanup_old_tokens command)
+  'local'    -- in-process buckets; only safe with a single server process
+  'shared'   -- django's cache framework (e.g. memcached), for setups with
+                several worker processes
+"""
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from oauth.oauth import TIMESTAMP_THRESHOLD
+
+from smart import models
+
+# timestamps can be off in either direction, so a nonce has to be kept for
+# twice the threshold: the current bucket plus this many older ones
+RETAINED_BUCKETS = 2
+
+
+class DatabaseNonceStore(object):
+    def add(self, nonce_str):
+        """Stores nonce_str; returns False if it had been seen already"""
+        nonce, created = models.Nonce.objects.get_or_create(nonce=nonce_str)
+        return created
+
+
+class BucketedNonceStore(object):
+    def __init__(self, window=TIMESTAMP_THRESHOLD, retain=RETAINED_BUCKETS):
+        self.window = window
+        self.retain = retain
+        self.lock = threading.Lock()
+        self.buckets = {}  # bucket number -> set of nonces
+
+    def add(self, nonce_str):
+        current = int(time.time() // self.window)
+        with self.lock:
+            for b in [b for b in self.buckets if b < current - self.retain]:
+                del self.buckets[b]
+
+            for nonces in self.buckets.itervalues():
+                if nonce_str in nonces:
+                    return False
+            self.buckets.setdefault(current, set()).add(nonce_str)
+            return True
+
+
+class CacheNonceStore(object):
+    def __init__(self, window=TIMESTAMP_THRESHOLD, retain=RETAINED_BUCKETS):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = window * (retain + 1)
+
+    def add(self, nonce_str):
+        # memcached keys must be short and free of whitespace
+        key = "smart.nonce.%s" % hashlib.sha1(nonce_str).hexdigest()
+        return self.cache.add(key, 1, self.timeout)
+
+
+STORES = {
+    'database': DatabaseNonceStore,
+    'local': BucketedNonceStore,
+    'shared': CacheNonceStore,
+}
+
+NONCE_STORE = STORES[getattr(settings, 'OAUTH_NONCE_STORE', 'database')]()
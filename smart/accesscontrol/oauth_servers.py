@@ -11,8 +11,51 @@ from django.db import transaction
 from django.conf import settings
 from smart import models
 
+from contextlib import contextmanager
 import datetime
 import logging
+import threading
+
+from smart.accesscontrol import nonces, principal_cache
+
+
+def _get_access_token(token_str, app=None):
+    kwargs = {'token': token_str}
+    if app:
+        kwargs['share__with_app'] = app
+
+    def fetch():
+        try:
+            # the share is needed for every request made with the token
+            return models.AccessToken.objects.select_related('share').get(**kwargs)
+        except models.AccessToken.DoesNotExist:
+            return None
+    return principal_cache.lookup(('AccessToken', token_str, app and app.id), fetch)
+
+
+def _get_session_token(token_str):
+    def fetch():
+        try:
+            return models.SessionToken.objects.select_related('user').get(token=token_str)
+        except models.SessionToken.DoesNotExist:
+            return None
+    # the token's account is cached along with it
+    return principal_cache.lookup(('SessionToken', token_str), fetch,
+                                  lambda t: [('Account', t.user_id)])
+
+
+def _get_machine_app(consumer_key, app_type=None):
+    # no type, we look at all machine apps
+    kwargs = {'consumer_key': consumer_key}
+    if app_type:
+        kwargs['app_type'] = app_type
+
+    def fetch():
+        try:
+            return models.MachineApp.objects.get(**kwargs)
+        except models.MachineApp.DoesNotExist:
+            return None
+    return principal_cache.lookup(('MachineApp', app_type, consumer_key), fetch)
 
 
 class UserDataStore(oauth.OAuthStore):
@@ -22,25 +65,20 @@ class UserDataStore(oauth.OAuthStore):
     """
 
     def _get_app(self, consumer_key):
-        try:
-            return models.PHA.objects.get(consumer_key=consumer_key)
-        except models.PHA.DoesNotExist:
-            return None
+        def fetch():
+            try:
+                return models.PHA.objects.get(consumer_key=consumer_key)
+            except models.PHA.DoesNotExist:
+                return None
+        return principal_cache.lookup(('PHA', consumer_key), fetch)
 
     def _get_token(self, token_str, app=None):
-        kwargs = {'token': token_str}
-        if app:
-            kwargs['share__with_app'] = app
-
-        try:
-            ret = models.AccessToken.objects.get(**kwargs)
-            if ret.smart_connect_p:
-                oauth.report_error(
-                    "Got a SMArt Connect Request -- should be a REST request"
-                )
-            return ret
-        except models.AccessToken.DoesNotExist:
-            return None
+        ret = _get_access_token(token_str, app)
+        if ret and ret.smart_connect_p:
+            oauth.report_error(
+                "Got a SMArt Connect Request -- should be a REST request"
+            )
+        return ret
 
     def verify_request_token_verifier(self, request_token, verifier):
         """
@@ -180,8 +218,7 @@ class UserDataStore(oauth.OAuthStore):
 
         IMPORTANT: raises an exception if the nonce has already been stored
         """
-        nonce, created = models.Nonce.objects.get_or_create(nonce=nonce_str)
-        if not created:
+        if not nonces.NONCE_STORE.add(nonce_str):
             raise oauth.OAuthError("Nonce already exists")
 
 
@@ -191,20 +228,15 @@ class HelperAppDataStore(UserDataStore):
 
     def _get_app(self, consumer_key):
         #print "In helper app data store", consumer_key
-        try:
-            ret = models.HelperApp.objects.get(consumer_key=consumer_key)
-            return ret
-        except models.HelperApp.DoesNotExist:
-            return None
+        def fetch():
+            try:
+                return models.HelperApp.objects.get(consumer_key=consumer_key)
+            except models.HelperApp.DoesNotExist:
+                return None
+        return principal_cache.lookup(('HelperApp', consumer_key), fetch)
 
     def _get_token(self, token_str, app=None):
-        kwargs = {'token': token_str}
-        if app:
-            kwargs['share__with_app'] = app
-        try:
-            return models.AccessToken.objects.get(**kwargs)
-        except models.AccessToken.DoesNotExist:
-            return None
+        return _get_access_token(token_str, app)
 
 
 class MachineDataStore(oauth.OAuthStore):
@@ -216,14 +248,7 @@ class MachineDataStore(oauth.OAuthStore):
         self.type = type
 
     def _get_machine_app(self, consumer_key):
-        try:
-            if self.type:
-                return models.MachineApp.objects.get(app_type=self.type, consumer_key=consumer_key)
-            else:
-                # no type, we look at all machine apps
-                return models.MachineApp.objects.get(consumer_key=consumer_key)
-        except models.MachineApp.DoesNotExist:
-            return None
+        return _get_machine_app(consumer_key, self.type)
 
     def lookup_consumer(self, consumer_key):
         return self._get_machine_app(consumer_key)
@@ -240,8 +265,7 @@ class MachineDataStore(oauth.OAuthStore):
 
         IMPORTANT: raises an exception if the nonce has already been stored
         """
-        nonce, created = models.Nonce.objects.get_or_create(nonce=nonce_str)
-        if not created:
+        if not nonces.NONCE_STORE.add(nonce_str):
             raise oauth.OAuthError("Nonce already exists")
 
 
@@ -250,15 +274,31 @@ class SessionDataStore(oauth.OAuthStore):
     Layer between Python OAuth and Django database.
 
     An oauth-server for in-RAM chrome-app user-specific tokens
+
+    The store is shared by every request, so a token row already looked up
+    for the request being verified is kept per thread (see prefetched).
     """
 
-    def _get_chrome_app(self, consumer_key):
+    def __init__(self):
+        self.local = threading.local()
+
+    @contextmanager
+    def prefetched(self, token):
+        """Lookups of token's string use the token row while in the block"""
+        self.local.token = token
         try:
-            ret = models.MachineApp.objects.get(
-                consumer_key=consumer_key, app_type='chrome')
-            return ret
-        except models.MachineApp.DoesNotExist:
-            return None
+            yield
+        finally:
+            self.local.token = None
+
+    def _prefetched(self, token_str):
+        token = getattr(self.local, 'token', None)
+        if token is not None and token.token == token_str:
+            return token
+        return None
+
+    def _get_chrome_app(self, consumer_key):
+        return _get_machine_app(consumer_key, 'chrome')
 
     def _get_request_token(self, token_str, type=None, pha=None):
         try:
@@ -268,11 +308,7 @@ class SessionDataStore(oauth.OAuthStore):
             return None
 
     def _get_token(self, token_str, type=None, pha=None):
-        try:
-            ret = models.SessionToken.objects.get(token=token_str)
-            return ret
-        except models.SessionToken.DoesNotExist:
-            return None
+        return self._prefetched(token_str) or _get_session_token(token_str)
 
     def lookup_consumer(self, consumer_key):
         """
@@ -362,24 +398,20 @@ class SMArtConnectDataStore(SessionDataStore):
     """
 
     def _get_chrome_app(self, consumer_key):
-        try:
-            return models.MachineApp.objects.get(consumer_key=consumer_key, app_type='chrome')
-        except models.MachineApp.DoesNotExist:
-            return None
+        return _get_machine_app(consumer_key, 'chrome')
 
     def _get_token(self, token_str, app=None):
-        kwargs = {'token': token_str}
         #print "evaluating as SC, looking for", token_str
-        try:
-
-            ret = models.AccessToken.objects.get(**kwargs)
-            if not ret.smart_connect_p:
-                oauth.report_error(
-                    "Not a SMArt Connect Request -- don't treat as one!")
-            return ret
-        except models.AccessToken.DoesNotExist:
+        ret = self._prefetched(token_str) or _get_access_token(token_str)
+        if ret is None:
             oauth.report_error(
                 "No token means this isn't a SMArt Connect Request!")
+            return None
+        if not ret.smart_connect_p:
+            oauth.report_error(
+                "Not a SMArt Connect Request -- don't treat as one!")
+            return None
+        return ret
 
 ADMIN_OAUTH_SERVER = oauth.OAuthServer(store=MachineDataStore())
 SESSION_OAUTH_SERVER = oauth.OAuthServer(store=SessionDataStore())
@@ -0,0 +1,229 @@
+"""
+Short-lived caches for principal resolution and permission sets
+
+Every OAuth-signed request used to look its consumer and token up in the
+database (once per OAuth server tried), and every principal rebuilt its
+PermissionSet from the rules modules.  Positive lookups and built
+permission sets are now kept for a few seconds:
+
+  LOOKUPS  -- apps by consumer key and tokens by token string, exactly as
+              the OAuth data stores query them
+  PERMSETS -- permission sets by principal
+
+Signatures, nonces and timestamps are still checked on every request;
+only the database rows behind them are cached.  Entries never outlive
+their token's expires_at, and saving or deleting a token, account, app or
+share drops the entries that depend on it.
+
+Other processes learn of such a change through a revocation generation
+kept in django's cache: every change bumps it, and an entry cached under
+an older generation is treated as missing.  That is only as shared as
+CACHE_BACKEND is, so the cache is opt-in: turn it on (a 'ttl' in
+settings.PRINCIPAL_CACHE) only with a cache backend all the server
+processes share, such as memcached.
+"""
+
+from collections import OrderedDict
+import calendar
+import copy
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Model
+from django.db.models.signals import post_save, post_delete
+
+from smart import models
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 30
+
+
+class TTLCache(object):
+    """A bounded LRU whose entries expire, and can be dropped by tag"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires, value, tags)
+        self.keys_by_tag = {}
+
+    def _drop(self, key):
+        # caller holds the lock
+        expires, value, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            if entry[0] <= time.time():
+                self._drop(key)
+                return None
+            return entry[1]
+
+    def set(self, key, value, tags=(), expires=None):
+        """expires (a timestamp) can only shorten the entry's TTL"""
+        if not self.ttl:
+            return
+
+        until = time.time() + self.ttl
+        if expires is not None:
+            until = min(until, expires)
+
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (until, value, tuple(tags))
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate_tag(self, tag):
+        with self.lock:
+            for key in list(self.keys_by_tag.get(tag, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.keys_by_tag = {}
+
+
+def _options():
+    options = getattr(settings, 'PRINCIPAL_CACHE', None) or {}
+    return {'max_entries': options.get('max_entries', DEFAULT_MAX_ENTRIES),
+            'ttl': options.get('ttl', 0)}
+
+LOOKUPS = TTLCache(**_options())
+PERMSETS = TTLCache(**_options())
+
+
+def expiry(obj):
+    """obj.expires_at (naive UTC, as tokens store it) as a timestamp"""
+    expires_at = getattr(obj, 'expires_at', None)
+    if expires_at is None:
+        return None
+    return calendar.timegm(expires_at.utctimetuple())
+
+
+GENERATION_KEY = "smart.principals.generation"
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60  # the longest memcached allows
+
+
+def generation():
+    """The current revocation generation, shared by all processes"""
+    ret = cache.get(GENERATION_KEY)
+    if ret is None:
+        # a fresh random value, so entries of a generation evicted from the
+        # cache can't match again (a clock reading could, when the old
+        # value was bumped as many times as milliseconds have passed)
+        cache.add(GENERATION_KEY, random.getrandbits(62), GENERATION_TIMEOUT)
+        ret = cache.get(GENERATION_KEY)
+    return ret
+
+
+def bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # not stored (or evicted): start over from a fresh value
+        generation()
+
+
+def copy_row(row):
+    """A copy of a model row, and of the related rows select_related cached
+    on it, so requests never share a mutable object"""
+    ret = copy.copy(row)
+    for k, v in row.__dict__.iteritems():
+        if k.endswith('_cache') and isinstance(v, Model):
+            setattr(ret, k, copy_row(v))
+    return ret
+
+
+def principal_tag(obj):
+    # tokens, accounts and apps all have globally unique ids
+    return ('principal', obj.id)
+
+
+def lookup(key, fetch, depends_on=None):
+    """Returns a copy of the cached row for key, or whatever fetch() finds.
+
+    Only rows that were found are cached; a copy is handed out so that
+    attributes set while serving one request don't leak into the next.
+    depends_on(row) may name further tags that invalidate the entry.
+    """
+    if not LOOKUPS.ttl:
+        return fetch()
+
+    current = generation()
+    entry = LOOKUPS.get(key)
+    if entry is None or entry[0] != current:
+        ret = fetch()
+        if ret is None:
+            return None
+        tags = [principal_tag(ret)] + list(depends_on and depends_on(ret) or ())
+        entry = (current, ret)
+        LOOKUPS.set(key, entry, tags, expiry(ret))
+    return copy_row(entry[1])
+
+
+def permset(principal, build):
+    if not PERMSETS.ttl:
+        return build()
+
+    current = generation()
+    key = (principal.__class__.__name__, principal.id)
+    entry = PERMSETS.get(key)
+    if entry is None or entry[0] != current:
+        entry = (current, build())
+        PERMSETS.set(key, entry, (principal_tag(principal),), expiry(principal))
+    return entry[1]
+
+
+##
+## invalidation
+##
+
+def _principal_changed(sender, instance, **kwargs):
+    bump_generation()
+    tag = principal_tag(instance)
+    LOOKUPS.invalidate_tag(tag)
+    PERMSETS.invalidate_tag(tag)
+
+
+def _account_changed(sender, instance, **kwargs):
+    _principal_changed(sender, instance)
+    # session tokens hold on to their account
+    LOOKUPS.invalidate_tag(('Account', instance.id))
+
+
+def _clear_all(sender, instance, **kwargs):
+    # apps and shares are captured by many tokens and permission sets
+    bump_generation()
+    LOOKUPS.clear()
+    PERMSETS.clear()
+
+for m in (models.AccessToken, models.ReqToken, models.SessionToken):
+    post_save.connect(_principal_changed, sender=m)
+    post_delete.connect(_principal_changed, sender=m)
+
+for m in (models.Account, models.LimitedAccount):
+    post_save.connect(_account_changed, sender=m)
+    post_delete.connect(_account_changed, sender=m)
+
+for m in (models.PHA, models.HelperApp, models.MachineApp, models.Share):
+    post_save.connect(_clear_all, sender=m)
+    post_delete.connect(_clear_all, sender=m)
@@ -0,0 +1,82 @@
+"""
+Incremental cleanup of expired tokens and old nonces
+
+Expired rows are deleted a bounded batch at a time, oldest first, walking
+the expires_at/created_at indexes, so the tables are never locked for
+long.  The reaper can run once (cleanup_old_tokens), in a loop
+(cleanup_old_tokens --loop), or in a background thread of the server
+process (settings.TOKEN_REAPER_INTERVAL, see smart.utils.startup).
+"""
+
+import datetime
+import threading
+import time
+
+from oauth.oauth import TIMESTAMP_THRESHOLD
+
+from smart import models
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Reaper(object):
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, pause=0, verbose=True):
+        self.batch_size = batch_size
+        self.pause = pause  # seconds between batches, to let other writers in
+        self.verbose = verbose
+
+    def targets(self, now):
+        """(model, indexed date field, cutoff) for everything to reap"""
+        # tokens expire in UTC, but Nonce.created_at (auto_now_add) is in
+        # settings.TIME_ZONE local time
+        oldest_nonce = datetime.datetime.now() - datetime.timedelta(seconds=TIMESTAMP_THRESHOLD)
+        return [(models.SessionToken, 'expires_at', now),
+                (models.AccessToken, 'expires_at', now),
+                (models.Nonce, 'created_at', oldest_nonce)]
+
+    def reap(self, model, field, cutoff):
+        """Deletes model rows with field < cutoff in batches; returns the count"""
+        total = 0
+        old = model.objects.filter(**{field + '__lt': cutoff}).order_by(field)
+        while True:
+            pks = list(old.values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return total
+
+            # deleting through the ORM still cascades and sends signals
+            model.objects.filter(pk__in=pks).delete()
+            total += len(pks)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def run_once(self):
+        """Reaps every target; returns {model name: (rows, seconds)}"""
+        ret = {}
+        now = datetime.datetime.utcnow()
+        for model, field, cutoff in self.targets(now):
+            st = time.time()
+            rows = self.reap(model, field, cutoff)
+            elapsed = time.time() - st
+            ret[model.__name__] = (rows, elapsed)
+            if self.verbose:
+                print "reaped %d %s rows in %.2fs (%.0f rows/s)" % (
+                    rows, model.__name__, elapsed, rows / (elapsed or 1e-9))
+        return ret
+
+    def run_forever(self, interval):
+        while True:
+            try:
+                self.run_once()
+            except Exception, e:
+                print "Token reaper failed:", e
+            finally:
+                from django.db import connection
+                connection.close()
+            time.sleep(interval)
+
+    def start(self, interval):
+        """Runs the reaper every interval seconds in a daemon thread"""
+        t = threading.Thread(target=self.run_forever, args=(interval,))
+        t.daemon = True
+        t.start()
+        return t
@@ -13,11 +13,15 @@ from django.core.exceptions import *
 import functools
 import copy
 import logging
+import re
+import threading
+import urllib
 
 from oauth import oauth, djangoutils
 
 from smart import models
 from smart.accesscontrol.oauth_servers import ADMIN_OAUTH_SERVER, OAUTH_SERVER, SMART_CONNECT_OAUTH_SERVER, SESSION_OAUTH_SERVER, HELPER_APP_SERVER
+from smart.accesscontrol.oauth_servers import _get_access_token, _get_session_token
 
 
 ##
@@ -32,43 +36,149 @@ def get_oauth_info(request, server):
         return None, None, None, None
 
 
-def get_principal(request):
-    """Figure out the principal making the request.
+# the OAuth servers, in the order get_principal has always tried them
+SERVERS = (
+    ('smart_connect', SMART_CONNECT_OAUTH_SERVER),
+    ('session', SESSION_OAUTH_SERVER),
+    ('oauth', OAUTH_SERVER),
+    ('helper', HELPER_APP_SERVER),
+    ('admin', ADMIN_OAUTH_SERVER),
+)
+SERVERS_BY_NAME = dict(SERVERS)
 
-    First SMArt connect app (via web user); then web user; then PHA; then
-    Helper app; then Chrome App sudo'ing.
-    """
+OAUTH_HEADER_PARAM = re.compile(r'(oauth_[a-z_]+)="([^"]*)"')
+
+# how many requests took each dispatch path, see get_principal
+DISPATCH_COUNTS = {}
+_dispatch_lock = threading.Lock()
 
-    # Look for a SMArt Connect Request, which comes signed with an empty
-    # "consumer secret"
-    pha, token, parameters, oauth_request = get_oauth_info(request, SMART_CONNECT_OAUTH_SERVER)
-    if pha and token:
-        return token, oauth_request
 
-    # is this a chrome app with a user session token?
-    chrome_app, token, parameters, oauth_request = get_oauth_info(request, SESSION_OAUTH_SERVER)
-    if token:
-        return token.user, oauth_request
+def oauth_identifiers(request):
+    """The (consumer key, token) a request claims, before any verification.
 
-    # check oauth
-    # IMPORTANT: the principal is the token, not the PHA itself
+    Looks in the Authorization header, then the query string and form
+    body, like the OAuth library does.  (None, None) when the request
+    isn't OAuth-signed at all.
+    """
+    params = {}
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if header[:6].lower() == 'oauth ':
+        for k, v in OAUTH_HEADER_PARAM.findall(header):
+            params[k] = urllib.unquote(v)
+
+    for source in (request.GET, request.POST):
+        for k in ('oauth_consumer_key', 'oauth_token'):
+            if k not in params and k in source:
+                params[k] = source[k]
+
+    return params.get('oauth_consumer_key'), params.get('oauth_token')
+
+
+def classify(consumer_key, token_str):
+    """The servers that could accept these credentials, in order, as
+    (name, token) pairs.
+
+    A single query finds the type of every app using the consumer key
+    (and the app_type of machine apps); servers for other kinds of app
+    would fail their consumer lookup, so they're left out.  Chrome apps
+    act through a SMArt Connect or a session token, which is told apart
+    by looking the token up -- through the principal cache.  The row
+    found is returned with the server's name, for principal_from_server
+    to hand over so it isn't looked up again; token is None otherwise.
+    """
+    types = {}
+    for t, app_type in models.OAuthApp.objects.filter(
+            consumer_key=consumer_key).values_list('type', 'machineapp__app_type'):
+        types.setdefault(t, set()).add(app_type)
+
+    if set(types) - set(('PHA', 'HelperApp', 'MachineApp')):
+        # not something we know how to classify: try everything
+        return [(name, None) for (name, server) in SERVERS]
+
+    ret = []
+    if 'chrome' in types.get('MachineApp', ()) and token_str:
+        token = _get_access_token(token_str)
+        if token is not None and token.smart_connect_p:
+            ret.append(('smart_connect', token))
+        else:
+            token = _get_session_token(token_str)
+            if token is not None:
+                ret.append(('session', token))
+    if 'PHA' in types:
+        ret.append(('oauth', None))
+    if 'HelperApp' in types:
+        ret.append(('helper', None))
+    if 'MachineApp' in types:
+        ret.append(('admin', None))
+    return ret
+
+
+def principal_from_server(request, name, token=None):
+    """Verify the request against the server of that name in SERVERS.
+
+    token is the row of the request's token if it's already been looked
+    up (only the smart_connect and session servers use it).
+
+    Returns (principal, oauth_request) if the server accepts the request
+    (the principal can still be None: a session token without a user), or
+    None if it doesn't.
+    """
+    server = SERVERS_BY_NAME[name]
+    if token is not None:
+        with server.store.prefetched(token):
+            app, token, parameters, oauth_request = get_oauth_info(request, server)
+    else:
+        app, token, parameters, oauth_request = get_oauth_info(request, server)
+
+    # IMPORTANT: for access tokens the principal is the token, not the PHA
+    # itself
     # TODO: is this really the right thing, is the token the principal?
-    pha, token, parameters, oauth_request = get_oauth_info(request, OAUTH_SERVER)
-    if pha:
-        if token:
+    if name == 'smart_connect':
+        if app and token:
             return token, oauth_request
-        return pha, oauth_request
-
-    ha, token, parameters, oauth_request = get_oauth_info(request, HELPER_APP_SERVER)
-    if ha:
+    elif name == 'session':
         if token:
-            return token, oauth_request
-        return ha, oauth_request
+            return token.user, oauth_request
+    elif name in ('oauth', 'helper'):
+        if app:
+            return token or app, oauth_request
+    elif app:
+        return app, oauth_request
+    return None
+
+
+def _record_dispatch(request, path):
+    request.oauth_dispatch = path
+    with _dispatch_lock:
+        DISPATCH_COUNTS[path] = DISPATCH_COUNTS.get(path, 0) + 1
 
-        # check a machine application
-    admin_app, token, params, oauth_request = get_oauth_info(request, ADMIN_OAUTH_SERVER)
 
-    if admin_app:
-        return admin_app, oauth_request
+def dispatch_stats():
+    with _dispatch_lock:
+        return dict(DISPATCH_COUNTS)
 
+
+def get_principal(request):
+    """Figure out the principal making the request.
+
+    First SMArt connect app (via web user); then web user; then PHA; then
+    Helper app; then Chrome App sudo'ing.
+
+    Rather than verifying the request against each of those in turn, the
+    servers are first narrowed down from the consumer key and token, so
+    an ordinary request is verified exactly once.  Should that fail, the
+    other remaining candidates are still tried in order.
+    """
+    consumer_key, token_str = oauth_identifiers(request)
+    if not consumer_key:
+        _record_dispatch(request, 'unsigned')
+        return None, None
+
+    for i, (name, token) in enumerate(classify(consumer_key, token_str)):
+        ret = principal_from_server(request, name, token)
+        if ret:
+            _record_dispatch(request, i == 0 and name or 'fallback:' + name)
+            return ret
+
+    _record_dispatch(request, 'rejected')
     return None, None
@@ -0,0 +1,378 @@
+"""
+Tests for access control: the principal cache, OAuth server dispatch,
+nonce stores and the token reaper
+"""
+
+import datetime
+import time
+import unittest
+
+from django.core.cache import cache, get_cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from oauth import oauth
+
+from smart import models
+import nonces
+import oauth_servers
+import principal_cache
+import reaper
+import security
+
+
+class Row(object):
+    def __init__(self, id, expires_at=None):
+        self.id = id
+        self.expires_at = expires_at
+
+
+class PrincipalCacheMixin(object):
+    """Runs each test with both caches turned on"""
+    def setUp(self):
+        self.saved = principal_cache.LOOKUPS, principal_cache.PERMSETS
+        principal_cache.LOOKUPS = principal_cache.TTLCache(ttl=30)
+        principal_cache.PERMSETS = principal_cache.TTLCache(ttl=30)
+        cache.delete(principal_cache.GENERATION_KEY)
+        self.fetches = 0
+
+    def tearDown(self):
+        principal_cache.LOOKUPS, principal_cache.PERMSETS = self.saved
+
+    def fetch(self, row):
+        def run():
+            self.fetches += 1
+            return row
+        return run
+
+
+class PrincipalCacheTests(PrincipalCacheMixin, unittest.TestCase):
+    def test_disabled_cache_always_fetches(self):
+        principal_cache.LOOKUPS = principal_cache.TTLCache(ttl=0)
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        self.assertEqual(self.fetches, 2)
+
+    def test_hands_out_copies(self):
+        row = Row("t1")
+        a = principal_cache.lookup('k', self.fetch(row))
+        b = principal_cache.lookup('k', self.fetch(row))
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual((a.id, b.id), ("t1", "t1"))
+        self.assertFalse(a is b or a is row)
+
+    def test_misses_are_not_cached(self):
+        principal_cache.lookup('k', self.fetch(None))
+        principal_cache.lookup('k', self.fetch(None))
+        self.assertEqual(self.fetches, 2)
+
+    def test_generation_bumped_elsewhere_drops_every_entry(self):
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        # what bump_generation does in another server process
+        cache.incr(principal_cache.GENERATION_KEY)
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        self.assertEqual(self.fetches, 2)
+
+    def test_lost_generation_starts_over(self):
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        cache.delete(principal_cache.GENERATION_KEY)
+        principal_cache.bump_generation()
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        self.assertEqual(self.fetches, 2)
+
+    def test_entries_dont_outlive_the_token(self):
+        expired = Row("t1", datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        principal_cache.lookup('k', self.fetch(expired))
+        principal_cache.lookup('k', self.fetch(expired))
+        self.assertEqual(self.fetches, 2)
+
+    def test_change_signal_bumps_the_generation(self):
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        before = principal_cache.generation()
+        principal_cache._principal_changed(models.AccessToken, Row("t2"))
+        self.assertEqual(principal_cache.generation(), before + 1)
+        principal_cache.lookup('k', self.fetch(Row("t1")))
+        self.assertEqual(self.fetches, 2)
+
+    def test_permsets(self):
+        builds = []
+        principal = Row("t1")
+        build = lambda: builds.append(True) or "permset"
+        self.assertEqual(principal_cache.permset(principal, build), "permset")
+        self.assertEqual(principal_cache.permset(principal, build), "permset")
+        self.assertEqual(len(builds), 1)
+        principal_cache.bump_generation()
+        principal_cache.permset(principal, build)
+        self.assertEqual(len(builds), 2)
+
+    def test_related_rows_are_copied(self):
+        token = models.AccessToken(id="t1", token="t1")
+        token._share_cache = models.Share(id="s1")
+        copied = principal_cache.copy_row(token)
+        self.assertFalse(copied._share_cache is token._share_cache)
+        self.assertEqual(copied._share_cache.id, "s1")
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        c = principal_cache.TTLCache(max_entries=2)
+        c.set('a', 1, [('principal', 'x')])
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (1, None, 3))
+
+    def test_invalidate_tag(self):
+        c = principal_cache.TTLCache()
+        c.set('a', 1, [('principal', 'x')])
+        c.set('b', 2, [('principal', 'x'), ('Account', 'y')])
+        c.set('c', 3, [('Account', 'y')])
+        c.invalidate_tag(('principal', 'x'))
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (None, None, 3))
+        self.assertEqual(c.keys_by_tag, {('Account', 'y'): set(['c'])})
+
+    def test_expires(self):
+        c = principal_cache.TTLCache()
+        c.set('a', 1, expires=time.time() - 1)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.entries, {})
+
+
+class RevokedTokenTests(PrincipalCacheMixin, TestCase):
+    """A deleted token stops authenticating straight away, cache or not"""
+    def test_deleted_session_token(self):
+        token = models.SessionToken.objects.create(
+            token="abc", secret="def",
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        self.assertEqual(oauth_servers._get_session_token("abc").id, token.id)
+        self.assertEqual(oauth_servers._get_session_token("abc").id, token.id)
+
+        token.delete()
+        self.assertEqual(oauth_servers._get_session_token("abc"), None)
+
+
+def signed_request(consumer_key=None, token=None):
+    params = []
+    if consumer_key:
+        params.append('oauth_consumer_key="%s"' % consumer_key)
+    if token:
+        params.append('oauth_token="%s"' % token)
+    headers = {}
+    if params:
+        headers['HTTP_AUTHORIZATION'] = 'OAuth realm="", ' + ", ".join(params)
+    return RequestFactory().get("/records/123/medications/", **headers)
+
+
+class DispatchTests(TestCase):
+    def setUp(self):
+        models.PHA.objects.create(email="pha@apps.smartplatforms.org", consumer_key="pha-key",
+                                  secret="s", name="PHA", mode="ui")
+        models.HelperApp.objects.create(email="helper@apps.smartplatforms.org",
+                                        consumer_key="helper-key", secret="s", name="Helper")
+        models.MachineApp.objects.create(email="chrome@apps.smartplatforms.org",
+                                         consumer_key="chrome-key", secret="s", name="Chrome",
+                                         app_type="chrome")
+        models.MachineApp.objects.create(email="admin@apps.smartplatforms.org",
+                                         consumer_key="admin-key", secret="s", name="Admin",
+                                         app_type="admin")
+        self.session_token = models.SessionToken.objects.create(
+            token="session-token", secret="s",
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+
+        self.saved = security.get_oauth_info, security._get_access_token
+        security._get_access_token = lambda token_str, app=None: None
+        self.accepting = set()
+        self.verified = []
+        security.get_oauth_info = self.get_oauth_info
+
+    def tearDown(self):
+        security.get_oauth_info, security._get_access_token = self.saved
+
+    def get_oauth_info(self, request, server):
+        """Accepts the request on the servers named in self.accepting"""
+        # only the module's servers are ever used, never one per request
+        [name] = [n for (n, s) in security.SERVERS if s is server]
+        prefetched = getattr(server.store, '_prefetched', None)
+        self.verified.append((name, prefetched and prefetched("session-token")))
+        if name in self.accepting:
+            return "app", None, {}, "oauth_request"
+        return None, None, None, None
+
+    def test_classify(self):
+        self.assertEqual(security.classify("pha-key", "t"), [('oauth', None)])
+        self.assertEqual(security.classify("helper-key", None), [('helper', None)])
+        self.assertEqual(security.classify("admin-key", None), [('admin', None)])
+        self.assertEqual(security.classify("nobody", "t"), [])
+
+    def test_classify_chrome_session(self):
+        [(name, token), fallback] = security.classify("chrome-key", "session-token")
+        self.assertEqual((name, token.id), ('session', self.session_token.id))
+        self.assertEqual(fallback, ('admin', None))
+        self.assertEqual(security.classify("chrome-key", None), [('admin', None)])
+        self.assertEqual(security.classify("chrome-key", "no-such-token"), [('admin', None)])
+
+    def test_classify_smart_connect(self):
+        connect_token = Row("t1")
+        connect_token.smart_connect_p = True
+        security._get_access_token = lambda token_str, app=None: connect_token
+        self.assertEqual(security.classify("chrome-key", "t1"),
+                         [('smart_connect', connect_token), ('admin', None)])
+
+    def dispatch(self, request):
+        before = security.dispatch_stats()
+        ret = security.get_principal(request)
+        after = security.dispatch_stats()
+        changed = [k for k in after if after[k] != before.get(k, 0)]
+        self.assertEqual(changed, [request.oauth_dispatch])
+        self.assertEqual(after[request.oauth_dispatch], before.get(request.oauth_dispatch, 0) + 1)
+        return ret
+
+    def test_one_verification_for_an_ordinary_request(self):
+        self.accepting = set(['oauth'])
+        request = signed_request("pha-key", "t")
+        self.assertEqual(self.dispatch(request), ("app", "oauth_request"))
+        self.assertEqual(request.oauth_dispatch, 'oauth')
+        self.assertEqual(self.verified, [('oauth', None)])
+
+    def test_session_token_row_is_handed_over(self):
+        self.accepting = set(['admin'])
+        request = signed_request("chrome-key", "session-token")
+        self.dispatch(request)
+        self.assertEqual(request.oauth_dispatch, 'fallback:admin')
+        [(name, prefetched), admin] = self.verified
+        self.assertEqual((name, prefetched.id), ('session', self.session_token.id))
+        # and only while the request is verified
+        self.assertEqual(security.SESSION_OAUTH_SERVER.store._prefetched("session-token"), None)
+
+    def test_unsigned_and_rejected(self):
+        request = signed_request()
+        self.assertEqual(self.dispatch(request), (None, None))
+        self.assertEqual(request.oauth_dispatch, 'unsigned')
+
+        request = signed_request("pha-key")
+        self.assertEqual(self.dispatch(request), (None, None))
+        self.assertEqual(request.oauth_dispatch, 'rejected')
+        self.assertEqual(self.verified, [('oauth', None)])
+
+
+class SMArtConnectStoreTests(TestCase):
+    def get_token(self, token_str):
+        try:
+            return oauth_servers.SMArtConnectDataStore()._get_token(token_str)
+        except oauth.OAuthError:
+            return None
+
+    def test_missing_token_is_refused(self):
+        self.assertEqual(self.get_token("no-such-token"), None)
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class NonceStoreTests(object):
+    """Replay rejection, common to every store"""
+    def test_replay_is_rejected(self):
+        self.assertTrue(self.store.add("n1"))
+        self.assertFalse(self.store.add("n1"))
+        self.assertTrue(self.store.add("n2"))
+        self.assertFalse(self.store.add("n2"))
+
+
+class DatabaseNonceStoreTests(NonceStoreTests, TestCase):
+    def setUp(self):
+        self.store = nonces.DatabaseNonceStore()
+
+
+class CacheNonceStoreTests(NonceStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = nonces.CacheNonceStore()
+        self.store.cache = get_cache('locmem://nonce-store-tests')
+        self.store.cache.clear()
+
+    def test_keys_are_memcached_safe(self):
+        self.assertTrue(self.store.add("a nonce with spaces " * 20))
+        self.assertFalse(self.store.add("a nonce with spaces " * 20))
+
+
+class BucketedNonceStoreTests(NonceStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.saved_time = nonces.time
+        nonces.time = FakeClock(1000 * 300)
+        self.store = nonces.BucketedNonceStore(window=300, retain=2)
+
+    def tearDown(self):
+        nonces.time = self.saved_time
+
+    def test_kept_for_the_retained_buckets(self):
+        self.store.add("n1")
+        nonces.time.now += 2 * 300
+        self.assertFalse(self.store.add("n1"))
+
+    def test_old_buckets_are_dropped(self):
+        self.store.add("n1")
+        nonces.time.now += 3 * 300
+        self.store.add("n2")
+        self.assertEqual(self.store.buckets, {1003: set(["n2"])})
+        self.assertTrue(self.store.add("n1"))
+
+    def test_oauth_stores_refuse_a_replay(self):
+        saved, nonces.NONCE_STORE = nonces.NONCE_STORE, self.store
+        try:
+            for data_store in (oauth_servers.UserDataStore(), oauth_servers.MachineDataStore()):
+                data_store.check_and_store_nonce("n-%s" % data_store.__class__.__name__)
+                self.assertRaises(oauth.OAuthError, data_store.check_and_store_nonce,
+                                  "n-%s" % data_store.__class__.__name__)
+        finally:
+            nonces.NONCE_STORE = saved
+
+
+class ReaperTests(TestCase):
+    def setUp(self):
+        self.now = datetime.datetime.utcnow()
+        self.saved_sleep = reaper.time.sleep
+        self.batches = []
+        reaper.time.sleep = self.batches.append
+
+    def tearDown(self):
+        reaper.time.sleep = self.saved_sleep
+
+    def session_tokens(self, n, expires_in):
+        for i in range(n):
+            models.SessionToken.objects.create(
+                token="t%d-%s" % (i, expires_in), secret="s",
+                expires_at=self.now + datetime.timedelta(seconds=expires_in))
+
+    def test_deletes_in_batches(self):
+        self.session_tokens(5, -60)
+        self.session_tokens(2, 60)
+        r = reaper.Reaper(batch_size=2, pause=0.5, verbose=False)
+        self.assertEqual(r.reap(models.SessionToken, 'expires_at', self.now), 5)
+        # a pause after each of the batches of 2, 2 and 1
+        self.assertEqual(self.batches, [0.5, 0.5, 0.5])
+        self.assertEqual(models.SessionToken.objects.count(), 2)
+        self.assertFalse(models.SessionToken.objects.filter(expires_at__lt=self.now).exists())
+
+    def test_nothing_to_reap(self):
+        self.session_tokens(2, 60)
+        r = reaper.Reaper(batch_size=2, pause=0.5, verbose=False)
+        self.assertEqual(r.reap(models.SessionToken, 'expires_at', self.now), 0)
+        self.assertEqual(self.batches, [])
+
+    def test_run_once(self):
+        self.session_tokens(3, -60)
+        for n in ("old", "new"):
+            models.Nonce.objects.create(nonce=n)
+        # created_at is local time, unlike the tokens' UTC expiry
+        models.Nonce.objects.filter(nonce="old").update(
+            created_at=datetime.datetime.now() -
+            datetime.timedelta(seconds=oauth.TIMESTAMP_THRESHOLD + 60))
+
+        ret = reaper.Reaper(batch_size=2, verbose=False).run_once()
+        self.assertEqual(ret['SessionToken'][0], 3)
+        self.assertEqual(ret['AccessToken'][0], 0)
+        self.assertEqual(ret['Nonce'][0], 1)
+        self.assertEqual(list(models.Nonce.objects.values_list('nonce', flat=True)), ["new"])
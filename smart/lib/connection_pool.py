@@ -0,0 +1,195 @@
+"""
+Keep-alive HTTP connection pooling for the triplestore connectors
+
+Every SPARQL query and update used to open (and often leak) a fresh
+httplib connection.  Connections are now kept per endpoint (scheme + host)
+and handed back to the pool once their response has been fully read.
+"""
+
+import httplib
+import select
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 30
+
+# errors raised when a kept-alive socket has been closed by the other side
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine,
+                           httplib.CannotSendRequest,
+                           httplib.ResponseNotReady,
+                           socket.error)
+
+# requests a server can safely be sent twice
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of keep-alive connections to one host.
+
+    At most max_size idle connections are kept around; connections that
+    have been idle for longer than idle_timeout seconds are discarded
+    rather than reused.
+    """
+
+    def __init__(self, scheme, host, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, released_at), most recent last
+        self.stats = {'hits': 0, 'misses': 0, 'retries': 0, 'evictions': 0}
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.host)
+        return httplib.HTTPConnection(self.host)
+
+    def _evict_idle(self, now):
+        # caller holds the lock
+        fresh = []
+        for conn, released_at in self.idle:
+            if now - released_at > self.idle_timeout:
+                conn.close()
+                self.stats['evictions'] += 1
+            else:
+                fresh.append((conn, released_at))
+        self.idle = fresh
+
+    def _dropped(self, conn):
+        """Whether the other side has closed an idle connection: its socket
+        is readable although no response is expected"""
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def acquire(self):
+        """Returns (connection, reused_p)."""
+        while True:
+            with self.lock:
+                self._evict_idle(time.time())
+                if not self.idle:
+                    self.stats['misses'] += 1
+                    break
+                conn = self.idle.pop()[0]
+            if not self._dropped(conn):
+                with self.lock:
+                    self.stats['hits'] += 1
+                return conn, True
+            with self.lock:
+                self.stats['evictions'] += 1
+            conn.close()
+        return self._new_connection(), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+            self.stats['evictions'] += 1
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            for conn, released_at in self.idle:
+                conn.close()
+            self.idle = []
+
+    def _send(self, conn, method, path, body, headers, progress):
+        # progress gets an entry once part of the request has been written
+        if not callable(body):
+            # the request line, headers and body go out in a single send
+            conn.request(method, path, body, headers)
+            progress.append(True)
+            return conn.getresponse()
+
+        # body() yields the chunks of a chunked transfer-encoded body
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for k, v in headers.iteritems():
+            conn.putheader(k, v)
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        progress.append(True)
+        for chunk in body():
+            if chunk:
+                conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+        conn.send("0\r\n\r\n")
+        return conn.getresponse()
+
+    def request(self, method, path, body=None, headers=None, idempotent=None):
+        """Send a request and return (response, connection).
+
+        body is either a string or a callable returning an iterator over
+        the chunks of a streamed body; it's called again if the request
+        has to be retried, so it must produce the same chunks each time.
+
+        The response must be read completely and the connection then
+        handed to release() (or discard() if the response will_close).
+        A kept-alive connection that turns out to be stale is retried
+        once on a brand new connection, as long as the request is
+        idempotent (by default, when its method is) or none of it had
+        been written: otherwise the server may already have acted on it.
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+
+        conn, reused = self.acquire()
+        progress = []
+        try:
+            return self._send(conn, method, path, body, headers or {}, progress), conn
+        except STALE_CONNECTION_ERRORS:
+            self.discard(conn)
+            if not reused or (progress and not idempotent):
+                raise
+            with self.lock:
+                self.stats['retries'] += 1
+
+        conn = self._new_connection()
+        try:
+            return self._send(conn, method, path, body, headers or {}, []), conn
+        except:
+            self.discard(conn)
+            raise
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, host):
+    key = (scheme, host)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                scheme, host,
+                max_size=getattr(settings, 'TRIPLESTORE_POOL_SIZE', DEFAULT_MAX_SIZE),
+                idle_timeout=getattr(settings, 'TRIPLESTORE_POOL_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT))
+            _pools[key] = pool
+        return pool
+
+
+def pool_stats():
+    """Hit/miss counters for every endpoint pool, keyed by "scheme://host"."""
+    with _pools_lock:
+        pools = _pools.values()
+
+    ret = {}
+    for pool in pools:
+        with pool.lock:
+            s = dict(pool.stats)
+            s['idle'] = len(pool.idle)
+        ret["%s://%s" % (pool.scheme, pool.host)] = s
+    return ret
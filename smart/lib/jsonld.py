@@ -0,0 +1,211 @@
+"""
+Streaming JSON-LD serialization
+
+The bundled rdflib-jsonld serializer builds the whole JSON tree in memory
+before writing it out.  Here a graph is written one top-level node at a
+time, compacted against a context computed once from the SMART namespace
+bindings, and comes out as a generator of chunks (see rdf_stream.rechunk).
+Only the output is streamed: the graph itself is held in memory, since a
+node's triples can be anywhere in it.
+
+Each API type also gets its own context, cached for the life of the
+process: the SMART prefixes plus a plain term for each of the type's
+properties, so a medication's sp:drugName is written as "drugName".
+
+Blank nodes referenced exactly once are embedded where they're used, and
+RDF collections become @list values, so a statement reads as one object.
+"""
+
+import hashlib
+import json
+import threading
+
+from rdflib import URIRef, BNode, Literal, RDF
+from rdflib.namespace import XSD
+
+from smart.common.rdf_tools.util import bound_graph
+from smart.lib import rdf_stream
+
+XML_NAMESPACE = u"http://www.w3.org/XML/1998/namespace"
+
+
+class Context(object):
+    """Prefix and term definitions.  IRIs with a term are written as the
+    term, IRIs in a known namespace as CURIEs, and expand() reverses that;
+    each way is a dict lookup."""
+
+    def __init__(self, prefixes, terms=None):
+        self.prefixes = dict((p, unicode(ns)) for p, ns in prefixes.iteritems())
+        self.by_namespace = dict((ns, p) for p, ns in self.prefixes.iteritems())
+        self.terms = dict((k, unicode(iri)) for k, iri in (terms or {}).iteritems())
+        self.by_iri = dict((iri, k) for k, iri in self.terms.iteritems())
+        self._document = None
+
+    def shrink(self, iri):
+        iri = unicode(iri)
+        term = self.by_iri.get(iri)
+        if term:
+            return term
+        for sep in u"#/":
+            i = iri.rfind(sep)
+            if i >= 0:
+                prefix = self.by_namespace.get(iri[:i + 1])
+                if prefix:
+                    return u"%s:%s" % (prefix, iri[i + 1:])
+        return iri
+
+    def expand(self, term_curie_or_iri):
+        """The IRI of a term or CURIE; anything else is returned as is"""
+        value = unicode(term_curie_or_iri)
+        iri = self.terms.get(value)
+        if iri:
+            return iri
+        prefix, sep, name = value.partition(u":")
+        ns = sep and self.prefixes.get(prefix)
+        if ns and not name.startswith(u"//"):
+            return ns + name
+        return value
+
+    def to_dict(self):
+        ret = dict(self.prefixes)
+        ret.update(self.terms)
+        return ret
+
+    def document(self):
+        """(JSON context document, its ETag), computed once"""
+        if self._document is None:
+            body = json.dumps({"@context": self.to_dict()}, sort_keys=True, indent=1)
+            self._document = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+        return self._document
+
+
+_lock = threading.Lock()
+_smart_context = None
+
+
+def smart_context():
+    """The Context for the namespaces SMART graphs are bound to"""
+    global _smart_context
+    with _lock:
+        if _smart_context is None:
+            _smart_context = Context(dict(
+                (p, ns) for p, ns in bound_graph().namespaces()
+                if p and unicode(ns) != XML_NAMESPACE))
+        return _smart_context
+
+
+def local_name(iri):
+    iri = unicode(iri)
+    return iri[max(iri.rfind(u"#"), iri.rfind(u"/")) + 1:]
+
+
+def _type_terms(type_uri, prefixes):
+    """{term: property IRI} for the properties of an API type, leaving out
+    local names that are ambiguous or clash with a prefix"""
+    from smart.models.record_object import RecordObject
+    try:
+        properties = RecordObject[type_uri].properties
+    except KeyError:
+        return None
+
+    by_name = {}
+    for p in properties:
+        by_name.setdefault(local_name(p), set()).add(unicode(p))
+    return dict((name, iris.pop()) for name, iris in by_name.iteritems()
+                if name and len(iris) == 1 and name not in prefixes)
+
+
+_type_contexts = {}
+
+
+def type_context(type_uri):
+    """The Context for an API type, or None if it isn't one"""
+    type_uri = unicode(type_uri)
+    with _lock:
+        if type_uri in _type_contexts:
+            return _type_contexts[type_uri]
+
+    base = smart_context()
+    terms = _type_terms(type_uri, base.prefixes)
+    context = terms is not None and Context(base.prefixes, terms) or None
+    with _lock:
+        return _type_contexts.setdefault(type_uri, context)
+
+
+def warm_type_contexts():
+    """Builds the context of every API type up front, e.g. before forking"""
+    from smart.models.record_object import RecordObject
+    for type_uri in RecordObject.known_types_dict.keys():
+        type_context(type_uri)
+    return len(_type_contexts)
+
+
+class NodeWriter(object):
+    def __init__(self, graph, context):
+        self.graph = graph
+        self.context = context
+
+        # blank nodes used once are written inline, at their only use
+        uses = {}
+        for o in graph.objects():
+            if isinstance(o, BNode):
+                uses[o] = uses.get(o, 0) + 1
+        self.embedded = set(b for b, n in uses.iteritems() if n == 1)
+
+    def top_level(self):
+        return [s for s in set(self.graph.subjects()) if s not in self.embedded]
+
+    def node(self, s, open_nodes=()):
+        shrink = self.context.shrink
+        ret = {}
+        if isinstance(s, URIRef):
+            ret["@id"] = shrink(s)
+        elif s not in self.embedded:
+            ret["@id"] = "_:%s" % s
+
+        open_nodes += (s,)
+        for p, o in self.graph.predicate_objects(s):
+            if p == RDF.type and isinstance(o, URIRef):
+                ret.setdefault("@type", []).append(shrink(o))
+            else:
+                ret.setdefault(shrink(p), []).append(self.value(o, open_nodes))
+
+        for k, v in ret.iteritems():
+            if isinstance(v, list) and len(v) == 1:
+                ret[k] = v[0]
+        return ret
+
+    def value(self, o, open_nodes):
+        if o == RDF.nil:
+            return {"@list": []}
+
+        if isinstance(o, Literal):
+            if o.language:
+                return {"@value": unicode(o), "@language": o.language}
+            if o.datatype and o.datatype != XSD.string:
+                return {"@value": unicode(o), "@type": self.context.shrink(o.datatype)}
+            return unicode(o)
+
+        if isinstance(o, BNode) and o in self.embedded and o not in open_nodes:
+            if (o, RDF.first, None) in self.graph:
+                return {"@list": [self.value(x, open_nodes) for x in self.graph.items(o)]}
+            return self.node(o, open_nodes)
+
+        if isinstance(o, BNode):
+            return {"@id": "_:%s" % o}
+        return {"@id": self.context.shrink(o)}
+
+
+def _pieces(graph, context):
+    writer = NodeWriter(graph, context)
+    yield '{"@context": %s,\n "@graph": [' % json.dumps(context.to_dict(), sort_keys=True)
+    sep = "\n"
+    for s in writer.top_level():
+        yield sep + json.dumps(writer.node(s), sort_keys=True)
+        sep = ",\n"
+    yield "\n]}\n"
+
+
+def iter_jsonld(graph, context=None, chunk_size=rdf_stream.DEFAULT_CHUNK_SIZE):
+    """Yields graph as a compacted JSON-LD document, in chunks"""
+    return rdf_stream.rechunk(_pieces(graph, context or smart_context()), chunk_size)
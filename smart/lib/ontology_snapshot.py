@@ -0,0 +1,143 @@
+"""
+Precompiled snapshot of the per-type ontology tables
+
+The triplestore layer needs the filters and default sort order of every
+API call's target type.  Rather than walking SMART_API_Call.store in each
+worker, they're pickled to settings.ONTOLOGY_SNAPSHOT, keyed by the
+sha256 of settings.ONTOLOGY_FILE, and read back with a single
+deserialization.  This only saves the walk: the OWL file itself is still
+parsed at import by record_object and ontology_url_patterns.  The URL
+patterns and RecordObject types aren't in the snapshot, since their views
+and record objects wrap the SMART_Class objects of that parse.
+
+The snapshot is written only by the rebuild_ontology_snapshot command,
+e.g. as a deployment step, so it should live somewhere the server processes
+can't write.  A missing snapshot, or one of a different OWL file (or of an
+older format), is ignored and the tables are built in memory instead.
+"""
+
+import cPickle as pickle
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+# bump whenever the pickled classes below change shape
+FORMAT_VERSION = 1
+
+
+class CallFilter(object):
+    """The parts of an ontology filter FilterSet uses"""
+    def __init__(self, client_parameter_name, filter_sparql):
+        self.client_parameter_name = client_parameter_name
+        self.filter_sparql = filter_sparql
+
+
+class TypeSpec(object):
+    """Filters and default sort of the API calls targeting one type"""
+    def __init__(self, filters=None, default_sort=None):
+        self.filters = filters or []
+        self.default_sort = default_sort
+
+
+def ontology_hash(ontology_file=None):
+    h = hashlib.sha256()
+    f = open(ontology_file or settings.ONTOLOGY_FILE, 'rb')
+    try:
+        for block in iter(lambda: f.read(64 * 1024), ''):
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def snapshot_path():
+    return getattr(settings, 'ONTOLOGY_SNAPSHOT', None) or \
+        settings.ONTOLOGY_FILE + '.snapshot'
+
+
+def build():
+    """Walks the parsed ontology; returns a fresh snapshot"""
+    from smart.common.rdf_tools.rdf_ontology import SMART_API_Call
+
+    types = {}
+    for c in SMART_API_Call.store.values():
+        spec = types.setdefault(unicode(c.target), TypeSpec())
+        # as before, the last call with filters (or a sort) wins
+        if c.filters:
+            spec.filters = [CallFilter(unicode(f.client_parameter_name), f.filter_sparql)
+                            for f in c.filters]
+        if c.default_sort:
+            spec.default_sort = str(c.default_sort)
+
+    return {'version': FORMAT_VERSION,
+            'ontology_hash': ontology_hash(),
+            'types': types}
+
+
+def read(path=None):
+    """The snapshot at path, or None if it's missing, stale or unreadable"""
+    try:
+        f = open(path or snapshot_path(), 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            snapshot = pickle.load(f)
+        except Exception:
+            # truncated, or pickled by an incompatible version of this module
+            return None
+    finally:
+        f.close()
+
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != FORMAT_VERSION or \
+            snapshot.get('ontology_hash') != ontology_hash():
+        return None
+    return snapshot
+
+
+def write(snapshot, path=None):
+    """Atomically replaces the snapshot file, so readers never see half of it"""
+    path = path or snapshot_path()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.ontology-snapshot-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def load():
+    """The current snapshot: read from disk once per process, or built in
+    memory (never saved) if the file is missing or stale"""
+    global _snapshot
+    with _lock:
+        if _snapshot is None:
+            snapshot = read()
+            if snapshot is None:
+                logging.warning("%s is missing or stale; run the "
+                                "rebuild_ontology_snapshot command" % snapshot_path())
+                snapshot = build()
+            _snapshot = snapshot
+        return _snapshot
+
+
+def type_spec(target):
+    """The TypeSpec for target (a type URI), or None if no call targets it"""
+    return load()['types'].get(unicode(target))
@@ -0,0 +1,142 @@
+"""
+Streaming N-Triples / N-Quads serialization
+
+Terms are written in their N-Triples form (plain ASCII, with \\u and \\U
+escapes), which is also valid inside SPARQL INSERT/DELETE DATA blocks.
+Output comes out as a generator of chunks of roughly chunk_size bytes, so
+a graph can be sent to the triplestore without ever holding its whole
+serialization in memory.
+
+splice_rdfxml does the same for RDF/XML read back from the triplestore:
+it passes the document through chunk by chunk, adding a few node elements
+at the end, instead of parsing and re-serializing it.
+"""
+
+import re
+
+from rdflib import URIRef, BNode, Literal
+from rdflib.graph import Graph
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+LITERAL_ESCAPES = {
+    u'\\': u'\\\\',
+    u'"': u'\\"',
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+    u'\t': u'\\t',
+}
+
+# a surrogate pair (narrow python builds) or any character that needs escaping
+LITERAL_UNSAFE = re.compile(u'[\ud800-\udbff][\udc00-\udfff]|[^\\x20\\x21\\x23-\\x5b\\x5d-\\x7e]')
+IRI_UNSAFE = re.compile(u'[\ud800-\udbff][\udc00-\udfff]|[^\\x21-\\x7e]')
+
+# end of an RDF/XML document's root element, whatever its prefix: either
+# its closing tag or, for an empty document, a self-closing start tag
+RDFXML_ROOT_END = re.compile(r'</(?:[A-Za-z_][\w.-]*:)?RDF\s*>\s*$')
+RDFXML_EMPTY_ROOT = re.compile(r'<((?:[A-Za-z_][\w.-]*:)?RDF)\b[^>]*?(/>)\s*$')
+
+# bytes held back while splicing; more than any root end tag needs
+SPLICE_TAIL = 4096
+
+
+def _escape_char(m):
+    c = m.group(0)
+    if c in LITERAL_ESCAPES:
+        return LITERAL_ESCAPES[c]
+
+    if len(c) == 2:
+        codepoint = 0x10000 + ((ord(c[0]) - 0xd800) << 10) + (ord(c[1]) - 0xdc00)
+    else:
+        codepoint = ord(c)
+
+    if codepoint > 0xffff:
+        return u'\\U%08X' % codepoint
+    return u'\\u%04X' % codepoint
+
+
+def _iri(s):
+    return '<%s>' % IRI_UNSAFE.sub(_escape_char, unicode(s)).encode('ascii')
+
+
+def nt_term(node):
+    """The N-Triples form of an rdflib term, as an ASCII str"""
+    if isinstance(node, Graph):
+        node = node.identifier
+
+    if isinstance(node, URIRef):
+        return _iri(node)
+    elif isinstance(node, BNode):
+        return '_:%s' % node.encode('ascii')
+    elif isinstance(node, Literal):
+        ret = '"%s"' % LITERAL_UNSAFE.sub(_escape_char, unicode(node)).encode('ascii')
+        if node.language:
+            return '%s@%s' % (ret, node.language)
+        if node.datatype:
+            return '%s^^%s' % (ret, _iri(node.datatype))
+        return ret
+
+    raise Exception("Unknown node type for %s" % node)
+
+
+def nt_line(triple):
+    return "%s %s %s .\n" % tuple(map(nt_term, triple))
+
+
+def nq_line(triple, context):
+    if not isinstance(context, URIRef):
+        # anything but a named graph goes to the default graph
+        return nt_line(triple)
+    return "%s %s %s %s .\n" % tuple(map(nt_term, tuple(triple) + (context,)))
+
+
+def rechunk(pieces, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Joins small string pieces into chunks of at least chunk_size bytes"""
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+def iter_ntriples(triples, chunk_size=DEFAULT_CHUNK_SIZE):
+    return rechunk((nt_line(t) for t in triples), chunk_size)
+
+
+def iter_nquads(cg, chunk_size=DEFAULT_CHUNK_SIZE):
+    return rechunk((nq_line(t, g.identifier) for g in cg.contexts() for t in g), chunk_size)
+
+
+def splice_rdfxml(chunks, fragment):
+    """Yields the RDF/XML document in chunks with fragment (one or more node
+    elements, carrying their own namespace declarations) added at the end
+    of its root element.  Only the last SPLICE_TAIL bytes are held back.
+    """
+    held = ""
+    try:
+        for chunk in chunks:
+            held += chunk
+            if len(held) > SPLICE_TAIL:
+                yield held[:-SPLICE_TAIL]
+                held = held[-SPLICE_TAIL:]
+    finally:
+        # let a pooled response go back to its pool even if we're cut short
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+    m = RDFXML_ROOT_END.search(held)
+    if m:
+        yield held[:m.start()] + fragment + held[m.start():]
+        return
+
+    m = RDFXML_EMPTY_ROOT.search(held)
+    if m:
+        yield held[:m.start(2)] + ">" + fragment + "</%s>" % m.group(1) + held[m.end(2):]
+        return
+
+    raise ValueError("Not an RDF/XML document: no end of the rdf:RDF element")
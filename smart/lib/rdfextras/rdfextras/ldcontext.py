@@ -32,6 +32,10 @@ REV_KEY = '@rev' # EXPERIMENTAL
 
 KEYS = set([LANG_KEY, ID_KEY, TYPE_KEY, LITERAL_KEY, LIST_KEY, REV_KEY])
 
+# shrink() and expand() results remembered per context; node IRIs go
+# through them too, so each memo is dropped whenever it grows past this
+SHRINK_MEMO_SIZE = 10000
+
 
 class Context(object):
 
@@ -39,6 +43,8 @@ class Context(object):
         self._key_map = {}
         self._iri_map = {}
         self._term_map = {}
+        self._shrunk = {} # iri -> shrink(iri), reset whenever a term is added
+        self._expanded = {} # term, curie or iri -> expand(it), likewise
         self.lang = None
         if source:
             self.load(source)
@@ -106,18 +112,37 @@ class Context(object):
     def add_term(self, term):
         self._iri_map[term.iri] = term
         self._term_map[term.key] = term
+        self._shrunk.clear()
+        self._expanded.clear()
 
     def get_term(self, iri):
         return self._iri_map.get(iri)
 
     def shrink(self, iri):
         iri = unicode(iri)
+        try:
+            return self._shrunk[iri]
+        except KeyError:
+            pass
+        if len(self._shrunk) >= SHRINK_MEMO_SIZE:
+            self._shrunk.clear()
+        ret = self._shrunk[iri] = self._shrink(iri)
+        return ret
+
+    def _shrink(self, iri):
         term = self._iri_map.get(iri)
         if term:
             return term.key
         if iri == RDF_TYPE:
             # NOTE: only if no term for the rdf:type IRI is defined
             return self.type_key
+        # prefix terms are looked up by namespace IRI, cut at each '#' or '/'
+        for sep in u'#/':
+            i = iri.rfind(sep)
+            if i >= 0:
+                term = self._iri_map.get(iri[:i + 1])
+                if term and iri[i + 1:]:
+                    return ":".join((term.key, iri[i + 1:]))
         try:
             ns, name = split_uri(iri)
             term = self._iri_map.get(ns)
@@ -129,6 +154,16 @@ class Context(object):
 
     def expand(self, term_curie_or_iri):
         term_curie_or_iri = unicode(term_curie_or_iri)
+        try:
+            return self._expanded[term_curie_or_iri]
+        except KeyError:
+            pass
+        if len(self._expanded) >= SHRINK_MEMO_SIZE:
+            self._expanded.clear()
+        ret = self._expanded[term_curie_or_iri] = self._expand(term_curie_or_iri)
+        return ret
+
+    def _expand(self, term_curie_or_iri):
         if ':' in term_curie_or_iri:
             pfx, term = term_curie_or_iri.split(':', 1)
             ns = self._term_map.get(pfx)
@@ -150,7 +185,7 @@ class Context(object):
         for term in self.terms:
             obj = term.iri
             if term.coercion:
-                obj = {IRI_KEY: term.iri}
+                obj = {ID_KEY: term.iri}
                 if term.coercion == REV_KEY:
                     obj = {REV_KEY: term.iri}
                 else:
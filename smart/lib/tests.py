@@ -0,0 +1,591 @@
+"""
+Tests for smart.lib: triplestore connection pooling, streaming RDF
+serialization, RDF content negotiation, the ontology snapshot and JSON-LD
+contexts
+"""
+
+import httplib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+from django.conf import settings
+from django.http import Http404
+from django.test.client import RequestFactory
+
+from rdflib import BNode, ConjunctiveGraph, Graph, Literal, URIRef
+
+from smart.common.rdf_tools.util import sp
+from connection_pool import ConnectionPool
+import jsonld
+import ontology_snapshot
+import rdf_stream
+from utils import rdf_format, _accepted_ranges
+
+# the vendored rdfextras isn't a package of its own (see wiki_apidocs)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rdfextras"))
+from rdfextras import ldcontext
+
+
+class FakeResponse(object):
+    status = 200
+    will_close = False
+
+
+class FakeConnection(object):
+    """Stands in for an httplib connection; fails on send or on the
+    response when asked to, like a socket the server has closed"""
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.sent = []
+        self.closed = False
+        self.sock = None
+
+    def _send(self, data):
+        if self.fail == "send":
+            raise socket.error(32, "Broken pipe")
+        self.sent.append(data)
+
+    def request(self, method, path, body, headers):
+        self._send((method, path, body))
+
+    def putrequest(self, method, path, skip_accept_encoding=False):
+        self.request_line = (method, path)
+
+    def putheader(self, k, v):
+        pass
+
+    def endheaders(self):
+        self._send(self.request_line)
+
+    def send(self, data):
+        self._send(data)
+
+    def getresponse(self):
+        if self.fail == "response":
+            raise httplib.BadStatusLine("")
+        return FakeResponse()
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+    """A pool whose new connections come from a list"""
+    def __init__(self, *connections, **kwargs):
+        ConnectionPool.__init__(self, "http", "localhost:8080", **kwargs)
+        self.fresh = list(connections)
+
+    def _new_connection(self):
+        return self.fresh.pop(0)
+
+
+def pool_with_idle(stale, *fresh):
+    pool = FakePool(*fresh)
+    pool.release(stale)
+    return pool
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def test_reuses_released_connections(self):
+        c = FakeConnection()
+        pool = pool_with_idle(c)
+        r, conn = pool.request("GET", "/", None)
+        self.assertTrue(conn is c)
+        self.assertEqual(pool.stats['hits'], 1)
+
+    def test_stale_idempotent_request_is_retried(self):
+        stale, fresh = FakeConnection("response"), FakeConnection()
+        pool = pool_with_idle(stale, fresh)
+        r, conn = pool.request("GET", "/q", None)
+        self.assertTrue(conn is fresh)
+        self.assertTrue(stale.closed)
+        self.assertEqual(fresh.sent, [("GET", "/q", None)])
+        self.assertEqual(pool.stats['retries'], 1)
+
+    def test_stale_post_is_not_sent_twice(self):
+        stale, fresh = FakeConnection("response"), FakeConnection()
+        pool = pool_with_idle(stale, fresh)
+        self.assertRaises(httplib.BadStatusLine,
+                          pool.request, "POST", "/statements", "update=x")
+        self.assertTrue(stale.closed)
+        self.assertEqual(fresh.sent, [])
+        self.assertEqual(pool.stats['retries'], 0)
+
+    def test_stale_post_is_retried_if_nothing_was_written(self):
+        stale, fresh = FakeConnection("send"), FakeConnection()
+        pool = pool_with_idle(stale, fresh)
+        r, conn = pool.request("POST", "/statements", "update=x")
+        self.assertEqual(fresh.sent, [("POST", "/statements", "update=x")])
+
+    def test_post_marked_idempotent_is_retried(self):
+        stale, fresh = FakeConnection("response"), FakeConnection()
+        pool = pool_with_idle(stale, fresh)
+        r, conn = pool.request("POST", "/query", "query=x", idempotent=True)
+        self.assertTrue(conn is fresh)
+
+    def test_streamed_body_is_produced_again_on_retry(self):
+        stale, fresh = FakeConnection("response"), FakeConnection()
+        pool = pool_with_idle(stale, fresh)
+        calls = []
+        def body():
+            calls.append(True)
+            yield "abc"
+        pool.request("PUT", "/statements", body)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(fresh.sent, [("PUT", "/statements"), "3\r\nabc\r\n", "0\r\n\r\n"])
+
+    def test_new_connection_failure_is_not_retried(self):
+        pool = FakePool(FakeConnection("response"), FakeConnection())
+        self.assertRaises(httplib.BadStatusLine, pool.request, "GET", "/", None)
+        self.assertEqual(len(pool.fresh), 1)
+
+    def test_failed_retry_discards_the_new_connection(self):
+        fresh = FakeConnection("response")
+        pool = pool_with_idle(FakeConnection("response"), fresh)
+        self.assertRaises(httplib.BadStatusLine, pool.request, "GET", "/", None)
+        self.assertTrue(fresh.closed)
+        self.assertEqual(pool.idle, [])
+
+    def test_discard_closes(self):
+        pool = FakePool()
+        c = FakeConnection()
+        pool.discard(c)
+        self.assertTrue(c.closed)
+        self.assertEqual(pool.idle, [])
+
+    def test_release_past_max_size_closes(self):
+        pool = FakePool(max_size=1)
+        a, b = FakeConnection(), FakeConnection()
+        pool.release(a)
+        pool.release(b)
+        self.assertFalse(a.closed)
+        self.assertTrue(b.closed)
+
+    def test_idle_connections_time_out(self):
+        pool = FakePool(FakeConnection(), idle_timeout=-1)
+        old = FakeConnection()
+        pool.release(old)
+        r, conn = pool.request("GET", "/", None)
+        self.assertTrue(old.closed)
+        self.assertFalse(conn is old)
+
+    def test_connection_closed_by_the_server_is_not_reused(self):
+        ours, theirs = socket.socketpair()
+        try:
+            dropped, fresh = FakeConnection(), FakeConnection()
+            dropped.sock = ours
+            pool = pool_with_idle(dropped, fresh)
+            theirs.close()
+            r, conn = pool.request("POST", "/statements", "update=x")
+            self.assertTrue(conn is fresh)
+            self.assertTrue(dropped.closed)
+            self.assertEqual(pool.stats['retries'], 0)
+        finally:
+            ours.close()
+
+
+class FakeRequest(object):
+    def __init__(self, accept=None):
+        self.META = {}
+        if accept is not None:
+            self.META['HTTP_ACCEPT'] = accept
+
+
+def negotiated(accept):
+    return rdf_format(FakeRequest(accept))
+
+
+class ContentNegotiationTests(unittest.TestCase):
+    def test_rdf_xml_by_default(self):
+        self.assertEqual(negotiated(None), ("application/rdf+xml", "xml"))
+        self.assertEqual(negotiated(""), ("application/rdf+xml", "xml"))
+        self.assertEqual(negotiated("*/*"), ("application/rdf+xml", "xml"))
+
+    def test_browsers_get_rdf_xml(self):
+        self.assertEqual(
+            negotiated("text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"),
+            ("application/rdf+xml", "xml"))
+
+    def test_jquery_text_requests_get_rdf_xml(self):
+        self.assertEqual(negotiated("text/plain, */*; q=0.01"),
+                         ("application/rdf+xml", "xml"))
+
+    def test_each_format(self):
+        self.assertEqual(negotiated("application/rdf+xml"), ("application/rdf+xml", "xml"))
+        self.assertEqual(negotiated("text/turtle"), ("text/turtle", "turtle"))
+        self.assertEqual(negotiated("application/x-turtle"), ("application/x-turtle", "turtle"))
+        self.assertEqual(negotiated("application/n-triples"), ("application/n-triples", "nt"))
+        self.assertEqual(negotiated("application/ld+json"), ("application/ld+json", "json-ld"))
+
+    def test_json_ld_as_application_json_is_opt_in(self):
+        # what jQuery sends for $.getJSON
+        self.assertEqual(negotiated("application/json, text/javascript, */*; q=0.01"),
+                         ("application/rdf+xml", "xml"))
+        self.assertEqual(negotiated("application/json"), ("application/rdf+xml", "xml"))
+        self.assertEqual(negotiated('application/json; profile="http://www.w3.org/ns/json-ld"'),
+                         ("application/json", "json-ld"))
+        self.assertEqual(
+            negotiated('application/json;profile="http://www.w3.org/ns/json-ld#compacted";q=0.5,'
+                       ' text/turtle;q=0.4'),
+            ("application/json", "json-ld"))
+        self.assertEqual(
+            negotiated('application/json;profile="http://www.w3.org/ns/json-ld";q=0.5,'
+                       ' application/ld+json'),
+            ("application/ld+json", "json-ld"))
+
+    def test_highest_q_wins(self):
+        self.assertEqual(negotiated("text/turtle;q=0.5, application/ld+json"),
+                         ("application/ld+json", "json-ld"))
+        self.assertEqual(negotiated("application/rdf+xml;q=0.2, application/n-triples;q=0.3"),
+                         ("application/n-triples", "nt"))
+
+    def test_most_specific_range_decides(self):
+        # text/* would accept turtle, but text/turtle;q=0 turns it down
+        self.assertEqual(negotiated("text/*, text/turtle;q=0, application/n-triples;q=0.5"),
+                         ("application/n-triples", "nt"))
+        self.assertEqual(negotiated("application/*;q=0.5, application/rdf+xml;q=0.1"),
+                         ("application/ld+json", "json-ld"))
+
+    def test_media_ranges_are_case_insensitive(self):
+        self.assertEqual(negotiated("Text/Turtle"), ("text/turtle", "turtle"))
+
+    def test_bad_q_refuses_the_range(self):
+        self.assertEqual(negotiated("text/turtle;q=high"), ("application/rdf+xml", "xml"))
+
+    def test_accepted_ranges(self):
+        self.assertEqual(_accepted_ranges("text/turtle; charset=utf-8; q=0.5, , */*"),
+                         [("text/turtle", 0.5, None), ("*/*", 1.0, None)])
+        self.assertEqual(_accepted_ranges('application/json; profile="http://x"'),
+                         [("application/json", 1.0, "http://x")])
+
+
+S = URIRef("http://localhost:7000/records/123/medications/1")
+P = URIRef("http://purl.org/dc/terms/title")
+XSD_DATE = URIRef("http://www.w3.org/2001/XMLSchema#date")
+
+
+class NTriplesTests(unittest.TestCase):
+    def test_terms(self):
+        self.assertEqual(rdf_stream.nt_term(S), "<%s>" % S)
+        self.assertEqual(rdf_stream.nt_term(BNode("b1")), "_:b1")
+        self.assertEqual(rdf_stream.nt_term(Literal("x")), '"x"')
+        self.assertEqual(rdf_stream.nt_term(Literal("x", lang="en")), '"x"@en')
+        self.assertEqual(rdf_stream.nt_term(Literal("2010", datatype=XSD_DATE)),
+                         '"2010"^^<%s>' % XSD_DATE)
+        self.assertEqual(rdf_stream.nt_term(Graph(identifier=S)), "<%s>" % S)
+
+    def test_literal_escapes(self):
+        self.assertEqual(rdf_stream.nt_term(Literal(u'a "b"\\\n\t\r')),
+                         '"a \\"b\\"\\\\\\n\\t\\r"')
+        self.assertEqual(rdf_stream.nt_term(Literal(u"caf\xe9")), '"caf\\u00E9"')
+        self.assertEqual(rdf_stream.nt_term(Literal(u"\U0001d11e")), '"\\U0001D11E"')
+
+    def test_iri_escapes(self):
+        self.assertEqual(rdf_stream.nt_term(URIRef(u"http://x/caf\xe9 y")),
+                         "<http://x/caf\\u00E9\\u0020y>")
+
+    def test_output_is_ascii_str(self):
+        line = rdf_stream.nt_line((S, P, Literal(u"caf\xe9")))
+        self.assertTrue(isinstance(line, str))
+        self.assertEqual(line, '<%s> <%s> "caf\\u00E9" .\n' % (S, P))
+
+    def test_round_trip(self):
+        g = Graph()
+        g.add((S, P, Literal(u'tab\there "quoted" caf\xe9', lang="fr")))
+        g.add((S, P, Literal("2010-05-02", datatype=XSD_DATE)))
+        parsed = Graph()
+        parsed.parse(data="".join(rdf_stream.iter_ntriples(g)), format="nt")
+        self.assertEqual(set(parsed), set(g))
+
+    def test_nquads(self):
+        cg = ConjunctiveGraph()
+        cg.get_context(S).add((S, P, Literal("x")))
+        self.assertEqual("".join(rdf_stream.iter_nquads(cg)),
+                         '<%s> <%s> "x" <%s> .\n' % (S, P, S))
+        # anything but a named graph goes to the default graph
+        self.assertEqual(rdf_stream.nq_line((S, P, Literal("x")), BNode()),
+                         '<%s> <%s> "x" .\n' % (S, P))
+
+    def test_rechunk(self):
+        self.assertEqual(list(rdf_stream.rechunk(["ab", "c", "de", "f"], 3)),
+                         ["abc", "def"])
+        self.assertEqual(list(rdf_stream.rechunk(["ab", "c", "d"], 3)), ["abc", "d"])
+        self.assertEqual(list(rdf_stream.rechunk([], 3)), [])
+
+
+FRAGMENT = ('<rdf:Description xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+            'rdf:about="%s"><title xmlns="http://purl.org/dc/terms/">summary</title>'
+            '</rdf:Description>' % S)
+
+
+class Chunks(object):
+    """An iterable of chunks that remembers how far it was read and
+    whether it was closed, like a pooled triplestore response"""
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        while self.read < len(self.data):
+            self.read += self.size
+            yield self.data[self.read - self.size:self.read]
+
+    def close(self):
+        self.closed = True
+
+
+def spliced(data, size):
+    return "".join(rdf_stream.splice_rdfxml(Chunks(data, size), FRAGMENT))
+
+
+class SpliceRDFXMLTests(unittest.TestCase):
+    def setUp(self):
+        self.g = Graph()
+        self.g.add((S, P, Literal("medication")))
+        self.expected = set(self.g) | set([(S, P, Literal("summary"))])
+
+    def parsed(self, data):
+        g = Graph()
+        g.parse(data=data, format="xml")
+        return set(g)
+
+    def test_fragment_is_added_to_the_root(self):
+        data = self.g.serialize(format="xml")
+        for size in (1, 7, len(data), 100000):
+            self.assertEqual(self.parsed(spliced(data, size)), self.expected)
+
+    def test_empty_graph(self):
+        data = Graph().serialize(format="xml")
+        self.assertEqual(self.parsed(spliced(data, 5)), set([(S, P, Literal("summary"))]))
+
+    def test_prefixed_and_unprefixed_roots(self):
+        rdf_ns = 'xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+        for data in ['<RDF %s></RDF>\n' % rdf_ns, '<RDF %s/>' % rdf_ns,
+                     '<r:RDF xmlns:r="http://www.w3.org/1999/02/22-rdf-syntax-ns#" >\n</r:RDF >  ']:
+            self.assertEqual(self.parsed(spliced(data, 3)), set([(S, P, Literal("summary"))]))
+
+    def test_streams_large_documents(self):
+        for i in range(1000):
+            self.g.add((URIRef("%s/%d" % (S, i)), P, Literal("x" * 50)))
+            self.expected.add((URIRef("%s/%d" % (S, i)), P, Literal("x" * 50)))
+        data = self.g.serialize(format="xml")
+        chunks = Chunks(data, 1024)
+        spliced = rdf_stream.splice_rdfxml(chunks, FRAGMENT)
+
+        first = spliced.next()
+        # passed on before the whole document was read
+        self.assertTrue(chunks.read < len(data))
+        self.assertTrue(len(first) <= chunks.read)
+        self.assertEqual(self.parsed(first + "".join(spliced)), self.expected)
+        self.assertTrue(chunks.closed)
+
+    def test_closes_the_chunks_when_cut_short(self):
+        chunks = Chunks("<rdf:RDF>" + " " * (3 * rdf_stream.SPLICE_TAIL), 1024)
+        spliced = rdf_stream.splice_rdfxml(chunks, FRAGMENT)
+        spliced.next()
+        spliced.close()
+        self.assertTrue(chunks.closed)
+
+    def test_not_rdf_xml(self):
+        for data in ["", "<html></html>", "<rdf:RDF>"]:
+            self.assertRaises(ValueError, spliced, data, 4)
+
+
+class OntologySnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = settings.ONTOLOGY_FILE, settings.ONTOLOGY_SNAPSHOT
+        settings.ONTOLOGY_FILE = os.path.join(self.dir, "smart.owl")
+        settings.ONTOLOGY_SNAPSHOT = os.path.join(self.dir, "smart.owl.snapshot")
+        self.write_ontology("<rdf:RDF/>")
+
+        self.saved_build = ontology_snapshot.build
+        self.built = []
+        ontology_snapshot.build = self.build
+        ontology_snapshot._snapshot = None
+
+    def tearDown(self):
+        settings.ONTOLOGY_FILE, settings.ONTOLOGY_SNAPSHOT = self.saved
+        ontology_snapshot.build = self.saved_build
+        ontology_snapshot._snapshot = None
+        shutil.rmtree(self.dir)
+
+    def write_ontology(self, data):
+        open(settings.ONTOLOGY_FILE, "w").write(data)
+
+    def build(self):
+        spec = ontology_snapshot.TypeSpec(
+            [ontology_snapshot.CallFilter("date_from", "?date >= $date_from")], "?date")
+        self.built.append(True)
+        return {'version': ontology_snapshot.FORMAT_VERSION,
+                'ontology_hash': ontology_snapshot.ontology_hash(),
+                'types': {unicode(S): spec}}
+
+    def test_round_trip(self):
+        ontology_snapshot.write(self.build())
+        snapshot = ontology_snapshot.read()
+        [spec] = snapshot['types'].values()
+        self.assertEqual(spec.default_sort, "?date")
+        self.assertEqual(spec.filters[0].client_parameter_name, "date_from")
+
+    def test_changed_ontology_makes_it_stale(self):
+        ontology_snapshot.write(self.build())
+        self.write_ontology("<rdf:RDF></rdf:RDF>")
+        self.assertEqual(ontology_snapshot.read(), None)
+
+    def test_other_format_version_is_stale(self):
+        snapshot = self.build()
+        snapshot['version'] = ontology_snapshot.FORMAT_VERSION - 1
+        ontology_snapshot.write(snapshot)
+        self.assertEqual(ontology_snapshot.read(), None)
+
+    def test_missing_or_corrupt(self):
+        self.assertEqual(ontology_snapshot.read(), None)
+        open(settings.ONTOLOGY_SNAPSHOT, "w").write("not a pickle")
+        self.assertEqual(ontology_snapshot.read(), None)
+
+    def test_load_reads_a_current_snapshot(self):
+        ontology_snapshot.write(self.build())
+        del self.built[:]
+        self.assertTrue(ontology_snapshot.type_spec(S))
+        self.assertEqual(ontology_snapshot.type_spec(P), None)
+        self.assertEqual(self.built, [])
+
+    def test_stale_snapshot_is_rebuilt_in_memory(self):
+        ontology_snapshot.write(self.build())
+        self.write_ontology("<rdf:RDF></rdf:RDF>")
+        before = open(settings.ONTOLOGY_SNAPSHOT, "rb").read()
+        del self.built[:]
+
+        self.assertTrue(ontology_snapshot.type_spec(S))
+        self.assertEqual(self.built, [True])
+        # only the rebuild command writes the file
+        self.assertEqual(open(settings.ONTOLOGY_SNAPSHOT, "rb").read(), before)
+        # and the rebuilt tables are kept for the rest of the process
+        ontology_snapshot.type_spec(S)
+        self.assertEqual(self.built, [True])
+
+
+LD_SOURCE = {
+    "@context": {
+        "sp": "http://smartplatforms.org/terms#",
+        "dcterms": "http://purl.org/dc/terms/",
+        "xsd": "http://www.w3.org/2001/XMLSchema#",
+        "title": "http://purl.org/dc/terms/title",
+        "date": {"@id": "dcterms:date", "@type": "xsd:date"},
+        "drugName": {"@id": "sp:drugName", "@type": "@id"},
+    }
+}
+
+
+class LDContextTests(unittest.TestCase):
+    def test_to_dict_writes_coerced_terms(self):
+        data = ldcontext.Context(LD_SOURCE).to_dict()
+        self.assertEqual(data["date"], {"@id": "http://purl.org/dc/terms/date",
+                                        "@type": "http://www.w3.org/2001/XMLSchema#date"})
+        self.assertEqual(data["drugName"], {"@id": "http://smartplatforms.org/terms#drugName",
+                                            "@type": "@id"})
+        self.assertEqual(data["title"], "http://purl.org/dc/terms/title")
+
+    IRIS = [u"http://purl.org/dc/terms/title", u"http://purl.org/dc/terms/date",
+            u"http://smartplatforms.org/terms#drugName", u"http://smartplatforms.org/terms#code",
+            u"http://smartplatforms.org/terms#", u"http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
+            u"http://localhost:7000/records/123/medications/1", u"urn:x"]
+
+    def test_shrink_memo_matches_shrinking_afresh(self):
+        context = ldcontext.Context(LD_SOURCE)
+        for i in range(2):
+            for iri in self.IRIS:
+                self.assertEqual(context.shrink(iri), context._shrink(iri))
+        self.assertEqual(context.shrink(self.IRIS[0]), "title")
+        self.assertEqual(context.shrink(self.IRIS[3]), "sp:code")
+        self.assertEqual(len(context._shrunk), len(self.IRIS))
+
+    def test_expand_memo_matches_expanding_afresh(self):
+        context = ldcontext.Context(LD_SOURCE)
+        for i in range(2):
+            for value in ["title", "sp:code", "dcterms:title", "nope:x", "nope"] + self.IRIS:
+                self.assertEqual(context.expand(value), context._expand(value))
+        self.assertEqual(context.expand("sp:code"), self.IRIS[3])
+        self.assertEqual(context.expand("drugName"), self.IRIS[2])
+
+    def test_memos_are_reset_when_a_term_is_added(self):
+        context = ldcontext.Context(LD_SOURCE)
+        self.assertEqual(context.shrink(self.IRIS[3]), "sp:code")
+        self.assertEqual(context.expand("code"), "code")
+        context.add_term(ldcontext.Term(self.IRIS[3], "code"))
+        self.assertEqual(context.shrink(self.IRIS[3]), "code")
+        self.assertEqual(context.expand("code"), self.IRIS[3])
+
+    def test_memos_are_bounded(self):
+        saved, ldcontext.SHRINK_MEMO_SIZE = ldcontext.SHRINK_MEMO_SIZE, 3
+        try:
+            context = ldcontext.Context(LD_SOURCE)
+            for iri in self.IRIS:
+                self.assertEqual(context.shrink(iri), context._shrink(iri))
+                self.assertEqual(context.expand(iri), iri)
+            self.assertTrue(len(context._shrunk) <= 3)
+            self.assertTrue(len(context._expanded) <= 3)
+        finally:
+            ldcontext.SHRINK_MEMO_SIZE = saved
+
+
+class JSONLDContextTests(unittest.TestCase):
+    def setUp(self):
+        self.context = jsonld.Context(
+            {"sp": "http://smartplatforms.org/terms#", "dcterms": "http://purl.org/dc/terms/"},
+            {"drugName": "http://smartplatforms.org/terms#drugName"})
+
+    def test_shrink_and_expand(self):
+        for iri, short in [(u"http://smartplatforms.org/terms#drugName", u"drugName"),
+                           (u"http://smartplatforms.org/terms#code", u"sp:code"),
+                           (u"http://purl.org/dc/terms/title", u"dcterms:title"),
+                           (u"http://localhost:7000/records/123", u"http://localhost:7000/records/123")]:
+            self.assertEqual(self.context.shrink(iri), short)
+            self.assertEqual(self.context.expand(short), iri)
+
+    def test_expand_leaves_unknown_values(self):
+        for value in [u"title", u"nope:x", u"urn:x", u"_:b1", u"sp://host/x"]:
+            self.assertEqual(self.context.expand(value), value)
+
+
+class JSONLDContextViewTests(unittest.TestCase):
+    def setUp(self):
+        from smart.views.smarthacks import jsonld_context
+        self.view = jsonld_context
+        self.factory = RequestFactory()
+
+    def get(self, type_name=None, **headers):
+        return self.view(self.factory.get("/jsonld/context", **headers), type_name)
+
+    def test_type_context(self):
+        r = self.get("Medication")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "application/ld+json")
+        self.assertEqual(r["Cache-Control"], "public, max-age=%d" % (24 * 60 * 60))
+        body, etag = jsonld.type_context(sp.Medication).document()
+        self.assertEqual((r.content, r["ETag"]), (body, etag))
+
+    def test_not_modified(self):
+        etag = self.get("Medication")["ETag"]
+        r = self.get("Medication", HTTP_IF_NONE_MATCH='"other", %s' % etag)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, "")
+        self.assertEqual(r["ETag"], etag)
+
+        r = self.get("Medication", HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["ETag"], etag)
+
+    def test_prefixes_only(self):
+        r = self.get()
+        self.assertEqual((r.content, r["ETag"]), jsonld.smart_context().document())
+
+    def test_unknown_type(self):
+        self.assertRaises(Http404, self.get, "NoSuchType")
@@ -17,6 +17,8 @@ except:
   from django.core.validators import email_re
 from smart.common.rdf_tools.util import parse_rdf, serialize_rdf, bound_graph
 from smart.common.rdf_tools import rdf_ontology
+from smart.lib import connection_pool, jsonld, rdf_stream
+from rdflib import Graph
 import django.core.mail as mail
 import logging
 import string, random, re
@@ -165,39 +167,264 @@ def url_request(url,  method, headers, data=None):
 def url_request_build(url,  method, headers, data=None):
   return HTTPRequest(method, url, HTTPRequest.FORM_URLENCODED_TYPE, data, headers)
 
-def url_request_execute(req):
+def _split_request_url(req):
     (scheme, url) = req.path.split("://")
     domain = url.split("/")[0]
     path = "/"+"/".join(url.split("/")[1:])
-    conn = None
-    
-    if (scheme == "http") :        
-        conn = httplib.HTTPConnection(domain)
-    elif (scheme == "https"):
-        conn = httplib.HTTPSConnection(domain)
 
     data = req.data
     if (req.method == "GET"):
         path += "?%s"%data
         data = None
 
-    # print "URL_REQUEST:", domain, req.method, path, urllib.unquote_plus(data), req.headers
-    conn.request(req.method, path, data, req.headers)
-    r = conn.getresponse()
+    return scheme, domain, path, data
 
+def _read_response(r):
     if (r.status == 200):
-        data = r.read()
-        conn.close()
-        return data
+        return r.read()
     elif (r.status == 204):
-        conn.close()
+        r.read()
         return True
     else:
-        data = r.read()
-        raise URLFetchException(r.status, data)
+        raise URLFetchException(r.status, r.read())
 
-def rdf_response(s):
-    return x_domain(HttpResponse(s, mimetype="application/rdf+xml"))
+def url_request_execute(req):
+    (scheme, domain, path, data) = _split_request_url(req)
+    conn = None
+    
+    if (scheme == "http") :        
+        conn = httplib.HTTPConnection(domain)
+    elif (scheme == "https"):
+        conn = httplib.HTTPSConnection(domain)
+
+    # print "URL_REQUEST:", domain, req.method, path, urllib.unquote_plus(data), req.headers
+    try:
+        conn.request(req.method, path, data, req.headers)
+        return _read_response(conn.getresponse())
+    finally:
+        conn.close()
+
+def pooled_url_request(url, method, headers, data=None, idempotent=None):
+    """Like url_request, but reuses keep-alive connections to the host.
+
+    idempotent says whether the request may be sent again when a reused
+    connection fails (by default, when the method is idempotent).
+    """
+    req = url_request_build(url, method, headers, data)
+    (scheme, domain, path, data) = _split_request_url(req)
+    return _pooled_execute(scheme, domain, req.method, path, data, req.headers, idempotent)
+
+def pooled_url_stream(url, method, headers, chunks):
+    """Sends the body produced by chunks() with chunked transfer-encoding.
+
+    chunks may be called more than once (when a stale connection has to
+    be retried) and must yield the same body every time.
+    """
+    (scheme, url) = url.split("://")
+    domain = url.split("/")[0]
+    path = "/"+"/".join(url.split("/")[1:])
+    return _pooled_execute(scheme, domain, method, path, chunks, headers)
+
+def _pooled_execute(scheme, domain, method, path, data, headers, idempotent=None):
+    pool = connection_pool.get_pool(scheme, domain)
+
+    r, conn = pool.request(method, path, data, headers, idempotent)
+    reusable = False
+    try:
+        ret = _read_response(r)
+        reusable = not r.will_close
+        return ret
+    except URLFetchException:
+        # the error body has been read, so the socket is still usable
+        reusable = not r.will_close
+        raise
+    finally:
+        if reusable:
+            pool.release(conn)
+        else:
+            pool.discard(conn)
+
+class PooledResponseBody(object):
+    """Iterator over a pooled response's body, read chunk_size bytes at a time.
+
+    The connection goes back to the pool once the body has been read to
+    the end; it's closed instead if the iterator is close()d early (django
+    closes a response's content when the client goes away).
+    """
+    def __init__(self, pool, conn, response, chunk_size):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.conn is None:
+            raise StopIteration
+        try:
+            chunk = self.response.read(self.chunk_size)
+        except:
+            self._finish(False)
+            raise
+        if not chunk:
+            self._finish(not self.response.will_close)
+            raise StopIteration
+        return chunk
+
+    def _finish(self, reusable):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if reusable:
+            self.pool.release(conn)
+        else:
+            self.pool.discard(conn)
+
+    def close(self):
+        self._finish(False)
+
+def pooled_url_iter(url, method, headers, data=None, chunk_size=64 * 1024, idempotent=None):
+    """Like pooled_url_request, but returns an iterator over the response body.
+
+    The request is sent and its status checked straight away, so errors
+    are raised here rather than halfway through the iteration.
+    """
+    req = url_request_build(url, method, headers, data)
+    (scheme, domain, path, data) = _split_request_url(req)
+    pool = connection_pool.get_pool(scheme, domain)
+
+    r, conn = pool.request(req.method, path, data, req.headers, idempotent)
+    if r.status == 200:
+        return PooledResponseBody(pool, conn, r, chunk_size)
+
+    # no content, or an error: read it all, as _pooled_execute does
+    reusable = False
+    try:
+        _read_response(r)
+        reusable = not r.will_close
+        return iter(())
+    except URLFetchException:
+        reusable = not r.will_close
+        raise
+    finally:
+        if reusable:
+            pool.release(conn)
+        else:
+            pool.discard(conn)
+
+# (mimetype, serialization) pairs offered to clients; on a tie in the
+# Accept header the earlier one wins, so RDF/XML stays the default.
+# N-Triples isn't offered as text/plain: jQuery sends "text/plain, */*"
+# for plain-text requests, which would then quietly get N-Triples.
+RDF_FORMATS = [
+    ("application/rdf+xml", "xml"),
+    ("application/ld+json", "json-ld"),
+    ("text/turtle", "turtle"),
+    ("application/x-turtle", "turtle"),
+    ("application/n-triples", "nt"),
+]
+
+# Nor is JSON-LD sent to a bare application/json: that's what jQuery asks
+# for when it expects plain JSON.  A client opts in by naming the JSON-LD
+# profile, as in 'application/json; profile="http://www.w3.org/ns/json-ld"'.
+JSON_LD_PROFILE = "http://www.w3.org/ns/json-ld"
+
+def _accepted_ranges(accept):
+    """(media range, q, profile) triples of an Accept header"""
+    ret = []
+    for part in accept.split(","):
+        params = part.strip().split(";")
+        q, profile = 1.0, None
+        for param in params[1:]:
+            k, _, v = param.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+            elif k == "profile":
+                profile = v.strip('"')
+        if params[0].strip():
+            ret.append((params[0].strip().lower(), q, profile))
+    return ret
+
+def _json_ld_q(ranges):
+    """q of an application/json range asking for JSON-LD, or 0.0"""
+    q = 0.0
+    for media_range, range_q, profile in ranges:
+        if media_range == "application/json" and profile and \
+                profile.startswith(JSON_LD_PROFILE):
+            q = max(q, range_q)
+    return q
+
+def rdf_format(request):
+    """The (mimetype, serialization) from RDF_FORMATS the request prefers,
+    or JSON-LD as application/json if it asks for that"""
+    ranges = _accepted_ranges(request.META.get('HTTP_ACCEPT', ''))
+    best, best_q = RDF_FORMATS[0], 0.0
+    for mimetype, format in RDF_FORMATS:
+        # the most specific matching range decides
+        q, specificity = 0.0, -1
+        for media_range, range_q, profile in ranges:
+            if media_range == mimetype:
+                rank = 2
+            elif media_range == mimetype.split("/")[0] + "/*":
+                rank = 1
+            elif media_range == "*/*":
+                rank = 0
+            else:
+                continue
+            if rank > specificity:
+                q, specificity = range_q, rank
+        if q > best_q:
+            best, best_q = (mimetype, format), q
+    if _json_ld_q(ranges) > best_q:
+        best = ("application/json", "json-ld")
+    return best
+
+def serialize_as(s, format, type_uri=None):
+    """s (RDF/XML, chunks of it, or a Graph) in another serialization,
+    as a string or an iterator over chunks.  JSON-LD is compacted with
+    type_uri's context, when given.
+
+    Unlike RDF/XML, which is passed through as it's read, the other
+    serializations are buffered: the whole document is parsed into one
+    Graph first, and only the output is produced in chunks."""
+    if isinstance(s, Graph):
+        g = s
+    else:
+        if not isinstance(s, basestring):
+            s = "".join(s)
+        g = parse_rdf(s)
+
+    if format == "nt":
+        return rdf_stream.iter_ntriples(g)
+    if format == "json-ld":
+        return jsonld.iter_jsonld(g, type_uri and jsonld.type_context(type_uri))
+    return g.serialize(format=format)
+
+def rdf_response(s, request=None, type_uri=None):
+    """s is the RDF/XML document, an iterator over its chunks or a Graph.
+    RDF/XML chunks are sent as they're produced, without building the
+    document in memory.  Given the request, the response is in the
+    serialization its Accept header asks for (RDF/XML unless it prefers
+    another, which is built from the whole graph; see serialize_as);
+    type_uri is the API type the document holds."""
+    mimetype, format = RDF_FORMATS[0]
+    if request is not None:
+        mimetype, format = rdf_format(request)
+
+    if format != "xml":
+        s = serialize_as(s, format, type_uri)
+    elif isinstance(s, Graph):
+        s = serialize_rdf(s)
+
+    r = x_domain(HttpResponse(s, mimetype=mimetype))
+    if request is not None:
+        r['Vary'] = 'Accept'
+    return r
 
 def rdf_get(record_connector, query):
     res = record_connector.sparql(query)    
@@ -212,6 +439,7 @@ def rdf_delete(record_connector, query, save=True):
        record_connector.pending_removes.append(r)
        
     if (save): record_connector.execute_transaction()
+    record_connector.invalidate_cache()
        
     return rdf_response(serialize_rdf(deleted))
 
@@ -219,6 +447,7 @@ def rdf_post(record_connector, g):
     record_connector.transaction_begin()
     record_connector.add_conjunctive_graph(g)
     record_connector.transaction_commit()
+    record_connector.invalidate_cache()
     return rdf_response(serialize_rdf(g))
 
 alnum_pattern = re.compile('^a-zA-Z0-9_+')
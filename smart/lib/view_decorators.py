@@ -5,12 +5,14 @@ Ben Adida
 Steve Zabak
 """
 
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified, Http404
 from django.core.exceptions import PermissionDenied
 from smart import models
 from smart import check_safety
+from smart.lib import utils
 
 import inspect
+import hashlib
 import functools, copy, logging
 
 # This should be abstracted
@@ -122,3 +124,35 @@ def marsloader(func):
           raise Exception("Missing arg " + new_arg + " in " + func.func_name)
     return func(request, **new_args)
   return functools.update_wrapper(marsloader_func, func)
+
+def record_version_etag(func):
+  """Strong ETags for record reads, derived from the record's version.
+
+  A request whose If-None-Match matches gets a 304 straight away, without
+  touching the triplestore.
+  """
+  def etag_func(request, *args, **kwargs):
+    record_id = kwargs['record_id']
+    try:
+      version = models.Record.objects.filter(id=record_id).values_list('version', flat=True)[0]
+    except IndexError:
+      return func(request, *args, **kwargs)
+
+    # the same URL can be served in different formats
+    tag = hashlib.sha1("%s\n%s\n%s\n%s" % (record_id, version, request.get_full_path(),
+                                           request.META.get('HTTP_ACCEPT', ''))).hexdigest()
+    etag = '"%s"' % tag
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+      candidates = [t.strip() for t in if_none_match.split(",")]
+      if '*' in candidates or etag in candidates or "W/" + etag in candidates:
+        response = utils.x_domain(HttpResponseNotModified())
+        response['ETag'] = etag
+        return response
+
+    response = func(request, *args, **kwargs)
+    if response.status_code == 200:
+      response['ETag'] = etag
+    return response
+  return functools.update_wrapper(etag_func, func)
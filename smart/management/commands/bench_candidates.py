@@ -0,0 +1,118 @@
+"""
+time filtering and neighbor expansion of growing candidate sets with each candidate strategy.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import time
+from smart.common.rdf_tools.util import URIRef, sp
+from smart.models.record_object import RecordObject
+from smart.models.records import Record
+from smart.triplestore.filters import FILTERS
+from smart.triplestore.triplestore import RecordTripleStore
+
+# name -> (candidate_strategy, candidate_chunk_size); None keeps the setting
+STRATEGIES = [("inline", ('bindings', 0)),
+              ("chunked", ('bindings', None)),
+              ("scoped", ('scoped', 1))]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--record', dest='record', default=None,
+            help='Id of the record to query (required).'),
+        make_option('--type', dest='type', default='Medication',
+            help='Statement type, as an sp: name or a full URI (default Medication).'),
+        make_option('--counts', dest='counts', default='10,100,1000,5000',
+            help='Comma-separated candidate set sizes (default 10,100,1000,5000).'),
+        make_option('--filter', dest='filters', action='append', default=[],
+            help='A filter parameter as name=value, e.g. date_from=2010-01-01 (repeatable).'),
+        make_option('--rounds', type='int', dest='rounds', default=3,
+            help='Runs per measurement; the best time is reported (default 3).'),
+    )
+    help = 'Benchmark query size and latency against candidate set size, per candidate strategy'
+
+    def candidate_uris(self, store, type_node, count):
+        # the record's own statements, padded with URIs the store doesn't know
+        uris = sorted(store.get_clinical_statement_uris(RecordObject[type_node]))
+        prefix = "%s/records/%s/bench/" % (settings.SITE_URL_PREFIX, store.record_id)
+        uris += [URIRef(prefix + str(i)) for i in xrange(count - len(uris))]
+        return uris[:count]
+
+    def measure(self, store, run, rounds):
+        """(best seconds, queries sent, bytes of query text, result)"""
+        sent = []
+        sparql = store.sparql
+        def counting(q):
+            sent.append(len(q))
+            return sparql(q)
+        store.sparql = counting
+
+        best = None
+        try:
+            for i in range(rounds):
+                del sent[:]
+                st = time.time()
+                result = run()
+                elapsed = time.time() - st
+                if best is None or elapsed < best:
+                    best = elapsed
+        finally:
+            del store.sparql
+        return best, len(sent), sum(sent), result
+
+    def handle(self, *args, **options):
+        if not options['record']:
+            raise CommandError("--record is required")
+        try:
+            record = Record.objects.get(id=options['record'])
+        except Record.DoesNotExist:
+            raise CommandError("No record %s" % options['record'])
+
+        try:
+            counts = [int(c) for c in options['counts'].split(",")]
+        except ValueError:
+            raise CommandError("--counts takes comma-separated numbers")
+
+        query_params = {}
+        for f in options['filters']:
+            if "=" not in f:
+                raise CommandError("--filter takes name=value, not %s" % f)
+            k, v = f.split("=", 1)
+            query_params[k] = v
+
+        t = options['type']
+        type_node = URIRef(t) if "://" in t else sp[t]
+        store = RecordTripleStore(record)
+        filters = FILTERS[type_node]
+
+        operations = [("expand", lambda uris: store.expand_to_neighboring_statements(uris, type_node))]
+        if query_params:
+            operations.insert(0, ("filter", lambda uris: filters(store, uris, query_params, type_node)))
+
+        print "%7s %-8s %-7s %8s %10s %10s %8s" % (
+            "count", "strategy", "step", "queries", "query KB", "ms", "results")
+        saved = dict(settings.TRIPLESTORE)
+        try:
+            for count in counts:
+                uris = self.candidate_uris(store, type_node, count)
+                for op, run in operations:
+                    expected = None
+                    for name, (strategy, chunk_size) in STRATEGIES:
+                        settings.TRIPLESTORE['candidate_strategy'] = strategy
+                        settings.TRIPLESTORE['candidate_chunk_size'] = \
+                            saved.get('candidate_chunk_size', 500) if chunk_size is None else chunk_size
+
+                        elapsed, queries, size, result = self.measure(
+                            store, lambda: run(uris), options['rounds'])
+                        print "%7d %-8s %-7s %8d %10.1f %10.1f %8d" % (
+                            len(uris), name, op, queries, size / 1024.0,
+                            1000 * elapsed, len(result))
+
+                        if expected is None:
+                            expected = set(result)
+                        elif set(result) != expected:
+                            print "MISMATCH: %s %s differs from inline" % (name, op)
+        finally:
+            settings.TRIPLESTORE.clear()
+            settings.TRIPLESTORE.update(saved)
@@ -0,0 +1,79 @@
+"""
+time generate_uris on a synthetic POSTed graph, against the node-at-a-time path.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import time
+from rdflib import ConjunctiveGraph
+from smart.common.rdf_tools.rdf_ontology import api_types
+from smart.common.rdf_tools.util import BNode, Literal, sp, rdf, NS, remap_node
+from smart.models.record_object import RecordObject
+
+def generate_uris_by_node(ro, g, c, var_bindings=None):
+    """The original node-at-a-time RecordObject.generate_uris"""
+    node_map = {}
+    nodes = set(g.subjects()) | set(g.objects())
+    for s in nodes:
+        new_node = ro.determine_remap_target(g, c, s, var_bindings)
+        if new_node:
+            node_map[s] = new_node
+
+    for (old_node, new_node) in node_map.iteritems():
+        remap_node(g, old_node, new_node)
+
+    return node_map.values()
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--statements', type='int', dest='statements', default=5000,
+            help='Number of statements in the generated graph (default 5000).'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+            help='Runs per implementation; the best time is reported (default 3).'),
+    )
+    help = 'Benchmark generate_uris on a large generated payload'
+
+    def build_graph(self, statements):
+        types = [t for t in api_types if t.is_statement and t.base_path
+                 and str(t.base_path).startswith("/records/{record_id}/")]
+        if not types:
+            raise CommandError("No record statement types in the ontology")
+
+        title = NS['dcterms']['title']
+        g = ConjunctiveGraph()
+        record = BNode()
+        g.add((record, rdf.type, sp.MedicalRecord))
+        for i in xrange(statements):
+            s = BNode()
+            g.add((s, rdf.type, types[i % len(types)].uri))
+            g.add((s, sp.belongsTo, record))
+            g.add((s, title, Literal("statement %d" % i)))
+
+            # a nested, untyped node, as codes and values are
+            code = BNode()
+            g.add((s, sp.code, code))
+            g.add((code, title, Literal("code %d" % i)))
+        return g
+
+    def time_run(self, method, statements, repeat):
+        best = None
+        for i in range(repeat):
+            g = self.build_graph(statements)
+            st = time.time()
+            new_uris = method(g, None, {'record_id': '1'})
+            elapsed = time.time() - st
+            if best is None or elapsed < best:
+                best = elapsed
+        return best, len(new_uris), len(g)
+
+    def handle(self, *args, **options):
+        statements = options['statements']
+        repeat = options['repeat']
+        ro = RecordObject[sp.Statement]
+
+        print "%d statements, %d triples" % (statements, len(self.build_graph(statements)))
+        for name, method in (("node-at-a-time", lambda *args: generate_uris_by_node(ro, *args)),
+                             ("one-pass", ro.generate_uris)):
+            elapsed, remapped, triples = self.time_run(method, statements, repeat)
+            print "%-15s %8.3fs  %d nodes remapped, %d triples after" % (
+                name, elapsed, remapped, triples)
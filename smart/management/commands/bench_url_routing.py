@@ -0,0 +1,58 @@
+"""
+time resolving every ontology API path with the segment trie and with the regex pattern list.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import re
+import time
+from smart.models.ontology_url_patterns import OntologyURLMapper
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rounds', type='int', dest='rounds', default=1000,
+            help='Times every API path is resolved (default 1000).'),
+    )
+    help = 'Benchmark ontology URL resolution: segment trie vs. regex pattern list'
+
+    def sample_paths(self, mapper):
+        # fill in the parameters the way a client would
+        return [re.sub("{(.*?)}", "x1234", str(p).split("?")[0])[1:]
+                for p, calls in mapper.calls_by_path()]
+
+    def resolve_list(self, url_patterns, path):
+        # what django's RegexURLResolver does
+        for p in url_patterns:
+            ret = p.resolve(path)
+            if ret:
+                return ret
+        return None
+
+    def handle(self, *args, **options):
+        rounds = options['rounds']
+
+        regex_patterns = OntologyURLMapper([], router='regex').patterns
+        router = OntologyURLMapper([], router='trie').patterns[0]
+        paths = self.sample_paths(OntologyURLMapper([], router='regex'))
+
+        mismatches = 0
+        for path in paths:
+            a = self.resolve_list(regex_patterns, path)
+            b = router.resolve(path)
+            if (a is None) != (b is None) or \
+               (a and (a[0].methods != b[0].methods or a[2] != b[2])):
+                mismatches += 1
+                print "MISMATCH for %s: %s / %s" % (path, a, b)
+
+        print "%d API paths, %d patterns, %d mismatches" % (
+            len(paths), len(regex_patterns), mismatches)
+
+        for name, resolve in (("regex list", lambda p: self.resolve_list(regex_patterns, p)),
+                              ("trie", router.resolve)):
+            st = time.time()
+            for i in xrange(rounds):
+                for path in paths:
+                    resolve(path)
+            elapsed = time.time() - st
+            print "%-11s %8.3fs  %.1f us/resolution" % (
+                name, elapsed, 1e6 * elapsed / (rounds * len(paths) or 1))
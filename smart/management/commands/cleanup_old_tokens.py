@@ -4,24 +4,27 @@ remove accesstokens and sessiontokens that are expired.
 
 
 from django.core.management.base import BaseCommand, CommandError
-import datetime, time
-from smart.models import *
-from oauth.oauth import TIMESTAMP_THRESHOLD
+from optparse import make_option
+from smart.accesscontrol.reaper import Reaper, DEFAULT_BATCH_SIZE
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=DEFAULT_BATCH_SIZE,
+            help='Rows deleted per statement (default %d).' % DEFAULT_BATCH_SIZE),
+        make_option('--pause', type='float', dest='pause', default=0,
+            help='Seconds to wait between batches.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, reaping every --interval seconds.'),
+        make_option('--interval', type='int', dest='interval', default=300,
+            help='Seconds between runs with --loop (default 300).'),
+    )
     args = ''
     help = 'clean up old session and access tokens'
 
     def handle(self, *args, **options):
-        now = datetime.datetime.utcnow()
-        max_delta = datetime.timedelta(seconds=TIMESTAMP_THRESHOLD)
-        oldest_nonce = now - max_delta
+        reaper = Reaper(batch_size=options['batch_size'], pause=options['pause'])
 
-        # remove old access tokens
-        SessionToken.objects.filter(expires_at__lt = now).delete()
-
-        # remove old session tokens
-        AccessToken.objects.filter(expires_at__lt = now).delete()
-
-        # remove old Nonces
-        Nonce.objects.filter(created_at__lt = oldest_nonce).delete()
+        if options['loop']:
+            reaper.run_forever(options['interval'])
+        else:
+            reaper.run_once()
@@ -0,0 +1,289 @@
+"""
+boot the app the way a fresh worker does, timing every module import.
+
+Run it in a fresh process (it's what manage.py gives you): anything imported
+before the hook is installed is already paid for and won't show up.  That's
+also why each ONTOLOGY_URL_ROUTER setting is profiled in a process of its own.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import __builtin__
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def current_rss():
+    """Resident set size in bytes"""
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        # peak, not current, but all getrusage offers (KB on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ImportProfiler(object):
+    """Wraps __import__; records time and memory of each module's first import.
+
+    Cumulative figures include the modules a module imports in turn, self
+    figures don't.
+    """
+
+    def __init__(self):
+        self.modules = {}  # name -> {'cumulative', 'self', 'rss'}
+        self.stack = []    # [time in children, rss in children] per open import
+        self.original = None
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self.hooked
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def loaded(self):
+        return set(k for k, v in sys.modules.iteritems() if v is not None)
+
+    def hooked(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        if level <= 0 and name in sys.modules and not fromlist:
+            # the common case: already imported, nothing to measure
+            return self.original(name, globals, locals, fromlist, level)
+
+        before = self.loaded()
+        self.stack.append([0.0, 0])
+        rss = current_rss()
+        st = time.time()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - st
+            grown = current_rss() - rss
+            child_time, child_rss = self.stack.pop()
+            if self.stack:
+                self.stack[-1][0] += elapsed
+                self.stack[-1][1] += grown
+
+            new = self.loaded() - before - set(self.modules)
+            if new:
+                label = name if name in new else max(new, key=len)
+                self.modules[label] = {'cumulative': elapsed,
+                                       'self': elapsed - child_time,
+                                       'rss': grown - child_rss}
+
+
+ROUTERS = ['trie', 'regex']
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--router', dest='router', default='all',
+            choices=['all'] + ROUTERS,
+            help='ONTOLOGY_URL_ROUTER setting to profile (default all, each in a fresh process).'),
+        make_option('--limit', type='int', dest='limit', default=30,
+            help='Modules listed in the report (default 30; 0 for all).'),
+        make_option('--sort', dest='sort', default='self',
+            choices=['self', 'cumulative', 'rss'],
+            help='Order modules by self time, cumulative time or rss (default self).'),
+        make_option('--json', dest='json', default=None,
+            help='Also write the results (per router) to this file, e.g. to use as a baseline.'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='Compare against the results of an earlier --json run.'),
+        make_option('--max-regression', type='float', dest='max_regression', default=None,
+            help='With --baseline: fail if any router\'s total boot time grew by more than this percent.'),
+    )
+    help = 'Profile worker cold start: per-module import time and memory'
+
+    # importing the models would defeat the purpose
+    requires_model_validation = False
+
+    def phases(self, mapper_times, undo):
+        """(name, function) for each boot phase; patches the phases make
+        are undone by calling each function in undo"""
+        from django.conf import settings
+
+        def triplestore():
+            __import__('smart.triplestore.triplestore')
+
+        def ontology():
+            from smart.models import ontology_url_patterns
+            # time the mapper itself, separately from what it imports
+            cls = ontology_url_patterns.OntologyURLMapper
+            original = cls.__init__
+            def timed(mapper, *args, **kwargs):
+                st = time.time()
+                original(mapper, *args, **kwargs)
+                mapper_times.append(time.time() - st)
+            cls.__init__ = timed
+            undo.append(lambda: setattr(cls, '__init__', original))
+
+        def models():
+            __import__('smart.models')
+
+        def plugins():
+            plugins = __import__('smart.plugins', fromlist=['__all__'])
+            for p in plugins.__all__:
+                __import__('smart.plugins.' + p)
+
+        def smart_urls():
+            __import__('smart.urls.urls')
+
+        def root_urls():
+            from django.core.urlresolvers import get_resolver
+            __import__(settings.ROOT_URLCONF)
+            # what the first request does
+            get_resolver(None).reverse_dict
+
+        return [("triplestore engine", triplestore),
+                ("ontology", ontology),
+                ("models", models),
+                ("plugins", plugins),
+                ("smart.urls.urls", smart_urls),
+                ("urls.py", root_urls)]
+
+    def profile(self, router):
+        from django.conf import settings
+        had_router = hasattr(settings, 'ONTOLOGY_URL_ROUTER')
+        saved_router = getattr(settings, 'ONTOLOGY_URL_ROUTER', None)
+        settings.ONTOLOGY_URL_ROUTER = router
+
+        profiler = ImportProfiler()
+        mapper_times = []
+        undo = []
+        preloaded = len(profiler.loaded())
+
+        phases = []
+        start_rss = current_rss()
+        start = time.time()
+        try:
+            profiler.install()
+            for name, phase in self.phases(mapper_times, undo):
+                rss = current_rss()
+                st = time.time()
+                phase()
+                phases.append({'name': name, 'time': time.time() - st,
+                               'rss': current_rss() - rss})
+        finally:
+            if profiler.original is not None:
+                profiler.uninstall()
+            for f in reversed(undo):
+                f()
+            if had_router:
+                settings.ONTOLOGY_URL_ROUTER = saved_router
+            else:
+                del settings.ONTOLOGY_URL_ROUTER
+
+        return {'total': time.time() - start,
+                'rss': current_rss() - start_rss,
+                'preloaded': preloaded,
+                'phases': phases,
+                'url_mapper': sum(mapper_times),
+                'modules': profiler.modules}
+
+    def report(self, results, sort, limit):
+        print "%-22s %9s %9s" % ("phase", "seconds", "rss KB")
+        for p in results['phases']:
+            print "%-22s %9.3f %9d" % (p['name'], p['time'], p['rss'] / 1024)
+        print "%-22s %9.3f" % ("  OntologyURLMapper", results['url_mapper'])
+        print "%-22s %9.3f %9d" % ("total", results['total'], results['rss'] / 1024)
+        print "%d modules imported (%d were already loaded)" % (
+            len(results['modules']), results['preloaded'])
+        print
+
+        modules = sorted(results['modules'].iteritems(),
+                         key=lambda (name, m): m[sort], reverse=True)
+        if limit:
+            modules = modules[:limit]
+        print "%-50s %9s %9s %9s" % ("module", "self s", "cumul s", "rss KB")
+        for name, m in modules:
+            print "%-50s %9.4f %9.4f %9d" % (
+                name, m['self'], m['cumulative'], m['rss'] / 1024)
+
+    def compare(self, results, baseline, limit):
+        def change(now, then):
+            if not then:
+                return "     new"
+            return "%+7.1f%%" % (100.0 * (now - then) / then)
+
+        print
+        print "against baseline:"
+        before = dict((p['name'], p) for p in baseline['phases'])
+        for p in results['phases'] + [{'name': 'total', 'time': results['total']}]:
+            then = p['name'] == 'total' and baseline['total'] or \
+                before.get(p['name'], {}).get('time')
+            print "%-22s %9.3f -> %9.3f %s" % (
+                p['name'], then or 0, p['time'], change(p['time'], then))
+
+        grown = []
+        for name, m in results['modules'].iteritems():
+            then = baseline['modules'].get(name, {}).get('self', 0)
+            grown.append((m['self'] - then, name, then, m['self']))
+        grown.sort(reverse=True)
+        print
+        print "%-50s %9s %9s" % ("slower modules", "was s", "now s")
+        for diff, name, then, now in grown[:limit or None]:
+            if diff <= 0:
+                break
+            print "%-50s %9.4f %9.4f" % (name, then, now)
+
+        return 100.0 * (results['total'] - baseline['total']) / (baseline['total'] or 1e-9)
+
+    def profile_in_child(self, router, options):
+        """Runs this command for one router in a fresh process"""
+        fd, path = tempfile.mkstemp(prefix='profile-startup-', suffix='.json')
+        os.close(fd)
+        try:
+            child = subprocess.Popen(
+                [sys.executable, os.path.abspath(sys.argv[0]), 'profile_startup',
+                 '--router', router, '--json', path,
+                 '--sort', options['sort'], '--limit', str(options['limit'])],
+                stdout=subprocess.PIPE)
+            output = child.communicate()[0]
+            if child.returncode:
+                raise CommandError("Profiling the %s router failed" % router)
+            print output
+            return json.load(open(path))[router]
+        finally:
+            os.unlink(path)
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.load(open(options['baseline']))
+            except (IOError, ValueError), e:
+                raise CommandError("Couldn't read baseline %s: %s" % (options['baseline'], e))
+
+        results = {}
+        if options['router'] == 'all':
+            for router in ROUTERS:
+                print "== ONTOLOGY_URL_ROUTER = '%s'" % router
+                results[router] = self.profile_in_child(router, options)
+        else:
+            router = options['router']
+            results[router] = self.profile(router)
+            self.report(results[router], options['sort'], options['limit'])
+
+        if options['json']:
+            f = open(options['json'], 'w')
+            try:
+                json.dump(results, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+        for router in sorted(set(results) & set(baseline or {})):
+            print
+            print "== ONTOLOGY_URL_ROUTER = '%s'" % router
+            regression = self.compare(results[router], baseline[router], options['limit'])
+            if options['max_regression'] is not None and \
+                    regression > options['max_regression']:
+                raise CommandError("Boot time with the %s router regressed by %.1f%% (allowed %.1f%%)" % (
+                    router, regression, options['max_regression']))
@@ -0,0 +1,34 @@
+"""
+rebuild the pickled ontology snapshot the triplestore filters are loaded from.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import time
+from smart.lib import ontology_snapshot
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+            help="Only report whether the saved snapshot matches the ontology file."),
+    )
+    help = 'Rebuild the ontology snapshot (settings.ONTOLOGY_SNAPSHOT)'
+
+    def handle(self, *args, **options):
+        path = ontology_snapshot.snapshot_path()
+
+        if options['check']:
+            if ontology_snapshot.read(path) is None:
+                raise CommandError("%s is missing or stale" % path)
+            print "%s is current" % path
+            return
+
+        st = time.time()
+        snapshot = ontology_snapshot.build()
+        try:
+            ontology_snapshot.write(snapshot, path)
+        except (IOError, OSError), e:
+            raise CommandError("Couldn't write %s: %s" % (path, e))
+
+        print "Wrote %s: %d types, ontology sha256 %s (%.2fs)" % (
+            path, len(snapshot['types']), snapshot['ontology_hash'], time.time() - st)
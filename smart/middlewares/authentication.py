@@ -5,6 +5,8 @@ inspired by django.contrib.auth middleware, but doing it differently
 for tighter integration into email-centric users in SMART.
 """
 
+import time
+
 from smart.accesscontrol import security
 from smart.lib.utils import DjangoVersionDependentExecutor
 
@@ -26,7 +28,9 @@ class Authentication(object):
         # So, we preemptively read the appropriate variable first, depending on
         # the current version of django
         self.avoid_post_clobbering(request)
+        st = time.time()
         request.principal, request.oauth_request = security.get_principal(request)
+        request.auth_time = time.time() - st
     
     noclobber_map = {
         '1.3.0': lambda request: request.POST,
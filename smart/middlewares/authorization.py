@@ -7,6 +7,7 @@ for tighter integration into email-centric users in Indivo.
 
 import re
 import smart
+import time
 
 from time import strftime
 from django.http import *
@@ -16,19 +17,74 @@ from django.conf import settings
 from smart import accesscontrol
 
 
+class AnyPattern(object):
+    """Matches where any of the compiled patterns does"""
+
+    def __init__(self, exc_patterns):
+        self.compiled = [re.compile(p) for p in exc_patterns]
+
+    def match(self, path):
+        for c in self.compiled:
+            m = c.match(path)
+            if m:
+                return m
+        return None
+
+
+# numbered backreferences and group conditions would point at another
+# pattern's groups once the patterns are joined into one regex
+NUMBERED_GROUP_REF = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+def combinable(pattern):
+    # inline flags such as (?i) would apply to the whole joined regex
+    return not NUMBERED_GROUP_REF.search(pattern) and \
+        re.compile(pattern).flags == re.compile("").flags
+
+
+def compile_exceptions(exc_patterns):
+    """One regex matching wherever any of the exception patterns re.match"""
+    if not exc_patterns:
+        return None
+    if not all(combinable(p) for p in exc_patterns):
+        return AnyPattern(exc_patterns)
+    try:
+        return re.compile("|".join("(?:%s)" % p for p in exc_patterns))
+    except re.error:
+        # e.g. the same group name used in two patterns
+        return AnyPattern(exc_patterns)
+
+
 class Authorization(object):
     """Authorization class to authorize incoming calls
     """
 
+    def __init__(self):
+        self.exceptions = compile_exceptions(settings.SMART_ACCESS_CONTROL_EXCEPTIONS)
+
     def process_view(self, request, view_func, view_args, view_kwargs):
         """ The process_view() hook allows us to examine the request before
         view_func is called
         """
-
+        st = time.time()
+        try:
+            return self.authorize(request, view_func, view_args, view_kwargs)
+        finally:
+            request.authz_time = time.time() - st
+
+    def process_response(self, request, response):
+        if getattr(settings, 'SMART_AUTH_TIMING_HEADERS', False):
+            for header, attr in (('X-Smart-Auth-Time', 'auth_time'),
+                                 ('X-Smart-Authz-Time', 'authz_time')):
+                t = getattr(request, attr, None)
+                if t is not None:
+                    response[header] = "%.3fms" % (t * 1000)
+        return response
+
+    def authorize(self, request, view_func, view_args, view_kwargs):
         # Bypass authorization check for some calls
-        for exc_pattern in settings.SMART_ACCESS_CONTROL_EXCEPTIONS:
-            if re.match(exc_pattern, request.path):
-                return None
+        if self.exceptions and self.exceptions.match(request.path):
+            return None
 
         if hasattr(view_func, 'resolve'):
             methods = view_func.methods.keys()
@@ -0,0 +1,58 @@
+"""
+Tests for the access control exceptions of the Authorization middleware
+
+The compiled matcher has to let through exactly the paths the old loop
+of re.match calls over SMART_ACCESS_CONTROL_EXCEPTIONS did.
+"""
+
+import re
+import unittest
+
+from authorization import AnyPattern, compile_exceptions
+
+PATHS = [
+    "/codes/", "/codes/snomed/123", "/codesx", "/spl/", "/spl", "/records/123/spl/",
+    "/apps/manifests/", "/CODES/", "/aa", "/abab", "/ab", "/x/y", "", "/",
+]
+
+PATTERN_SETS = [
+    ["^/codes/", "^/spl/"],
+    ["/codes/", "spl"],
+    ["^/codes/$", "^/spl/?$", "^/apps/.*"],
+    ["^/x|^/spl", "^/records/\d+/"],
+    ["^/(?P<a>a)(?P=a)", "^/(?P<b>ab)(?P=b)"],
+    # can't be joined into one regex as they are
+    ["^/(?P<a>ab)", "^/(?P<a>a)"],
+    ["^/(a)\\1", "^/(ab)\\1"],
+    ["^/codes/", "(?i)^/spl/"],
+    ["(?i)^/codes/"],
+    ["^/(a)?(?(1)a|b)"],
+]
+
+
+def old_match(exc_patterns, path):
+    """Authorization.process_view's original loop"""
+    for exc_pattern in exc_patterns:
+        if re.match(exc_pattern, path):
+            return True
+    return False
+
+
+class CompileExceptionsTests(unittest.TestCase):
+    def test_matches_like_the_per_pattern_loop(self):
+        for patterns in PATTERN_SETS:
+            compiled = compile_exceptions(patterns)
+            for path in PATHS:
+                self.assertEqual(bool(compiled.match(path)), old_match(patterns, path),
+                                 "%r on %r" % (patterns, path))
+
+    def test_no_exceptions(self):
+        self.assertEqual(compile_exceptions([]), None)
+        self.assertEqual(compile_exceptions(None), None)
+
+    def test_plain_patterns_become_one_regex(self):
+        self.assertFalse(isinstance(compile_exceptions(["^/codes/", "^/spl/"]), AnyPattern))
+
+    def test_patterns_that_cant_be_joined_are_tried_in_turn(self):
+        for patterns in PATTERN_SETS[5:]:
+            self.assertTrue(isinstance(compile_exceptions(patterns), AnyPattern), patterns)
@@ -27,7 +27,7 @@ class Nonce(BaseModel):
     FIXME: clear out the old nonces regularly
     """
     nonce = models.CharField(max_length=100, null=False, unique=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 
 ##
@@ -40,7 +40,7 @@ class OAuthApp(Principal):
 
     Meta = BaseMeta(False)
 
-    consumer_key = models.CharField(max_length=200)
+    consumer_key = models.CharField(max_length=200, db_index=True)
     secret = models.CharField(max_length=60)
     name = models.CharField(max_length=200)
     
@@ -155,10 +155,10 @@ class SessionRequestToken(Object):
 
 
 class SessionToken(Object):
-    token = models.CharField(max_length=40)
+    token = models.CharField(max_length=40, db_index=True)
     secret = models.CharField(max_length=60)
     user = models.ForeignKey('Account', null=True)
-    expires_at = models.DateTimeField(null=False)
+    expires_at = models.DateTimeField(null=False, db_index=True)
 
     @property
     def approved_p(self):
@@ -91,6 +91,10 @@ class Principal(Object):
 
     @property
     def permset(self):
+        from smart.accesscontrol import principal_cache
+        return principal_cache.permset(self, self.build_permset)
+
+    def build_permset(self):
         from smart import accesscontrol
         permset = accesscontrol.PermissionSet(self)
         self.grant_permissions(permset)
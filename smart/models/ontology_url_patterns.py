@@ -1,13 +1,32 @@
 import re
 from smart.common.rdf_tools.rdf_ontology import api_types, api_calls, ontology
+from django.conf import settings
 from django.conf.urls.defaults import patterns
+from django.core.urlresolvers import RegexURLPattern
+from django import http
 from smart.lib.utils import MethodDispatcher
 
+try:
+    from django.core.urlresolvers import ResolverMatch
+except ImportError:
+    ResolverMatch = None
+
 
 class OntologyURLMapper():
-    def __init__(self, urlpatterns):
+    def __init__(self, urlpatterns, router=None):
         self.patterns = urlpatterns
 
+        if router is None:
+            router = getattr(settings, 'ONTOLOGY_URL_ROUTER', 'trie')
+
+        if router == 'trie':
+            self.patterns.append(self.build_router())
+        else:
+            self.patterns += self.build_patterns()
+
+    def dispatchers(self):
+        """(path, MethodDispatcher, extra view arguments) for each API path"""
+        ret = []
         for p, calls in self.calls_by_path():
             methods = {}
             arguments = {}
@@ -17,12 +36,26 @@ class OntologyURLMapper():
                 methods[str(c.http_method)] = mapper.maps_to
                 arguments.update(mapper.arguments)
             #print "mapping", p, methods, arguments
-            self.patterns += patterns(
+            ret.append((p, MethodDispatcher(methods), arguments))
+        return ret
+
+    def build_patterns(self):
+        """One django regex pattern per path, longest paths first"""
+        ret = []
+        for p, dispatcher, arguments in self.dispatchers():
+            ret += patterns(
                 '',
                 (self.django_path(p),
-                MethodDispatcher(methods),
+                dispatcher,
                 arguments)
             )
+        return ret
+
+    def build_router(self):
+        router = OntologyRouter()
+        for p, dispatcher, arguments in self.dispatchers():
+            router.add(p, dispatcher, arguments)
+        return router
 
     def calls_by_path(self):
         ret = {}
@@ -52,6 +85,105 @@ class OntologyURLMapper():
         return ret
 
 
+class RouterNode(object):
+    __slots__ = ('literals', 'params', 'handler')
+
+    def __init__(self):
+        self.literals = {}  # segment -> RouterNode
+        self.params = []    # (segment regex, RouterNode), in insertion order
+        self.handler = None
+
+
+class OntologyRouter(RegexURLPattern):
+    """Resolves ontology API paths by walking a trie of path segments.
+
+    Takes the place of one regex pattern per API path in the URLconf: a
+    request path is resolved in one pass over its segments instead of
+    being matched against every pattern in turn.  A literal segment is
+    preferred over a {parameter} one; parameters match a non-empty
+    segment, just like django_param_regex.
+    """
+
+    def __init__(self):
+        # resolve() below never looks at the regex; it's only there for the
+        # resolver's reverse dict, which has to be able to normalize it, so
+        # it's a plain (reversible) literal that no API path starts with
+        RegexURLPattern.__init__(self, r'^__ontology_router__/$', self.not_found)
+        self.root = RouterNode()
+        self.param_patterns = {}
+
+    def not_found(self, request, *args, **kwargs):
+        raise http.Http404
+
+    def segment_regex(self, segment):
+        if segment not in self.param_patterns:
+            parts = re.split("{(.*?)}", segment)
+            # parts alternate between literal text and parameter names
+            regex = "".join(i % 2 and "(?P<%s>[^/]+)" % part or re.escape(part)
+                            for (i, part) in enumerate(parts))
+            self.param_patterns[segment] = re.compile("^%s$" % regex)
+        return self.param_patterns[segment]
+
+    def add(self, path, view, arguments):
+        path = str(path).split("?")[0]
+        assert path[0] == "/", "Expect smart.owl to provide absolute paths"
+
+        node = self.root
+        for segment in path[1:].split("/"):
+            if "{" not in segment:
+                node = node.literals.setdefault(segment, RouterNode())
+                continue
+
+            regex = self.segment_regex(segment)
+            for (r, child) in node.params:
+                if r is regex:
+                    node = child
+                    break
+            else:
+                child = RouterNode()
+                node.params.append((regex, child))
+                node = child
+
+        if node.handler is None:
+            node.handler = (view, arguments)
+
+    def match(self, segments, i=0, node=None):
+        """Returns (view, arguments, kwargs) for segments[i:], or None"""
+        node = node or self.root
+        if i == len(segments):
+            if node.handler is None:
+                return None
+            return node.handler + ({},)
+
+        segment = segments[i]
+        child = node.literals.get(segment)
+        if child is not None:
+            ret = self.match(segments, i + 1, child)
+            if ret is not None:
+                return ret
+
+        for (regex, child) in node.params:
+            m = regex.match(segment)
+            if m:
+                ret = self.match(segments, i + 1, child)
+                if ret is not None:
+                    ret[2].update(m.groupdict())
+                    return ret
+        return None
+
+    def resolve(self, path):
+        ret = self.match(path.split("/"))
+        if ret is None:
+            return None
+
+        view, arguments, kwargs = ret
+        kwargs.update(arguments)
+        if ResolverMatch is None:
+            # django < 1.3
+            return view, (), kwargs
+        return ResolverMatch(view, (), kwargs)
+
+
 class CallMapper(object):
     __mapper_registry = set()
 
@@ -2,16 +2,18 @@ from smart.triplestore import *
 from smart.models.records import *
 from smart.lib.utils import *
 from smart.common.rdf_tools.util import URIRef, bound_graph, sp
+from smart.lib.view_decorators import record_version_etag
 from django.http import HttpResponse, HttpResponseBadRequest
 from string import Template
 import re
 import logging
 
 
+@record_version_etag
 def record_get_object(request, record_id, obj, **kwargs):
     c = RecordTripleStore(Record.objects.get(id=record_id))
     item_id = URIRef(smart_path(request.path))
-    return rdf_response(c.get_objects(request.path, request.GET, obj, [item_id]))
+    return rdf_response(c.get_objects_stream(request.path, request.GET, obj, [item_id]), request, obj.node)
 
 
 def record_delete_object(request, record_id, obj, **kwargs):
@@ -20,9 +22,10 @@ def record_delete_object(request, record_id, obj, **kwargs):
     return rdf_delete(c, get_statements_by_context(bindings=["<%s>" % id.encode()]))
 
 
+@record_version_etag
 def record_get_all_objects(request, record_id, obj, **kwargs):
     c = RecordTripleStore(Record.objects.get(id=record_id))
-    return rdf_response(c.get_objects(request.path, request.GET, obj))
+    return rdf_response(c.get_objects_stream(request.path, request.GET, obj), request, obj.node)
 
 
 def record_delete_all_objects(request, record_id, obj, **kwargs):
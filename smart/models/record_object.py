@@ -116,17 +116,50 @@ class RecordObject(object):
         full_path = RecordObject[node_type].determine_full_path(var_bindings)
         return full_path
 
+    def bnode_statement_types(self, g):
+        """Statement (or record) type of every blank node of g that has one.
+
+        Gives the same answer as calling statement_type on each node, from
+        a single pass over the rdf:type triples.
+        """
+        ret = {}
+        relevant_types = {}
+        for n, p, t in g.triples((None, rdf.type, None)):
+            if type(n) != BNode:
+                continue
+
+            if t not in relevant_types:
+                c = SMART_Class[t]
+                relevant_types[t] = (c.is_statement or c.uri == sp.MedicalRecord) and c.uri or None
+            if relevant_types[t] is None:
+                continue
+
+            assert n not in ret, "Got multiple node types for %s" % [ret[n], relevant_types[t]]
+            ret[n] = relevant_types[t]
+        return ret
+
+    def remap_nodes(self, g, node_map):
+        """Replaces every node in node_map (as subject or object) in one sweep"""
+        if not node_map:
+            return
+
+        if isinstance(g, ConjunctiveGraph):
+            quads = g.quads((None, None, None))
+        else:
+            quads = ((s, p, o, g) for (s, p, o) in g)
+
+        changed = [(s, p, o, q) for (s, p, o, q) in quads
+                   if s in node_map or o in node_map]
+        for (s, p, o, q) in changed:
+            q.remove((s, p, o))
+            q.add((node_map.get(s, s), p, node_map.get(o, o)))
+
     def generate_uris(self, g, c, var_bindings=None):
         node_map = {}
-        nodes = set(g.subjects()) | set(g.objects())
-        for s in nodes:
-            new_node = self.determine_remap_target(g, c, s, var_bindings)
-            if new_node:
-                node_map[s] = new_node
-
-        for (old_node, new_node) in node_map.iteritems():
-            remap_node(g, old_node, new_node)
+        for s, node_type in self.bnode_statement_types(g).iteritems():
+            node_map[s] = RecordObject[node_type].determine_full_path(var_bindings)
 
+        self.remap_nodes(g, node_map)
         return node_map.values()
 
     def attach_statements_to_record(self, g, new_uris, var_bindings):
@@ -161,30 +194,48 @@ class RecordObject(object):
             g.add((recordURI, rdf.type, sp.MedicalRecord))
 
     def segregate_nodes(self, data, r, context=None):
-
+        """Copies the triples reachable from r into per-statement contexts.
+
+        Each statement node gets a context of its own, holding its triples
+        and those of the non-statement nodes (codes, values, ...) it
+        reaches.  The walk uses an explicit stack, visits each (node,
+        context) pair once so cycles are harmless, and looks each node's
+        type up only once.
+        """
         if context is None:
             context = r
 
-        # Recursion base case:  we've already started evaluating
-        # this node as a root before --> don't evaluate it again!
-        if r == context and len(data.get_context(context)) > 0:
-            return
+        node_types = {}
+
+        def is_statement(n):
+            if n not in node_types:
+                node_types[n] = self.statement_type(data, n)
+            return node_types[n] is not None
 
-        nodes_to_recurse = {}
-        for s, p, o in data.triples((r, None, None)):
-            data.get_context(context).add((s, p, o))
+        visited = set()
+        to_visit = [(r, context)]
+        while to_visit:
+            node, context = to_visit.pop()
+            if (node, context) in visited:
+                continue
+            visited.add((node, context))
 
-            if type(o) == Literal:
+            # we've already evaluated this node as a root before
+            # --> don't evaluate it again!
+            if node == context and len(data.get_context(context)) > 0:
                 continue
 
-            nodes_to_recurse[o] = o
-            if not self.statement_type(data, o):
-                nodes_to_recurse[o] = context
+            g = data.get_context(context)
+            for s, p, o in list(data.triples((node, None, None))):
+                g.add((s, p, o))
 
-        for node, context in nodes_to_recurse.iteritems():
-            self.segregate_nodes(data, node, context)
+                if type(o) == Literal:
+                    continue
 
-        return
+                if is_statement(o):
+                    to_visit.append((o, o))
+                else:
+                    to_visit.append((o, context))
 
     def prepare_graph(self, g, c, var_bindings=None):
         new_uris = self.generate_uris(g, c, var_bindings)
@@ -277,6 +328,7 @@ class RecordItemCallMapper(RecordCallMapper):
 
 
 @CallMapper.register(client_method_name="get_allergies")
+@record_version_etag
 def record_get_allergies(request, *args, **kwargs):
     record_id = kwargs['record_id']
     a = RecordObject["http://smartplatforms.org/terms#Allergy"]
@@ -290,7 +342,7 @@ def record_get_allergies(request, *args, **kwargs):
     ae = parse_rdf(exclusion_graph)
 
     a += ae
-    return rdf_response(serialize_rdf(a))
+    return rdf_response(a, request, sp.Allergy)
    
 def sha256(fileName):
     """Compute sha256 hash of the specified file"""
@@ -338,7 +390,7 @@ def fetch_documents(request, record_id, term, multiple):
 
     if len(bindings) == 0:
         g = ConjunctiveGraph()
-        return rdf_response(serialize_rdf(g))
+        return rdf_response(g, request, term)
     
     g = None
 
@@ -421,7 +473,7 @@ def fetch_documents(request, record_id, term, multiple):
         else:
             g += g2
         
-    return rdf_response(serialize_rdf(g))
+    return rdf_response(g, request, term)
 
 def fetch_imaging_studies(request, record_id, multiple):
     term = str(NS['sp']['ImagingStudy'])
@@ -430,26 +482,29 @@ def fetch_imaging_studies(request, record_id, multiple):
     c = RecordTripleStore(Record.objects.get(id=record_id))
 
     if multiple:
-        imaging_studies_graph = c.get_objects(request.path, request.GET, obj)
+        imaging_studies_graph = c.get_objects_stream(request.path, request.GET, obj)
     else:
         item_id = URIRef(smart_path(request.path))
-        imaging_studies_graph = c.get_objects(request.path, request.GET, obj, [item_id])
+        imaging_studies_graph = c.get_objects_stream(request.path, request.GET, obj, [item_id])
 
-    return rdf_response(imaging_studies_graph)
+    return rdf_response(imaging_studies_graph, request, term)
 
 @CallMapper.register(client_method_name="get_document")
+@record_version_etag
 def record_get_document(request, *args, **kwargs):
     record_id = kwargs['record_id']
     term = str(NS['sp']['Document'])
     return fetch_documents(request,record_id,term,False)
     
 @CallMapper.register(client_method_name="get_documents")
+@record_version_etag
 def record_get_documents(request, *args, **kwargs):
     record_id = kwargs['record_id']
     term = str(NS['sp']['Document'])
     return fetch_documents(request,record_id,term,True)
     
 @CallMapper.register(client_method_name="get_photograph")
+@record_version_etag
 def record_get_photograph(request, *args, **kwargs):
     record_id = kwargs['record_id']
     term = str(NS['sp']['Photograph'])
@@ -466,12 +521,14 @@ def record_get_imaging_studies(request, *args, **kwargs):
     return fetch_imaging_studies(request,record_id,True)
     
 @CallMapper.register(client_method_name="get_medical_image")
+@record_version_etag
 def record_get_medical_image(request, *args, **kwargs):
     record_id = kwargs['record_id']
     term = str(NS['sp']['MedicalImage'])
     return fetch_documents(request,record_id,term,False)
     
 @CallMapper.register(client_method_name="get_medical_images")
+@record_version_etag
 def record_get_medical_images(request, *args, **kwargs):
     record_id = kwargs['record_id']
     term = str(NS['sp']['MedicalImage'])
@@ -5,6 +5,7 @@ Ben Adida & Josh Mandel
 """
 
 from base import *
+from django.db.models import F
 from django.utils import simplejson
 from django.conf import settings
 from smart.common.rdf_tools.rdf_ontology import ontology
@@ -23,9 +24,16 @@ class Record(Object):
 
     full_name = models.CharField(max_length=150, null=False)
 
+    # bumped whenever a triplestore transaction touches the record's graphs
+    version = models.IntegerField(default=0)
+
     def __unicode__(self):
         return 'Record %s' % self.id
 
+    @classmethod
+    def bump_versions(cls, record_ids):
+        cls.objects.filter(id__in=record_ids).update(version=F('version') + 1)
+
     def generate_direct_access_token(self, account, token_secret=None):
         u = RecordDirectAccessToken.objects.create(
             record=self,
@@ -78,9 +78,9 @@ class Token(object):
 
 class AccessToken(Principal, Token):
     # the token, secret, and PHA this corresponds to
-    token = models.CharField(max_length=40)
+    token = models.CharField(max_length=40, db_index=True)
     token_secret = models.CharField(max_length=60)
-    expires_at = models.DateTimeField(null=True)
+    expires_at = models.DateTimeField(null=True, db_index=True)
 
     # derived from a share
     share = models.ForeignKey('Share')
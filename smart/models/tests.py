@@ -0,0 +1,294 @@
+"""
+Tests for the ontology URL router and for splitting POSTed graphs into
+statements
+
+The trie router has to resolve every request path the way the per-path
+regex patterns it replaces would.  Paths are registered directly, so no
+ontology is needed.  The graph tests use SMART types (sp:Medication,
+sp:MedicalRecord, ...) from the ontology.
+"""
+
+import re
+import unittest
+
+from django.core.urlresolvers import RegexURLPattern, RegexURLResolver
+from django.utils.regex_helper import normalize
+from rdflib import BNode, ConjunctiveGraph, Graph, Literal, URIRef
+from rdflib.compare import isomorphic
+
+from smart.common.rdf_tools.util import rdf, sp
+from ontology_url_patterns import OntologyURLMapper, OntologyRouter
+from record_object import RecordObject
+from smart.management.commands.bench_generate_uris import generate_uris_by_node
+
+
+class PathMapper(OntologyURLMapper):
+    """Just the path translation, without reading the ontology"""
+    def __init__(self):
+        pass
+
+
+def view(name):
+    def v(request, **kwargs):
+        return name
+    v.__name__ = name
+    return v
+
+
+API_PATHS = [
+    ("/records/{record_id}/medications/", view("medications"), {}),
+    ("/records/{record_id}/medications/{medication_id}", view("medication"), {}),
+    ("/records/{record_id}/medications/{medication_id}/fulfillments/", view("fulfillments"),
+     {'obj_type': 'Fulfillment'}),
+    ("/records/{record_id}/apps/{pha_email}/preferences", view("preferences"), {}),
+    ("/records/{record_id}/documents/{document_id}/content?format={format}", view("content"), {}),
+    ("/apps/{pha_email}/manifest", view("manifest"), {}),
+    ("/apps/manifests/", view("manifests"), {}),
+]
+
+REQUEST_PATHS = [
+    "records/123/medications/",
+    "records/123/medications/456",
+    "records/123/medications/456/fulfillments/",
+    "records/123/apps/my-app@apps.smartplatforms.org/preferences",
+    "records/123/documents/9/content",
+    "apps/my-app@apps.smartplatforms.org/manifest",
+    "apps/manifests/",
+    # none of these resolve
+    "",
+    "records/123/medications",
+    "records//medications/",
+    "records/123/medications/456/fulfillments",
+    "records/123/medications/456/fulfillments/789",
+    "apps/manifests",
+    "records/123/documents/9/content?format=pdf",
+]
+
+
+def router_for(paths):
+    router = OntologyRouter()
+    for p, v, arguments in paths:
+        router.add(p, v, arguments)
+    return router
+
+
+def regex_patterns_for(paths):
+    """The patterns build_patterns would make, longest paths first"""
+    mapper = PathMapper()
+    paths = sorted(paths, key=lambda x: -1 * len(x[0]))
+    return [RegexURLPattern(mapper.django_path(p), v, arguments)
+            for p, v, arguments in paths]
+
+
+def resolved(match):
+    """(view, kwargs) from a ResolverMatch (or django 1.2's tuple), or None"""
+    if match is None:
+        return None
+    view, args, kwargs = match
+    return view, kwargs
+
+
+class OntologyRouterTests(unittest.TestCase):
+    def test_resolves_like_the_regex_patterns(self):
+        router = router_for(API_PATHS)
+        patterns = regex_patterns_for(API_PATHS)
+
+        for path in REQUEST_PATHS:
+            expected = None
+            for p in patterns:
+                expected = resolved(p.resolve(path))
+                if expected is not None:
+                    break
+            self.assertEqual(resolved(router.resolve(path)), expected,
+                             "%r resolved differently" % path)
+
+    def test_captures_parameters_and_arguments(self):
+        router = router_for(API_PATHS)
+        v, kwargs = resolved(router.resolve("records/123/medications/456/fulfillments/"))
+        self.assertEqual(v.__name__, "fulfillments")
+        self.assertEqual(kwargs, {'record_id': '123', 'medication_id': '456',
+                                  'obj_type': 'Fulfillment'})
+
+    def test_literal_segment_wins_over_parameter(self):
+        router = router_for([("/records/{record_id}/", view("record"), {}),
+                             ("/records/search/", view("search"), {})])
+        v, kwargs = resolved(router.resolve("records/search/"))
+        self.assertEqual((v.__name__, kwargs), ("search", {}))
+        v, kwargs = resolved(router.resolve("records/123/"))
+        self.assertEqual((v.__name__, kwargs), ("record", {'record_id': '123'}))
+
+    def test_falls_back_to_parameter_after_literal_dead_end(self):
+        router = router_for([("/records/search/", view("search"), {}),
+                             ("/records/{record_id}/medications/", view("medications"), {})])
+        v, kwargs = resolved(router.resolve("records/search/medications/"))
+        self.assertEqual((v.__name__, kwargs), ("medications", {'record_id': 'search'}))
+
+    def test_mixed_segment(self):
+        router = router_for([("/records/{record_id}/photo.{ext}", view("photo"), {})])
+        v, kwargs = resolved(router.resolve("records/123/photo.png"))
+        self.assertEqual(kwargs, {'record_id': '123', 'ext': 'png'})
+        self.assertEqual(router.resolve("records/123/photoXpng"), None)
+
+    def test_regex_is_reversible(self):
+        router = router_for(API_PATHS)
+        normalize(router.regex.pattern)
+
+        # the resolver's reverse dict is built from every pattern's regex
+        resolver = RegexURLResolver(r'^/', [router] + regex_patterns_for(API_PATHS[:1]))
+        self.assertTrue(resolver.reverse_dict)
+
+
+RECORD = URIRef("http://localhost:7000/records/123")
+MED_1 = URIRef("http://localhost:7000/records/123/medications/1")
+MED_2 = URIRef("http://localhost:7000/records/123/medications/2")
+TITLE = URIRef("http://purl.org/dc/terms/title")
+
+
+def context_triples(data, c):
+    return set(data.get_context(c))
+
+
+class SegregateNodesTests(unittest.TestCase):
+    def setUp(self):
+        self.ro = RecordObject[sp.Statement]
+        self.data = ConjunctiveGraph()
+        d = self.data.default_context
+        d.add((RECORD, rdf.type, sp.MedicalRecord))
+        for med in (MED_1, MED_2):
+            d.add((RECORD, sp.hasStatement, med))
+            d.add((med, rdf.type, sp.Medication))
+            d.add((med, sp.belongsTo, RECORD))
+
+    def test_each_statement_gets_its_nodes(self):
+        d = self.data.default_context
+        code = BNode()
+        d.add((MED_1, sp.drugName, code))
+        d.add((code, TITLE, Literal("Lipitor")))
+        self.ro.segregate_nodes(self.data, RECORD)
+
+        self.assertEqual(context_triples(self.data, MED_1),
+                         set([(MED_1, rdf.type, sp.Medication),
+                              (MED_1, sp.belongsTo, RECORD),
+                              (MED_1, sp.drugName, code),
+                              (code, TITLE, Literal("Lipitor"))]))
+        self.assertEqual(context_triples(self.data, MED_2),
+                         set([(MED_2, rdf.type, sp.Medication),
+                              (MED_2, sp.belongsTo, RECORD)]))
+        self.assertEqual(len(context_triples(self.data, RECORD)), 3)
+
+    def test_cycles(self):
+        d = self.data.default_context
+        a, b = BNode(), BNode()
+        # statement -> node -> node -> back to the first node and the statement
+        d.add((MED_1, sp.drugName, a))
+        d.add((a, sp.code, b))
+        d.add((b, sp.code, a))
+        d.add((b, sp.code, MED_1))
+        d.add((a, sp.code, a))
+        # statements pointing at each other
+        d.add((MED_1, sp.relatedTo, MED_2))
+        d.add((MED_2, sp.relatedTo, MED_1))
+        self.ro.segregate_nodes(self.data, RECORD)
+
+        med_1 = context_triples(self.data, MED_1)
+        for t in [(a, sp.code, b), (b, sp.code, a), (b, sp.code, MED_1), (a, sp.code, a),
+                  (MED_1, sp.relatedTo, MED_2)]:
+            self.assertTrue(t in med_1)
+        # another statement's own triples stay in its own context
+        self.assertFalse((MED_2, sp.relatedTo, MED_1) in med_1)
+        self.assertTrue((MED_2, sp.relatedTo, MED_1) in context_triples(self.data, MED_2))
+
+    def test_long_chains_dont_recurse(self):
+        d = self.data.default_context
+        node = MED_1
+        for i in range(5000):
+            n = BNode()
+            d.add((node, sp.code, n))
+            node = n
+        d.add((node, TITLE, Literal("end")))
+        self.ro.segregate_nodes(self.data, RECORD)
+        self.assertEqual(len(context_triples(self.data, MED_1)), 5003)
+
+    def test_shared_node_is_copied_to_each_statement(self):
+        d = self.data.default_context
+        code = BNode()
+        for med in (MED_1, MED_2):
+            d.add((med, sp.drugName, code))
+        d.add((code, TITLE, Literal("Lipitor")))
+        self.ro.segregate_nodes(self.data, RECORD)
+        for med in (MED_1, MED_2):
+            self.assertTrue((code, TITLE, Literal("Lipitor")) in context_triples(self.data, med))
+
+
+NEW_URI = re.compile(r"^http://localhost:7000/records/123/(medications|problems)/[0-9a-f-]{36}$")
+
+
+def posted_graph(graph_class=Graph):
+    """A POSTed graph: blank statement nodes, typed and untyped value
+    nodes, and a node that's already a URI"""
+    g = graph_class()
+    record = BNode()
+    g.add((record, rdf.type, sp.MedicalRecord))
+    for i, t in enumerate([sp.Medication, sp.Medication, sp.Problem]):
+        s = BNode()
+        g.add((s, rdf.type, t))
+        g.add((s, TITLE, Literal("statement %d" % i)))
+        g.add((s, sp.belongsTo, record))
+        code = BNode()
+        g.add((s, sp.drugName, code))
+        g.add((code, rdf.type, sp.CodedValue))
+        g.add((code, sp.code, s))
+    g.add((MED_1, rdf.type, sp.Medication))
+    g.add((MED_1, sp.relatedTo, BNode()))
+    return g
+
+
+def blanked(g, uris):
+    """g with each of uris replaced by a blank node, so graphs that only
+    differ by their generated ids compare equal"""
+    nodes = dict((u, BNode()) for u in uris)
+    ret = Graph()
+    for s, p, o in g:
+        ret.add((nodes.get(s, s), p, nodes.get(o, o)))
+    return ret
+
+
+class GenerateURIsTests(unittest.TestCase):
+    def setUp(self):
+        self.ro = RecordObject[sp.Statement]
+        self.bindings = {'record_id': '123'}
+
+    def test_same_graph_as_node_at_a_time(self):
+        old, new = posted_graph(), posted_graph()
+        old_uris = generate_uris_by_node(self.ro, old, None, dict(self.bindings))
+        new_uris = self.ro.generate_uris(new, None, dict(self.bindings))
+
+        self.assertEqual(len(new_uris), len(old_uris))
+        self.assertEqual(len(new), len(old))
+        self.assertTrue(isomorphic(blanked(new, new_uris), blanked(old, old_uris)))
+
+    def test_new_uris(self):
+        g = posted_graph()
+        new_uris = self.ro.generate_uris(g, None, dict(self.bindings))
+
+        statements = [u for u in new_uris if u != RECORD]
+        self.assertEqual(len(statements), 3)
+        for u in statements:
+            self.assertTrue(NEW_URI.match(u), u)
+        self.assertTrue(RECORD in new_uris)
+        # the record node becomes the record URI; value nodes stay blank
+        self.assertEqual(len(list(g.triples((None, sp.belongsTo, RECORD)))), 3)
+        self.assertEqual(len(set(g.objects(None, sp.drugName))), 3)
+        for code in g.objects(None, sp.drugName):
+            self.assertTrue(isinstance(code, BNode))
+
+    def test_contexts_are_kept(self):
+        cg = ConjunctiveGraph()
+        g = cg.get_context(MED_2)
+        for t in posted_graph():
+            g.add(t)
+        new_uris = self.ro.generate_uris(cg, None, dict(self.bindings))
+        self.assertEqual(len(cg.get_context(MED_2)), len(posted_graph()))
+        self.assertEqual(len(cg.default_context), 0)
+        for u in new_uris:
+            self.assertTrue(list(cg.get_context(MED_2).triples((u, rdf.type, None))))
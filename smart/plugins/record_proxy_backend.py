@@ -13,7 +13,7 @@ def proxy_get(request, *args, **kwargs):
     url = settings.PROXY_BASE + request.path    
     try:
         ret = url_request(url, "GET", {})
-        return rdf_response(ret)
+        return rdf_response(ret, request)
     except URLFetchException as e:
     
         if (settings.PROXY_ERROR_NOTIFICATION):
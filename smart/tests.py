@@ -0,0 +1,10 @@
+"""
+Collects the tests kept next to the code they cover, for manage.py test
+"""
+
+from smart.triplestore.tests import *
+from smart.models.tests import *
+from smart.lib.tests import *
+from smart.accesscontrol.tests import *
+from load_tools.tests import *
+from smart.middlewares.tests import *
@@ -0,0 +1,188 @@
+"""
+Per-record cache of get_objects responses
+
+Apps re-read the same record lists (medications, problems, ...) on every
+launch.  Responses are cached under the record id, the object type, the
+request path, the normalized query parameters (which include the page)
+and any explicit statement list.  Every key also holds the record's
+version (Record.version, bumped in the database by each triplestore
+commit that touches the record; older databases get the column from
+upgrade/record_version.sql), so once a write is committed, no
+process -- whichever one made the write -- serves a response computed
+before it.  Invalidating a record only frees its entries early.
+
+Two backends are available, picked by settings.RESPONSE_CACHE['backend']:
+  'local'  -- an in-process LRU bounded by entry count and total bytes
+  'shared' -- django's cache framework (e.g. memcached), for setups
+              with several worker processes
+
+Responses are streamed to the client as they're read from the store; a
+copy is only kept (and cached once complete) for responses of at most
+settings.RESPONSE_CACHE['max_entry_bytes'].
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.conf import settings
+
+DEFAULT_MAX_ENTRIES = 500
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+
+class LocalBackend(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, **kwargs):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # least recently used first
+        self.size = 0
+        self.keys_by_record = {}
+
+    def get(self, record_id, key):
+        with self.lock:
+            value = self.entries.pop((record_id, key), None)
+            if value is not None:
+                self.entries[(record_id, key)] = value
+            return value
+
+    def set(self, record_id, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop((record_id, key), None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[(record_id, key)] = value
+            self.size += len(value)
+            self.keys_by_record.setdefault(record_id, set()).add(key)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                (evicted_record, evicted_key), evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                keys = self.keys_by_record[evicted_record]
+                keys.discard(evicted_key)
+                if not keys:
+                    del self.keys_by_record[evicted_record]
+
+    def invalidate(self, record_id):
+        with self.lock:
+            for key in self.keys_by_record.pop(record_id, ()):
+                self.size -= len(self.entries.pop((record_id, key), ""))
+
+
+class SharedBackend(object):
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+
+    def _entry_key(self, record_id, key):
+        # memcached keys must be short and free of whitespace
+        return "smart.objects.%s.%s" % (record_id, hashlib.sha1(repr(key)).hexdigest())
+
+    def get(self, record_id, key):
+        return self.cache.get(self._entry_key(record_id, key))
+
+    def set(self, record_id, key, value):
+        self.cache.set(self._entry_key(record_id, key), value, self.timeout)
+
+    def invalidate(self, record_id):
+        # entries of older versions are never looked up again; they expire
+        pass
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'shared': SharedBackend,
+}
+
+
+class ResponseCache(object):
+    def __init__(self, backend=None, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.backend = backend
+        self.max_entry_bytes = max_entry_bytes
+        self.lock = threading.Lock()
+        self.type_stats = {}
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def key(self, path, queries, obj, limit_to_statements=None):
+        params = tuple(sorted((k, tuple(queries.getlist(k)) if hasattr(queries, 'getlist')
+                                  else (queries[k],))
+                              for k in queries))
+        statements = tuple(sorted(str(s) for s in limit_to_statements or ()))
+        return (str(obj.node), path, params, statements)
+
+    def _count(self, obj, outcome):
+        with self.lock:
+            s = self.type_stats.setdefault(str(obj.node), {'hits': 0, 'misses': 0})
+            s[outcome] += 1
+
+    def get_objects_stream(self, record_id, version, path, queries, obj,
+                           limit_to_statements, fetch):
+        """Returns the cached response as a single chunk, or the chunks of
+        fetch(), caching the response once they've all been read.
+
+        version is the record's version as read before fetch() runs, so a
+        response is never cached under a version newer than its data (None
+        when it isn't known, which bypasses the cache).
+        """
+        if not self.enabled or version is None:
+            return fetch()
+
+        key = (version,) + self.key(path, queries, obj, limit_to_statements)
+
+        ret = self.backend.get(record_id, key)
+        if ret is not None:
+            self._count(obj, 'hits')
+            return [ret]
+
+        self._count(obj, 'misses')
+        return self._tee(record_id, key, fetch())
+
+    def _tee(self, record_id, key, chunks):
+        kept, size = [], 0
+        try:
+            for chunk in chunks:
+                if kept is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        kept = None  # too big to cache; stop copying
+                    else:
+                        kept.append(chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+        # only reached once the whole response has been read
+        if kept is not None:
+            self.backend.set(record_id, key, "".join(kept))
+
+    def invalidate(self, record_id):
+        if self.enabled:
+            self.backend.invalidate(record_id)
+
+    def stats(self):
+        """Hit/miss counters keyed by object type URI"""
+        with self.lock:
+            return dict((t, dict(s)) for (t, s) in self.type_stats.iteritems())
+
+
+def _configured_cache():
+    options = dict(getattr(settings, 'RESPONSE_CACHE', None) or {})
+    name = options.pop('backend', None)
+    max_entry_bytes = options.pop('max_entry_bytes', DEFAULT_MAX_ENTRY_BYTES)
+    if not name:
+        return ResponseCache()
+    return ResponseCache(BACKENDS[name](**options), max_entry_bytes)
+
+RESPONSE_CACHE = _configured_cache()
@@ -0,0 +1,82 @@
+"""
+Candidate URI sets in queries
+
+Filtering, neighbor expansion and context fetches restrict a query to a
+set of candidate statement URIs.  Small sets are listed inline in a
+BINDINGS block.  Past settings.TRIPLESTORE['candidate_chunk_size'] URIs,
+the query text grows with the set (and some stores parse it in quadratic
+time), so larger sets are handled in one of two ways, picked by
+settings.TRIPLESTORE['candidate_strategy']:
+
+  'bindings': the set is split into chunks of candidate_chunk_size URIs,
+              queried in parallel (candidate_parallelism at a time).
+  'scoped':   the query is scoped by the record graph pattern
+              ($record sp:hasStatement ?v) and the statement type instead,
+              and its results are intersected with the set in python.
+
+A CONSTRUCT can't be intersected after the fact, so context fetches are
+always chunked.  A candidate_chunk_size of 0 lists every set inline.
+"""
+
+from base import *
+from multiprocessing.pool import ThreadPool
+
+HAS_STATEMENT = URIRef("http://smartplatforms.org/terms#hasStatement")
+
+
+def strategy():
+    return settings.TRIPLESTORE.get('candidate_strategy', 'bindings')
+
+
+def chunk_size():
+    return settings.TRIPLESTORE.get('candidate_chunk_size', 500)
+
+
+def parallelism():
+    return settings.TRIPLESTORE.get('candidate_parallelism', 4)
+
+
+def scoped(uris):
+    """Whether a query on uris should be scoped rather than list them"""
+    size = chunk_size()
+    return bool(size) and strategy() == 'scoped' and len(uris) > size
+
+
+def scope(var, type_node=None):
+    """Graph pattern binding var to the record's statements (of type_node)"""
+    ret = "GRAPH $record { $record %s %s . }" % (HAS_STATEMENT.n3(), var)
+    if type_node is not None:
+        ret += "\nGRAPH %s { %s a %s . }" % (var, var, type_node.n3())
+    return ret
+
+
+def bindings(var, uris):
+    return " BINDINGS %s {(%s)} " % (var, ")(".join([x.n3() for x in uris]))
+
+
+def chunked(uris, size=None):
+    uris = list(uris)
+    size = size or chunk_size() or len(uris) or 1
+    return [uris[i:i + size] for i in xrange(0, len(uris), size)]
+
+
+def map_chunks(run, uris):
+    """[run(chunk) for each chunk of uris], in parallel when there are several"""
+    chunks = chunked(uris)
+    if len(chunks) <= 1:
+        return [run(c) for c in chunks]
+
+    pool = ThreadPool(max(1, min(parallelism(), len(chunks))))
+    try:
+        return pool.map(run, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def select(triplestore, query, var, uris):
+    """The rows of query with var bound to each of uris in turn"""
+    rows = []
+    for results in map_chunks(lambda c: triplestore.select(query + bindings(var, c)), uris):
+        rows.extend(results)
+    return rows
@@ -1,7 +1,12 @@
-from collections import defaultdict
 from django.conf import settings
-from smart.common.rdf_tools.rdf_ontology import SMART_API_Call
-from rdflib import Literal
+from smart.lib import ontology_snapshot
+import candidates
+from rdflib import Literal, URIRef
+import base64
+import json
+import operator
+import re
+import urllib
 
 DATE_FILTERS_LB = ["date_from", "date_from_including", "date_to_excluding"]
 DATE_FILTERS_UB = ["date_from_excluding", "date_to", "date_to_including"]
@@ -11,129 +16,282 @@ DATE_FILTERS_GT_EQ = ["date_from", "date_from_including"]
 DATE_FILTERS_GT = ["date_from_excluding"]
 DATE_FILTERS = DATE_FILTERS_LB + DATE_FILTERS_UB
 
+# partial dates ("2010", "2010-05") are compared as if padded out with these
+DATE_LB = "1900-01-01T00:00:00Z"
+DATE_UB = "2999-12-31T23:59:59Z"
 
-class SparqlClause(list):
-    pass
+DATE_COMPARISONS = {
+    "<=": operator.le,
+    "<": operator.lt,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
 
+# characters that may not appear in a cursor's IRI (they'd escape the <...>)
+UNSAFE_IRI_CHARS = re.compile(r'[\x00-\x20<>"{}|^`\\]')
 
-class AndClause(SparqlClause):
-    def __str__(self):
-        return "{" + "}\n{".join([str(x) for x in self]) + "}"
 
+# string literals and IRIs in a filter_sparql template; a placeholder
+# anywhere else is a bare term
+SPARQL_QUOTED = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'|<[^<>"\s]*>')
 
-class OrClause(SparqlClause):
-    def __str__(self):
-        return "{" + "}\nUNION\n{".join([str(x) for x in self]) + "}"
+STRING_ESCAPES = {
+    u'\\': u'\\\\',
+    u'"': u'\\"',
+    u"'": u"\\'",
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+    u'\t': u'\\t',
+}
+STRING_UNSAFE = re.compile(u'[\\\\"\'\n\r\t]')
 
+# bare values that can't change the shape of the query: numbers,
+# booleans and prefixed names
+BARE_SAFE = re.compile(r'^(?:[-+]?[0-9]+(?:\.[0-9]+)?|true|false|[A-Za-z][\w-]*:[\w-]*)$')
 
-class FilterSet(object):
-    def __init__(self, smart_type=None):
-        self.smart_type = smart_type
-        self.filters = []
-        self.dateFilters = {}
-        if smart_type:
-            self.filters = smart_type.filters
+# characters left alone in values substituted into an IRI
+IRI_SAFE = "/:#?&=;,@!$'()*+-._~%"
 
-    def sub(self, f, k, v):
-        if k in DATE_FILTERS:
-            self.dateFilters[k] = v
+# compiled query shapes kept per FilterSet
+MAX_SHAPES = 256
 
-        assert type(f.filter_sparql) is Literal, 'filter_sparql is not an RDF Literal!'
-        return f.filter_sparql.replace("{" + k + "}", v)
 
-    def getQuery(self, query_params):
-        clauses = AndClause()
+def escapeString(v):
+    return STRING_UNSAFE.sub(lambda m: STRING_ESCAPES[m.group(0)], unicode(v))
 
-        for f in self.filters:
-            k = f.client_parameter_name
-            if k in query_params:
-                o = OrClause()
-                vv = query_params[k]
-                for v in vv.split("|"):
-                    o.append(self.sub(f, k, v))
-                clauses.append(o)
 
-        if clauses:
-            selects = "?v ?d" if len(self.dateFilters) > 0 else "?v"
-            return """
-                PREFIX sp:<http://smartplatforms.org/terms#>
-                PREFIX dcterms:<http://purl.org/dc/terms/>
-                SELECT %s
-                {%s}
-                """ % (selects, str(clauses))
+def escapeIRI(v):
+    return unicode(urllib.quote(unicode(v).encode("utf-8"), safe=IRI_SAFE))
 
-        return None
 
-    def dateInRange(self, date):
-        LB = "1900-01-01T00:00:00Z"
-        UB = "2999-12-31T23:59:59Z"
+def escapeBare(v):
+    if BARE_SAFE.match(v):
+        return unicode(v)
+    return u'"%s"' % escapeString(v)
 
-        for k in self.dateFilters.keys():
-            v = self.dateFilters[k]
 
-            if k in DATE_FILTERS_LB:
-                if len(v) < len(LB):
-                    v += LB[len(v):len(LB)]
+def compileTemplate(sparql, name):
+    """Splits a filter_sparql template around its {name} placeholders.
+
+    Returns [text, escape, text, escape, ..., text], where each escape is
+    the function making a value safe where that placeholder sits: inside
+    a string literal, inside an IRI or as a bare term.
+    """
+    placeholder = u"{%s}" % name
+    parts = [u""]
+
+    def add(text, escape):
+        pieces = text.split(placeholder)
+        parts[-1] += pieces[0]
+        for piece in pieces[1:]:
+            parts.extend([escape, piece])
+
+    pos = 0
+    for m in SPARQL_QUOTED.finditer(sparql):
+        add(sparql[pos:m.start()], escapeBare)
+        add(m.group(0), m.group(0).startswith(u"<") and escapeIRI or escapeString)
+        pos = m.end()
+    add(sparql[pos:], escapeBare)
+    return parts
 
+
+class CompiledFilter(object):
+    def __init__(self, f):
+        assert type(f.filter_sparql) is Literal, 'filter_sparql is not an RDF Literal!'
+        self.name = unicode(f.client_parameter_name)
+        self.parts = compileTemplate(unicode(f.filter_sparql), self.name)
+
+
+def compileShape(filters, key):
+    """The clause shape for key, a tuple of (filter index, number of values).
+
+    Every filter used is a group, and its |-separated values alternatives
+    in a UNION.  Returns ([(text, escape), ...], tail), to be rendered
+    with the values in key order.
+    """
+    segments, text = [], [u"{"]
+    for i, (fi, n) in enumerate(key):
+        text.append(i and u"}\n{{" or u"{")
+        for j in range(n):
+            if j:
+                text.append(u"}\nUNION\n{")
+            parts = filters[fi].parts
+            text.append(parts[0])
+            for k in range(1, len(parts), 2):
+                segments.append((u"".join(text), parts[k]))
+                text = [parts[k + 1]]
+        text.append(u"}")
+    text.append(u"}")
+    return segments, u"".join(text)
+
+
+def renderShape(shape, values):
+    segments, tail = shape
+    out = []
+    for (text, escape), v in zip(segments, values):
+        out.append(text)
+        out.append(escape(v))
+    out.append(tail)
+    return u"".join(out)
+
+
+def padDate(date, padding):
+    return date + padding[len(date):]
+
+
+class DateBounds(object):
+    """The date filters of one request, normalized once.
+
+    Each bound is a (comparison, padded bound, padding) triple: a result's
+    date ?d passes when padDate(?d, padding) <comparison> bound.
+    """
+
+    def __init__(self, date_filters):
+        self.bounds = []
+        for k, v in sorted(date_filters.items()):
+            if k in DATE_FILTERS_LB:
+                v = padDate(v, DATE_LB)
             if k in DATE_FILTERS_UB:
-                if len(v) < len(UB):
-                    v += UB[len(v):len(UB)]
+                v = padDate(v, DATE_UB)
 
             if k in DATE_FILTERS_LT_EQ:
-                d = date + LB[len(date):len(LB)]
-                if not d <= v:
-                    return False
-
+                self.bounds.append(("<=", v, DATE_LB))
             if k in DATE_FILTERS_LT:
-                d = date + LB[len(date):len(LB)]
-                if not d < v:
-                    return False
-
+                self.bounds.append(("<", v, DATE_LB))
             if k in DATE_FILTERS_GT_EQ:
-                d = date + UB[len(date):len(UB)]
-                if not d >= v:
-                    return False
-
+                self.bounds.append((">=", v, DATE_UB))
             if k in DATE_FILTERS_GT:
-                d = date + UB[len(date):len(UB)]
-                if not d > v:
-                    return False
+                self.bounds.append((">", v, DATE_UB))
 
-        return True
+    def __nonzero__(self):
+        return bool(self.bounds)
 
-    def __call__(self, triplestore, candidate_uris, query_params):
-        query = self.getQuery(query_params)
-        if query:
-            query += """ BINDINGS ?v {(""" + ")(".join([
-                x.n3() for x in candidate_uris
-            ]) + """)} """
+    def matches(self, date):
+        return all(DATE_COMPARISONS[op](padDate(date, padding), v)
+                   for op, v, padding in self.bounds)
 
-            results = triplestore.select(query)
-            keys_used = set()
-            result_uris = set()
+    def filterRows(self, rows):
+        """URIs of the (uri, date) rows whose date is in range.
+
+        Dates are padded once per padding, and each bound then checked
+        against the whole column.
+        """
+        dates = [str(d) for uri, d in rows]
+        padded = {}
+        keep = [True] * len(rows)
+        for op, v, padding in self.bounds:
+            if padding not in padded:
+                padded[padding] = [padDate(d, padding) for d in dates]
+            compare = DATE_COMPARISONS[op]
+            keep = [k and compare(d, v) for k, d in zip(keep, padded[padding])]
+        return set(uri for (uri, d), k in zip(rows, keep) if k)
 
-            if len(self.dateFilters) == 0:
-                for v in results:
-                    keys_used |= (set(v.keys()))
-                    result_uris |= (set(v.values()))
+    def sparqlFilter(self, var="?d"):
+        """The same comparisons as a SPARQL 1.1 FILTER on var"""
+        return "FILTER(%s)" % " && ".join([
+            'CONCAT(STR(%s), SUBSTR("%s", STRLEN(STR(%s)) + 1)) %s %s' % (
+                var, padding, var, op, Literal(v).n3())
+            for op, v, padding in self.bounds])
 
-                assert not keys_used or keys_used == set('v'), \
-                    "Expected only ONE selected term:  'v', a clinical statement URI"
 
-                return result_uris
-            else:
-                for v in results:
-                    keys_used |= (set(v.keys()))
-                    values = list(v.values())
-                    if (self.dateInRange(str(values[0]))):
-                        result_uris |= (set([values[1]]))
+def pushesDownDateFilters(triplestore):
+    """Whether date ranges can be evaluated by the store (SPARQL 1.1)"""
+    return getattr(triplestore, 'supports_query_planner', False) and \
+        settings.TRIPLESTORE.get('date_filter_pushdown', True)
 
-                assert not keys_used or keys_used == set(('v', 'd')), \
-                    "Expected only TWO selected terms:  'v', a clinical statement URI, and 'd', a date/time string"
 
-                return result_uris
+class FilterSet(object):
+    def __init__(self, smart_type=None):
+        self.smart_type = smart_type
+        self.filters = []
+        if smart_type:
+            self.filters = smart_type.filters
+        self.compiled = [CompiledFilter(f) for f in self.filters]
+        self.shapes = {}
+
+    def shape(self, key):
+        shape = self.shapes.get(key)
+        if shape is None:
+            if len(self.shapes) >= MAX_SHAPES:
+                self.shapes.clear()
+            shape = self.shapes[key] = compileShape(self.compiled, key)
+        return shape
+
+    def getClauses(self, query_params):
+        """The WHERE clauses for the request's filters, as one string.
+
+        Requests using the same filters with the same number of values
+        share a compiled shape; only the escaped values are filled in.
+        """
+        key, values = [], []
+        for i, f in enumerate(self.compiled):
+            if f.name in query_params:
+                vv = query_params[f.name].split("|")
+                key.append((i, len(vv)))
+                for v in vv:
+                    values.extend([v] * (len(f.parts) // 2))
+
+        if not key:
+            return u""
+        return renderShape(self.shape(tuple(key)), values)
+
+    def usesDateFilters(self, query_params):
+        return any(f.client_parameter_name in DATE_FILTERS and
+                   f.client_parameter_name in query_params
+                   for f in self.filters)
+
+    def dateBounds(self, query_params):
+        """DateBounds for the request's date filters (the last of several
+        |-separated values counts)"""
+        date_filters = {}
+        for f in self.filters:
+            k = f.client_parameter_name
+            if k in DATE_FILTERS and k in query_params:
+                date_filters[k] = query_params[k].split("|")[-1]
+        return DateBounds(date_filters)
+
+    def getQuery(self, query_params, bounds=None, pushdown=False, scope=None):
+        clauses = self.getClauses(query_params)
+
+        if clauses:
+            selects = "?v ?d" if bounds and not pushdown else "DISTINCT ?v"
+            where = clauses
+            if scope:
+                where = scope + "\n" + where
+            if bounds and pushdown:
+                where += "\n" + bounds.sparqlFilter()
+            return """
+                PREFIX sp:<http://smartplatforms.org/terms#>
+                PREFIX dcterms:<http://purl.org/dc/terms/>
+                SELECT %s
+                {%s}
+                """ % (selects, where)
+
+        return None
+
+    def __call__(self, triplestore, candidate_uris, query_params, type_node=None):
+        bounds = self.dateBounds(query_params)
+        pushdown = bool(bounds) and pushesDownDateFilters(triplestore)
+
+        scoped = candidates.scoped(candidate_uris)
+        query = self.getQuery(query_params, bounds, pushdown,
+                              scoped and candidates.scope("?v", type_node) or None)
+        if not query:
+            return candidate_uris
+
+        if scoped:
+            results = triplestore.select(query)
+        else:
+            results = candidates.select(triplestore, query, "?v", candidate_uris)
+
+        if bounds and not pushdown:
+            ret = bounds.filterRows([(r['v'], r['d']) for r in results
+                                     if 'v' in r and 'd' in r])
         else:
-            return  candidate_uris
+            ret = set(r['v'] for r in results if 'v' in r)
+        if scoped:
+            ret &= set(candidate_uris)
+        return ret
 
 
 class Paginator (object):
@@ -156,6 +314,70 @@ class Paginator (object):
         else:
             return []
 
+    def sortedPage(self, triplestore, uris, limit, offset):
+        """Returns (page_uris, total) without sorting the whole list here.
+
+        The store counts the sortable candidates, then sorts and slices
+        them with ORDER BY/LIMIT/OFFSET, so only the page itself comes
+        back.  The candidates go out with both queries (the page one is
+        skipped when the offset is past the end).  Ordering needs the
+        whole set in one query, so it is listed inline whatever the
+        candidate strategy.
+        """
+        if not uris:
+            return [], 0
+
+        values = candidates.bindings("?uri", uris)
+        q = """PREFIX sp:<http://smartplatforms.org/terms#>
+                PREFIX dcterms:<http://purl.org/dc/terms/>
+                SELECT (COUNT(*) AS ?total) WHERE {
+                   SELECT DISTINCT ?uri ?sortParam WHERE {
+                      ?uri %s ?sortParam .
+                   }
+                }""" % self.by_rdf_term
+        results = triplestore.select(q + values)
+        total = results and int(results[0]['total']) or 0
+        if total <= offset:
+            return [], total
+
+        q = """PREFIX sp:<http://smartplatforms.org/terms#>
+                PREFIX dcterms:<http://purl.org/dc/terms/>
+                SELECT DISTINCT ?uri ?sortParam WHERE{
+                   ?uri %s ?sortParam .
+                } ORDER BY DESC (?sortParam) ASC (?uri)
+                LIMIT %d OFFSET %d""" % (self.by_rdf_term, limit, offset)
+        results = triplestore.select(q + values)
+        return [item['uri'] for item in results], total
+
+    def keysetPage(self, triplestore, uris, limit, after=None):
+        """Returns ([(uri, sortParam)...], more_p) for the page after a cursor.
+
+        Rather than skipping `offset` rows, the store seeks straight past the
+        last (sortParam, uri) key of the previous page, so deep pages cost the
+        same as the first one and don't shift when statements are added.
+        """
+        if not uris:
+            return [], False
+
+        q = """PREFIX sp:<http://smartplatforms.org/terms#>
+                PREFIX dcterms:<http://purl.org/dc/terms/>
+                SELECT DISTINCT ?uri ?sortParam WHERE{
+                   ?uri %s ?sortParam .
+                   %s
+                } ORDER BY DESC (?sortParam) ASC (?uri)
+                LIMIT %d""" % (self.by_rdf_term, self.keysetFilter(after, "?uri"), limit + 1)
+        results = triplestore.select(q + candidates.bindings("?uri", uris))
+        page = [(item['uri'], item['sortParam']) for item in results]
+        return page[:limit], len(page) > limit
+
+    def keysetFilter(self, after, uri_var):
+        if after is None:
+            return ""
+        sort_value, uri = after
+        return """FILTER(?sortParam < %s ||
+                          (?sortParam = %s && STR(%s) > %s))""" % (
+            sort_value.n3(), sort_value.n3(), uri_var, Literal(uri).n3())
+
     def parseParams(self, params):
         try:
             limit = int(params['limit'])
@@ -176,40 +398,109 @@ class Paginator (object):
 
 
 class SimplePaginator(Paginator):
+    def addPageMeta(self, params, path, meta, page_uris, total, limit, offset):
+        meta['resultOrder'] = page_uris
+        if (offset + limit < total):
+            # an empty cursor= is ignored, and not carried over
+            params.pop('cursor', None)
+            params['offset'] = offset + limit
+            params['limit'] = limit
+            args = "&".join(["%s=%s" % (k, params[k]) for k in params.keys()])
+            meta['nextPageURL'] = "%s%s?%s" % (settings.SITE_URL_PREFIX, path, args)
+
+    def addCursorMeta(self, params, path, meta, page, more, limit):
+        meta['resultOrder'] = [uri for (uri, sort_value) in page]
+        if more:
+            params.pop('offset', None)
+            params['cursor'] = encodeCursor(*page[-1])
+            params['limit'] = limit
+            args = "&".join(["%s=%s" % (k, params[k]) for k in params.keys()])
+            meta['nextPageURL'] = "%s%s?%s" % (settings.SITE_URL_PREFIX, path, args)
+
     def __call__(self, triplestore, candidate_uris, params, path, meta):
         limit, offset = self.parseParams(params)
+        if limit and hasCursor(params):
+            page, more = self.keysetPage(triplestore, candidate_uris, limit,
+                                         decodeCursor(params['cursor']))
+            self.addCursorMeta(params, path, meta, page, more, limit)
+            return set(meta['resultOrder'])
         if limit:
-            sorted_uris = self.sortedList(triplestore, candidate_uris)
-            page_uris = sorted_uris[offset: offset + limit]
-            meta['resultOrder'] = page_uris
-            if (offset + limit < len(sorted_uris)):
-                params['offset'] = offset + limit
-                params['limit'] = limit
-                args = "&".join(["%s=%s" % (k, params[k]) for k in params.keys()])
-                meta['nextPageURL'] = "%s%s?%s" % (settings.SITE_URL_PREFIX, path, args)
+            page_uris, total = self.sortedPage(triplestore, candidate_uris, limit, offset)
+            self.addPageMeta(params, path, meta, page_uris, total, limit, offset)
             return set(page_uris)
         else:
             return super(SimplePaginator, self).__call__(triplestore, candidate_uris, params, path, meta)
 
-PAGINATORS = defaultdict(lambda: Paginator(None))
-FILTERS = defaultdict(lambda: FilterSet())
 
-for c in SMART_API_Call.store.values():
-    if c.filters:
-        FILTERS[c.target] = FilterSet(c)
-    if c.default_sort:
-        PAGINATORS[c.target] = SimplePaginator(str(c.default_sort))
+def hasCursor(params):
+    """Whether params ask for cursor pagination (an empty cursor= doesn't)"""
+    return bool(params.get('cursor'))
+
+
+def encodeCursor(uri, sort_value):
+    """Opaque, URL-safe token for the (sortParam, uri) key of a page's last row"""
+    key = [unicode(sort_value), getattr(sort_value, 'datatype', None),
+           getattr(sort_value, 'language', None), unicode(uri)]
+    return base64.urlsafe_b64encode(json.dumps(key)).rstrip("=")
+
+
+def decodeCursor(token):
+    """Returns the (sortParam, uri) key, or None to start from the first page"""
+    try:
+        token = str(token)
+        value, datatype, lang, uri = json.loads(
+            base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (TypeError, ValueError):
+        return None
+
+    if UNSAFE_IRI_CHARS.search(uri) or \
+            (datatype and UNSAFE_IRI_CHARS.search(datatype)):
+        return None
+    return Literal(value, datatype=datatype, lang=lang), URIRef(uri)
+
+
+class TypeTable(dict):
+    """Per-type objects, built from the ontology snapshot on first lookup"""
+    def __init__(self, build):
+        super(TypeTable, self).__init__()
+        self.build = build
+
+    def __missing__(self, target):
+        value = self.build(ontology_snapshot.type_spec(target))
+        self[target] = value
+        return value
+
+
+def buildFilterSet(spec):
+    if spec and spec.filters:
+        return FilterSet(spec)
+    return FilterSet()
+
+
+def buildPaginator(spec):
+    if spec and spec.default_sort:
+        return SimplePaginator(spec.default_sort)
+    return Paginator(None)
+
+
+PAGINATORS = TypeTable(buildPaginator)
+FILTERS = TypeTable(buildFilterSet)
 
 
 def runFiltering(triplestore, obj, uris, query_params):
     f = FILTERS[obj.node]
-    return f(triplestore, uris, query_params)
+    return f(triplestore, uris, query_params, obj.node)
 
 
-def runPagination(triplestore, obj, uris, query_params, path, meta):
+def paramDict(query_params):
     param_dict = {}
     for k in query_params:
         param_dict[k] = query_params[k]
+    return param_dict
+
+
+def runPagination(triplestore, obj, uris, query_params, path, meta):
+    param_dict = paramDict(query_params)
 
     p = PAGINATORS[obj.node]
     return p(triplestore, uris, param_dict, path, meta)
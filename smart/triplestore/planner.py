@@ -0,0 +1,175 @@
+"""
+Query planner for TripleStore.get_objects
+
+The step-by-step path (statement lookup, filtering, pagination, neighbor
+expansion, context fetch) ships every intermediate URI set back to the
+store as a BINDINGS block.  When the store speaks SPARQL 1.1, the whole
+pipeline is compiled into two queries instead: one returning the total
+counts together with the requested page, and one CONSTRUCT that
+re-evaluates the page as a subselect and expands it to its neighboring
+statements inside the store.
+"""
+
+from base import *
+from filters import FILTERS, PAGINATORS, SimplePaginator, paramDict, decodeCursor, \
+    hasCursor, pushesDownDateFilters
+import candidates
+
+PREFIXES = """PREFIX sp:<http://smartplatforms.org/terms#>
+PREFIX dcterms:<http://purl.org/dc/terms/>
+"""
+
+
+def enabled(triplestore):
+    return getattr(triplestore, 'supports_query_planner', False) and \
+        settings.TRIPLESTORE.get('query_planner', True)
+
+
+class QueryPlan(object):
+    def __init__(self, obj, clauses, sort_term=None, limit=None, offset=0,
+                 keyset=False, after=None, date_filter=None):
+        self.obj = obj
+        self.clauses = clauses
+        self.date_filter = date_filter
+        self.sort_term = sort_term
+        self.limit = limit
+        self.offset = offset
+        self.keyset = keyset
+        self.after = after
+
+    @property
+    def paged(self):
+        return bool(self.sort_term and self.limit)
+
+    def statements(self):
+        """Graph pattern binding ?v to each matching statement in $record"""
+        ret = "\n" + candidates.scope("?v", self.obj.node)
+        if self.clauses:
+            ret += "\n" + str(self.clauses)
+        if self.date_filter:
+            ret += "\n" + self.date_filter
+        return ret
+
+    def page(self, lookahead=0):
+        """Subselect binding ?v to each statement on the requested page"""
+        if not self.paged:
+            return "SELECT DISTINCT ?v WHERE {%s\n}" % self.statements()
+
+        if self.keyset:
+            return """SELECT DISTINCT ?v ?sortParam WHERE {%s
+                ?v %s ?sortParam .
+                %s
+            } ORDER BY DESC(?sortParam) ASC(?v) LIMIT %d""" % (
+                self.statements(), self.sort_term,
+                PAGINATORS[self.obj.node].keysetFilter(self.after, "?v"),
+                self.limit + lookahead)
+
+        return """SELECT DISTINCT ?v ?sortParam WHERE {%s
+                ?v %s ?sortParam .
+            } ORDER BY DESC(?sortParam) ASC(?v) LIMIT %d OFFSET %d""" % (
+            self.statements(), self.sort_term, self.limit + lookahead, self.offset)
+
+    def summary_query(self):
+        """Total and sortable counts, joined with the ordered page (if any)"""
+        if not self.paged:
+            return PREFIXES + """SELECT (COUNT(DISTINCT ?v) AS ?total) WHERE {%s
+            }""" % self.statements()
+
+        if self.keyset:
+            # one row past the page tells whether there is a next page
+            return PREFIXES + """SELECT ?total ?v ?sortParam WHERE {
+                { SELECT (COUNT(DISTINCT ?v) AS ?total) WHERE {%s
+                } }
+                OPTIONAL { { %s } }
+            } ORDER BY DESC(?sortParam) ASC(?v)""" % (
+                self.statements(), self.page(lookahead=1))
+
+        # the subselect's ordering is lost in the join, so order again
+        return PREFIXES + """SELECT ?total ?sorted ?v WHERE {
+            { SELECT (COUNT(DISTINCT ?v) AS ?total) WHERE {%s
+            } }
+            { SELECT (COUNT(*) AS ?sorted) WHERE {
+                SELECT DISTINCT ?v ?sortParam WHERE {%s
+                    ?v %s ?sortParam .
+                }
+            } }
+            OPTIONAL { { %s } }
+        } ORDER BY DESC(?sortParam) ASC(?v)""" % (
+            self.statements(), self.statements(), self.sort_term, self.page())
+
+    def construct_query(self):
+        page = self.page()
+        return PREFIXES + """CONSTRUCT { ?s ?p ?o . }
+        WHERE {
+            { SELECT DISTINCT ?c WHERE {
+                { { %s }
+                  BIND(?v AS ?c) }
+                UNION
+                { { %s }
+                  GRAPH ?v { ?v ?vp ?c . }
+                  GRAPH ?c { ?c a ?ctype . }
+                  FILTER(?ctype != sp:MedicalRecord) }
+            } }
+            GRAPH ?c { ?s ?p ?o . }
+        }""" % (page, page)
+
+
+def build_plan(triplestore, obj, queries):
+    """Returns a QueryPlan for the request, or None if one can't be made."""
+    filters = FILTERS[obj.node]
+    bounds = filters.dateBounds(queries)
+    if bounds and not pushesDownDateFilters(triplestore):
+        # date ranges have to be evaluated in python
+        return None
+
+    paginator = PAGINATORS[obj.node]
+    limit, offset = paginator.parseParams(queries)
+    sort_term = None
+    if isinstance(paginator, SimplePaginator):
+        sort_term = paginator.by_rdf_term
+
+    keyset = hasCursor(queries)
+    after = keyset and decodeCursor(queries['cursor']) or None
+
+    return QueryPlan(obj, filters.getClauses(queries), sort_term, limit, offset,
+                     keyset, after, bounds and bounds.sparqlFilter() or None)
+
+
+def get_objects(triplestore, path, queries, obj):
+    """Planned equivalent of TripleStore.get_objects.
+
+    Returns a (chunks, meta) tuple, chunks being an iterator over the
+    RDF/XML, or None when the request needs the step-by-step path.
+    """
+    plan = build_plan(triplestore, obj, queries)
+    if plan is None:
+        return None
+
+    meta = {}
+    results = triplestore.select(plan.summary_query())
+    if not results or int(results[0]['total']) == 0:
+        return [Graph().serialize(format="xml")], None
+
+    meta['totalResultCount'] = int(results[0]['total'])
+    page_uris = [r['v'] for r in results if 'v' in r]
+
+    if plan.paged and plan.keyset:
+        page = [(r['v'], r['sortParam']) for r in results if 'v' in r]
+        PAGINATORS[obj.node].addCursorMeta(paramDict(queries), path, meta,
+                                           page[:plan.limit],
+                                           len(page) > plan.limit, plan.limit)
+        page_uris = meta['resultOrder']
+        meta['resultsReturned'] = len(set(page_uris))
+        if not page_uris:
+            return [Graph().serialize(format="xml")], None
+    elif plan.paged:
+        PAGINATORS[obj.node].addPageMeta(paramDict(queries), path, meta,
+                                         page_uris, int(results[0]['sorted']),
+                                         plan.limit, plan.offset)
+        meta['resultsReturned'] = len(set(page_uris))
+        if not page_uris:
+            return [Graph().serialize(format="xml")], None
+    else:
+        meta['resultsReturned'] = meta['totalResultCount']
+
+    return triplestore.sparql_stream(plan.construct_query()), meta
@@ -1,7 +1,14 @@
 from base import *
+import logging
+
+from smart.lib import rdf_stream
+import candidates
 
 
 class SesameConnector(object):
+    # SPARQL 1.1 subselects and aggregates are available
+    supports_query_planner = True
+
     def __init__(self, endpoint=None):
         self.context = None
         self.pending_removes = ConjunctiveGraph()
@@ -30,11 +37,16 @@ class SesameConnector(object):
             self._sesame_serialize_node(st[2]),
         )
 
-    def _serialize_flat(self, g):
-        return "\n     ".join([" ".join(map(lambda x: x.n3(), s)) + "." for s in g])
+    def _request(self, url, method, headers, data=None, idempotent=None):
+        return utils.pooled_url_request(url, method, headers, data, idempotent)
+
+    def _request_stream(self, url, method, headers, chunks):
+        return utils.pooled_url_stream(url, method, headers, chunks)
 
-    def _request(self, url, method, headers, data=None):
-        return utils.url_request(url, method, headers, data)
+    def _request_iter(self, url, method, headers, data=None, idempotent=None):
+        chunk_size = settings.TRIPLESTORE.get('stream_chunk_bytes',
+                                              rdf_stream.DEFAULT_CHUNK_SIZE)
+        return utils.pooled_url_iter(url, method, headers, data, chunk_size, idempotent)
 
     def add_conjunctive_graph(self, cg):
         return self.replace_conjunctive_graph(cg, drop=False)
@@ -53,14 +65,14 @@ class SesameConnector(object):
     def sparql_update(self, q):
         u = self.endpoint + "/statements"
         st = time.time()
-        print "Updating", len(q)
+        logging.debug("Updating %s" % len(q))
         res = self._request(
             u,
             "POST",
             {"Content-type": "application/x-www-form-urlencoded"},
             urllib.urlencode({"update": q})
         )
-        print "results in ", (time.time() - st)  # , res
+        logging.debug("update results in %s" % (time.time() - st))
         return res
 
     def sparql(self, q):
@@ -74,7 +86,8 @@ class SesameConnector(object):
         }
         data = urllib.urlencode({"query": q})
         try:
-            res = self._request(u, "POST", headers, data)
+            # a query changes nothing, so it's safe to send again
+            res = self._request(u, "POST", headers, data, idempotent=True)
             #print "results in ", (time.time() - st)
             return res
         except Exception, e:
@@ -91,22 +104,119 @@ class SesameConnector(object):
         self._clear_transaction()
         self.tx = True
 
-    def transaction_commit(self):
-        assert self.tx, "Can't commit a transaction that wasn't initiated"
+    def sparql_stream(self, q):
+        """Like sparql, but returns an iterator over the response body"""
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "application/rdf+xml, application/sparql-results+json"
+        }
+        return self._request_iter(self.endpoint, "POST", headers,
+                                  urllib.urlencode({"query": q}), idempotent=True)
 
-        drops = []
-        for c in self.pending_clears:
-            drops.append("DROP GRAPH %s;\n" % c.n3())
-        if len(drops) > 0:
-            self.sparql_update("\n".join(drops))
+    def sparql_update_stream(self, chunks):
+        """Posts an update whose text is produced piecewise by chunks(),
+        form-encoded as the update parameter, like sparql_update"""
+        def body():
+            yield "update="
+            for chunk in chunks():
+                yield urllib.quote_plus(chunk)
 
-        for g in self.pending_adds.contexts():
-            q = "INSERT DATA { GRAPH %s {\n     %s }}" % (g.identifier.n3(), self._serialize_flat(g))
-            self.sparql_update(q)
+        u = self.endpoint + "/statements"
+        st = time.time()
+        res = self._request_stream(
+            u,
+            "POST",
+            {"Content-type": "application/x-www-form-urlencoded"},
+            body
+        )
+        logging.debug("streamed update results in %s" % (time.time() - st))
+        return res
 
-        for g in self.pending_removes.contexts():
-            q = "DROP DATA { GRAPH %s {\n     %s } }" % (g.identifier.n3(), self._serialize_flat(g))
-            self.sparql_update(q)
+    def _update_operations(self):
+        """(verb, target) pairs, in the order they have to be applied"""
+        ret = [("DROP", c) for c in self.pending_clears]
+        ret += [("INSERT", g) for g in self.pending_adds.contexts()]
+        ret += [("DELETE", g) for g in self.pending_removes.contexts()]
+        return ret
+
+    def _update_text(self, operations, max_bytes, cursor):
+        """Yields the text of one update request, carrying on from cursor.
+
+        cursor is an [operation index, iterator over that graph's triples
+        or None, triple line read but not yet written] list.  The text is
+        cut at the first operation or triple boundary past max_bytes of
+        update text, before form encoding (0 for no limit), and cursor is left where the next request starts (its
+        index None once everything has been written), so each graph is
+        walked once however many requests it's spread over.
+        """
+        op_i, triples, pending = cursor
+        size = 0
+        while op_i < len(operations):
+            verb, target = operations[op_i]
+            sep = size and ";\n" or ""
+
+            if verb == "DROP":
+                text = sep + "DROP GRAPH %s" % rdf_stream.nt_term(target)
+                if size and max_bytes and size + len(text) > max_bytes:
+                    break
+                size += len(text)
+                yield text
+                op_i += 1
+                continue
+
+            head = sep + "%s DATA { GRAPH %s {\n" % (verb, rdf_stream.nt_term(target))
+            if size and max_bytes and size + len(head) > max_bytes:
+                break
+            if triples is None:
+                triples = iter(target)
+            size += len(head)
+            yield head
+
+            written = 0
+            while True:
+                if pending is None:
+                    s = next(triples, None)
+                    if s is None:
+                        break
+                    pending = rdf_stream.nt_line(s)
+                if written and max_bytes and size + len(pending) > max_bytes:
+                    break
+                size += len(pending)
+                written += 1
+                yield pending
+                pending = None
+            yield " }}"
+            size += 3
+
+            if pending is not None:
+                # cut inside this graph
+                break
+            op_i += 1
+            triples = None
+
+        cursor[:] = [op_i if op_i < len(operations) else None, triples, pending]
+
+    def transaction_commit(self):
+        assert self.tx, "Can't commit a transaction that wasn't initiated"
+
+        # 0: no limit, the whole transaction goes out as one streamed request
+        max_bytes = settings.TRIPLESTORE.get('update_batch_bytes', 1024 * 1024)
+        chunk_size = settings.TRIPLESTORE.get('stream_chunk_bytes',
+                                              rdf_stream.DEFAULT_CHUNK_SIZE)
+
+        operations = self._update_operations()
+        if operations and not max_bytes:
+            # a retry walks the graphs again from the start
+            self.sparql_update_stream(lambda: rdf_stream.rechunk(
+                self._update_text(operations, 0, [0, None, None]), chunk_size))
+        elif operations:
+            cursor = [0, None, None]
+            while cursor[0] is not None:
+                # a request's text is kept (it's at most about max_bytes),
+                # so a retry can send it again
+                text = list(self._update_text(operations, max_bytes, cursor))
+                self.sparql_update_stream(
+                    lambda text=text: rdf_stream.rechunk(iter(text), chunk_size))
 
         self._clear_transaction()
 
@@ -128,33 +238,60 @@ class SesameConnector(object):
 
         return ret
 
-    def expand_to_neighboring_statements(self, limit_to_statements):
+    def expand_to_neighboring_statements(self, limit_to_statements, type_node=None):
         q = """prefix : <http://smartplatforms.org/terms#>
                select distinct ?g ?g2 where {
-                graph $record {
-                     $record :hasStatement ?g.
-                } OPTIONAL {
+                %s
+                OPTIONAL {
                       graph ?g {?g ?p ?g2.}
                       graph ?g2 {?g2 a ?g2type.}
                       filter(?g2type != :MedicalRecord)
                    }
             }"""
-        if limit_to_statements:
-            q += """ BINDINGS ?g {(""" + ")(".join([
-                x.n3() for x in limit_to_statements
-            ]) + """)} """
-
-        results = self.select(q)
+        if not limit_to_statements:
+            results = self.select(q % candidates.scope("?g"))
+        elif candidates.scoped(limit_to_statements):
+            # type_node: every statement in limit_to_statements is of that type
+            wanted = set(limit_to_statements)
+            results = [b for b in self.select(q % candidates.scope("?g", type_node))
+                       if b.get('g') in wanted]
+        else:
+            results = candidates.select(self, q % candidates.scope("?g"), "?g",
+                                        limit_to_statements)
         ret = set([item for binding in results for item in binding.values()])
 
         return ret
 
     def get_contexts(self, bindings):
-
         if len(bindings) == 0:
             g = ConjunctiveGraph()
             return g.serialize(format="xml")
+        if len(candidates.chunked(bindings)) > 1:
+            return self.get_contexts_chunked(bindings)
+        return self.sparql(self.contexts_query(bindings))
+
+    def get_contexts_stream(self, bindings):
+        if len(bindings) == 0:
+            return iter([ConjunctiveGraph().serialize(format="xml")])
+        if len(candidates.chunked(bindings)) > 1:
+            return iter([self.get_contexts_chunked(bindings)])
+        return self.sparql_stream(self.contexts_query(bindings))
+
+    def get_contexts_chunked(self, bindings):
+        """get_contexts for a large set of graphs: one CONSTRUCT per chunk,
+        run in parallel, merged into a single RDF/XML document"""
+        def fetch(chunk):
+            res = self.sparql(self.contexts_query(chunk))
+            if res is None:
+                raise Exception("Couldn't fetch %d of the contexts" % len(chunk))
+            return res
 
+        g = Graph()
+        for res in candidates.map_chunks(fetch, bindings):
+            g += parse_rdf(res)
+        return g.serialize(format="xml")
+
+    def contexts_query(self, bindings):
         q = """    PREFIX : <http://smartplatforms.org/terms#>
         CONSTRUCT{
             ?s ?p ?o.
@@ -165,11 +302,7 @@ class SesameConnector(object):
             }
         }"""
 
-        q += """ BINDINGS ?g {(""" + ")(".join([
-            x.n3() for x in bindings
-        ]) + """)} """
-
-        return self.sparql(q)
+        return q + candidates.bindings("?g", bindings)
 
 
 connector = SesameConnector
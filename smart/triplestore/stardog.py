@@ -2,6 +2,7 @@
 Experimental support for the stardog triplestore.  
 """
 from base import *
+from smart.lib import rdf_stream
 
 class StardogConnector(object):
     def __init__(self, endpoint=None):
@@ -17,7 +18,7 @@ class StardogConnector(object):
         self.auth = "Basic "+base64.b64encode("%s:%s"%(user, password))
  
 
-    def _request(self, url, method, headers=None, data=None):
+    def _request(self, url, method, headers=None, data=None, idempotent=None):
         if headers == None: 
             headers = {}
 
@@ -25,7 +26,7 @@ class StardogConnector(object):
             headers["Authorization"] = "Basic "+base64.b64encode("admin:admin")
 
         #print url, method, headers, data 
-        return utils.url_request(url, method, headers, data)
+        return utils.pooled_url_request(url, method, headers, data, idempotent)
 
     def add_conjunctive_graph(self, cg):
         return replace_conjunctive_graph(cg, drop=False)
@@ -52,17 +53,40 @@ class StardogConnector(object):
 
         accept = "application/rdf+xml, application/sparql-results+json"
 
+        # a query changes nothing, so it's safe to send again
         res = self._request(u, "POST", {"Content-type": "application/x-www-form-urlencoded", 
-                                        "Accept" : accept}, data)
+                                        "Accept" : accept}, data, idempotent=True)
         #print "results in ", (time.time() - st)#,res
         return res
             
-    def _transaction_step(self, graph, url):
-        if isinstance(graph.identifier, URIRef):
-            param = urllib.urlencode({"graph-uri": (graph.identifier)})
-            url = url + "?" + param
-        data = graph.serialize(format="xml")
-        self._request(url, "POST", {"Content-type": "application/rdf+xml"}, data)
+    def sparql_stream(self, q):
+        """Like sparql, but returns an iterator over the response body"""
+        accept = "application/rdf+xml, application/sparql-results+json"
+        return self._request_iter(self.endpoint+"/query", "POST",
+                                  {"Content-type": "application/x-www-form-urlencoded",
+                                   "Accept" : accept},
+                                  urllib.urlencode({"query" : q}), idempotent=True)
+
+    def _request_stream(self, url, method, headers, chunks):
+        if "Authorization" not in headers:
+            headers["Authorization"] = "Basic "+base64.b64encode("admin:admin")
+        return utils.pooled_url_stream(url, method, headers, chunks)
+
+    def _request_iter(self, url, method, headers, data=None, idempotent=None):
+        if "Authorization" not in headers:
+            headers["Authorization"] = "Basic "+base64.b64encode("admin:admin")
+        chunk_size = settings.TRIPLESTORE.get('stream_chunk_bytes',
+                                              rdf_stream.DEFAULT_CHUNK_SIZE)
+        return utils.pooled_url_iter(url, method, headers, data, chunk_size, idempotent)
+
+    def _transaction_step(self, cg, url):
+        # every pending graph goes out in one N-Quads body, streamed in chunks
+        if len(cg) == 0:
+            return
+        chunk_size = settings.TRIPLESTORE.get('stream_chunk_bytes',
+                                              rdf_stream.DEFAULT_CHUNK_SIZE)
+        self._request_stream(url, "POST", {"Content-type": "text/x-nquads"},
+                             lambda: rdf_stream.iter_nquads(cg, chunk_size))
 
     def _clear_transaction(self):
         self.pending_adds.remove((None,None,None)) 
@@ -81,11 +105,8 @@ class StardogConnector(object):
         for clearuri in self.pending_clears:
             self._request(self.endpoint+"/%s/clear?%s"%(self.tx, urllib.urlencode({"graph-uri": str(clearuri)})), "POST")
         
-        for g in self.pending_adds.contexts():
-            self._transaction_step( graph=g, url=self.endpoint+"/%s/add"%self.tx )
-
-        for g in self.pending_removes.contexts():
-            self._transaction_step( graph=g, url=self.endpoint+"/%s/remove"%self.tx )
+        self._transaction_step( cg=self.pending_adds, url=self.endpoint+"/%s/add"%self.tx )
+        self._transaction_step( cg=self.pending_removes, url=self.endpoint+"/%s/remove"%self.tx )
 
         endtx = self._request(self.endpoint+"/transaction/commit/%s"%self.tx, "POST")
         print "committed tx", self.tx
@@ -127,6 +148,12 @@ class StardogConnector(object):
         return ret
 
     def get_contexts(self, bindings):
+        return self.sparql(self.contexts_query(bindings))
+
+    def get_contexts_stream(self, bindings):
+        return self.sparql_stream(self.contexts_query(bindings))
+
+    def contexts_query(self, bindings):
         q = """    PREFIX : <http://smartplatforms.org/terms#>
         CONSTRUCT{
             ?s ?p ?o. 
@@ -142,7 +169,6 @@ class StardogConnector(object):
           ?s ?p ?o.
         }"""%b.n3() for b in bindings])
 
-        q = q.replace("$unions", repl)
-        return self.sparql(q)
+        return q.replace("$unions", repl)
        
 connector = StardogConnector
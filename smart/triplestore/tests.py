@@ -0,0 +1,803 @@
+"""
+Tests for the triplestore layer's pure-python parts
+
+These don't talk to a store: the response cache is exercised with fake
+fetches, and query text is checked as a string.
+"""
+
+import base64
+import json
+import threading
+import urlparse
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.http import HttpResponse
+from rdflib import ConjunctiveGraph, Literal, URIRef
+import unittest
+
+from smart.lib.ontology_snapshot import CallFilter, TypeSpec
+from smart.lib.rdf_stream import nt_line
+from smart.lib.view_decorators import record_version_etag
+from smart.models import Record
+from cache import LocalBackend, ResponseCache, SharedBackend
+from filters import DATE_LB, DATE_UB, DateBounds, FilterSet, SimplePaginator, padDate, \
+    compileTemplate, decodeCursor, encodeCursor, escapeBare, escapeIRI, escapeString, hasCursor
+import candidates
+import filters
+import planner
+import triplestore
+from sesame import SesameConnector
+
+
+class FakeObject(object):
+    def __init__(self, node):
+        self.node = node
+
+
+class FakeStore(object):
+    """Answers every select with rows (or with rows(query), if it's
+    callable), and keeps the queries it's sent"""
+    def __init__(self, rows, supports_query_planner=False):
+        self.rows = rows
+        self.supports_query_planner = supports_query_planner
+        self.queries = []
+
+    def select(self, q):
+        self.queries.append(q)
+        if callable(self.rows):
+            return self.rows(q)
+        return self.rows
+
+
+def filter_set(**templates):
+    return FilterSet(TypeSpec([CallFilter(name, Literal(sparql))
+                               for name, sparql in sorted(templates.items())]))
+
+
+class TriplestoreSettingsMixin(object):
+    """Runs each test with the given settings.TRIPLESTORE entries"""
+    triplestore_settings = {}
+
+    def setUp(self):
+        self.saved_triplestore = dict(settings.TRIPLESTORE)
+        settings.TRIPLESTORE.update(self.triplestore_settings)
+
+    def tearDown(self):
+        settings.TRIPLESTORE.clear()
+        settings.TRIPLESTORE.update(self.saved_triplestore)
+
+
+MEDICATION = FakeObject("http://smartplatforms.org/terms#Medication")
+PATH = "/records/123/medications/"
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(LocalBackend())
+        self.fetches = 0
+
+    def fetch(self, chunks=("<rdf:RDF>", "</rdf:RDF>")):
+        def run():
+            self.fetches += 1
+            for c in chunks:
+                yield c
+        return run
+
+    def get(self, version, record_id="123", queries=None, fetch=None):
+        return "".join(self.cache.get_objects_stream(
+            record_id, version, PATH, queries or {}, MEDICATION, None,
+            fetch or self.fetch()))
+
+    def test_hit_after_complete_read(self):
+        self.assertEqual(self.get(1), "<rdf:RDF></rdf:RDF>")
+        self.assertEqual(self.get(1), "<rdf:RDF></rdf:RDF>")
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.stats()[MEDICATION.node], {'hits': 1, 'misses': 1})
+
+    def test_new_version_misses(self):
+        self.get(1)
+        self.get(2)
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_version_bypasses(self):
+        self.get(None)
+        self.get(None)
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.cache.stats(), {})
+
+    def test_query_params_are_part_of_the_key(self):
+        self.get(1, queries={'limit': '10', 'offset': '0'})
+        self.get(1, queries={'offset': '0', 'limit': '10'})
+        self.get(1, queries={'limit': '10', 'offset': '10'})
+        self.assertEqual(self.fetches, 2)
+
+    def test_partial_read_is_not_cached(self):
+        chunks = self.cache.get_objects_stream("123", 1, PATH, {}, MEDICATION, None,
+                                               self.fetch())
+        chunks.next()
+        chunks.close()
+        self.get(1)
+        self.assertEqual(self.fetches, 2)
+
+    def test_oversized_response_is_not_cached(self):
+        self.cache.max_entry_bytes = 4
+        self.get(1)
+        self.get(1)
+        self.assertEqual(self.fetches, 2)
+
+    def test_invalidate_only_drops_that_record(self):
+        self.get(1, record_id="123")
+        self.get(1, record_id="456")
+        self.cache.invalidate("123")
+        self.get(1, record_id="123")
+        self.get(1, record_id="456")
+        self.assertEqual(self.fetches, 3)
+        self.assertEqual(self.cache.backend.size, 2 * len("<rdf:RDF></rdf:RDF>"))
+
+    def test_disabled_cache_always_fetches(self):
+        self.cache = ResponseCache()
+        self.get(1)
+        self.get(1)
+        self.assertEqual(self.fetches, 2)
+
+
+class LocalBackendTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        b = LocalBackend(max_entries=2)
+        b.set("1", ("a",), "x")
+        b.set("1", ("b",), "y")
+        b.get("1", ("a",))
+        b.set("1", ("c",), "z")
+        self.assertEqual(b.get("1", ("b",)), None)
+        self.assertEqual(b.get("1", ("a",)), "x")
+        self.assertEqual(b.keys_by_record["1"], set([("a",), ("c",)]))
+
+    def test_evicts_by_size(self):
+        b = LocalBackend(max_bytes=5)
+        b.set("1", ("a",), "xxx")
+        b.set("2", ("b",), "yyy")
+        self.assertEqual(b.get("1", ("a",)), None)
+        self.assertEqual(b.size, 3)
+
+    def test_eviction_drops_empty_record_sets(self):
+        b = LocalBackend(max_entries=1)
+        for i in range(10):
+            b.set(str(i), ("a",), "x")
+        self.assertEqual(b.keys_by_record.keys(), ["9"])
+
+    def test_replacing_an_entry_keeps_the_size(self):
+        b = LocalBackend()
+        b.set("1", ("a",), "xxx")
+        b.set("1", ("a",), "yy")
+        self.assertEqual(b.size, 2)
+
+    def test_entry_larger_than_the_cache_is_skipped(self):
+        b = LocalBackend(max_bytes=2)
+        b.set("1", ("a",), "xxx")
+        self.assertEqual(b.get("1", ("a",)), None)
+        self.assertEqual(b.keys_by_record, {})
+
+
+class SharedBackendTests(ResponseCacheTests):
+    """The same round trips through django's cache framework (locmem here,
+    memcached in a multi-process deployment)"""
+    def setUp(self):
+        ResponseCacheTests.setUp(self)
+        backend = SharedBackend()
+        backend.cache = get_cache('locmem://shared-backend-tests')
+        backend.cache.clear()
+        self.cache = ResponseCache(backend)
+
+    def test_invalidate_only_drops_that_record(self):
+        # entries aren't dropped; the next commit's version bump retires them
+        self.get(1, record_id="123")
+        self.cache.invalidate("123")
+        self.get(1, record_id="123")
+        self.get(2, record_id="123")
+        self.assertEqual(self.fetches, 2)
+
+    def test_another_process_sees_the_entry(self):
+        self.get(1)
+        other = SharedBackend()
+        other.cache = self.cache.backend.cache
+        key = (1,) + self.cache.key(PATH, {}, MEDICATION)
+        self.assertEqual(other.get("123", key), "<rdf:RDF></rdf:RDF>")
+
+    def test_keys_are_memcached_safe(self):
+        key = (1,) + self.cache.key(PATH + " with spaces" * 50, {'q': 'x y'}, MEDICATION)
+        entry_key = self.cache.backend._entry_key("123", key)
+        self.assertTrue(len(entry_key) < 250)
+        self.assertFalse(" " in entry_key)
+
+
+DATED = u"?v dcterms:date ?d ."
+DATES = ["2009", "2009-12-31", "2010", "2010-01-01", "2010-05", "2010-05-02",
+         "2010-05-03", "2010-05-03T12:00:00Z", "2010-05-31", "2010-06-01",
+         "2010-12-31T23:59:59Z", "2011-01-01"]
+
+
+class DateBoundsTests(unittest.TestCase):
+    def in_range(self, **date_filters):
+        bounds = DateBounds(date_filters)
+        return [d for d in DATES if bounds.matches(d)]
+
+    def test_pad_date(self):
+        self.assertEqual(padDate("2010-05", DATE_LB), "2010-05-01T00:00:00Z")
+        self.assertEqual(padDate("2010-05", DATE_UB), "2010-05-31T23:59:59Z")
+        self.assertEqual(padDate("2010-05-03T12:00:00Z", DATE_LB), "2010-05-03T12:00:00Z")
+
+    def test_no_bounds(self):
+        self.assertFalse(DateBounds({}))
+        self.assertEqual(self.in_range(), DATES)
+
+    def test_date_from_includes_partial_dates_ending_after_it(self):
+        self.assertEqual(self.in_range(date_from="2010-05-03"),
+                         ["2010", "2010-05", "2010-05-03", "2010-05-03T12:00:00Z",
+                          "2010-05-31", "2010-06-01", "2010-12-31T23:59:59Z", "2011-01-01"])
+
+    def test_date_to_pads_the_bound_to_the_end_of_the_period(self):
+        self.assertEqual(self.in_range(date_to="2010-05"),
+                         ["2009", "2009-12-31", "2010", "2010-01-01", "2010-05",
+                          "2010-05-02", "2010-05-03", "2010-05-03T12:00:00Z", "2010-05-31"])
+
+    def test_exclusive_bounds(self):
+        self.assertEqual(self.in_range(date_from_excluding="2010", date_to_excluding="2010-05-03"),
+                         [])
+        self.assertEqual(self.in_range(date_from_excluding="2009", date_to_excluding="2010-05-03"),
+                         ["2010", "2010-01-01", "2010-05", "2010-05-02"])
+
+    def test_filter_rows_agrees_with_matches(self):
+        for date_filters in [{'date_from': "2010"}, {'date_to_including': "2010-05-03"},
+                             {'date_from_including': "2010-01", 'date_to': "2010-05"},
+                             {'date_from_excluding': "2009-12-31", 'date_to_excluding': "2011"}]:
+            bounds = DateBounds(date_filters)
+            rows = [(URIRef("http://example.org/%d" % i), Literal(d))
+                    for i, d in enumerate(DATES)]
+            self.assertEqual(bounds.filterRows(rows),
+                             set(uri for uri, d in rows if bounds.matches(str(d))))
+
+    def test_sparql_filter(self):
+        self.assertEqual(DateBounds({'date_from': "2010"}).sparqlFilter(),
+                         'FILTER(CONCAT(STR(?d), SUBSTR("2999-12-31T23:59:59Z", '
+                         'STRLEN(STR(?d)) + 1)) >= "2010-01-01T00:00:00Z")')
+
+    def test_last_of_several_values_counts(self):
+        f = filter_set(date_from=DATED, date_to=DATED)
+        bounds = f.dateBounds({'date_from': "2009|2010", 'loinc': "x"})
+        self.assertEqual(bounds.bounds, [(">=", "2010-01-01T00:00:00Z", DATE_UB)])
+        self.assertFalse(f.usesDateFilters({'loinc': "x"}))
+
+
+class DateFilteringTests(TriplestoreSettingsMixin, unittest.TestCase):
+    triplestore_settings = {'candidate_strategy': 'bindings', 'date_filter_pushdown': True}
+
+    uris = [URIRef("http://example.org/%d" % i) for i in range(3)]
+
+    def test_filters_rows_in_python_without_a_planner(self):
+        store = FakeStore([{'v': self.uris[0], 'd': Literal("2009-06")},
+                           {'v': self.uris[1], 'd': Literal("2010-06")},
+                           {'v': self.uris[2]}])
+        f = filter_set(date_from=DATED)
+        self.assertEqual(f(store, self.uris, {'date_from': "2010"}), set(self.uris[1:2]))
+        self.assertTrue("SELECT ?v ?d" in store.queries[0])
+        self.assertFalse("FILTER" in store.queries[0])
+
+    def test_pushes_the_comparison_into_the_query(self):
+        store = FakeStore([{'v': self.uris[1]}], supports_query_planner=True)
+        f = filter_set(date_from=DATED)
+        self.assertEqual(f(store, self.uris, {'date_from': "2010"}), set(self.uris[1:2]))
+        self.assertTrue("SELECT DISTINCT ?v" in store.queries[0])
+        self.assertTrue(DateBounds({'date_from': "2010"}).sparqlFilter() in store.queries[0])
+
+
+LOINC = u"?v sp:labName ?n . ?n sp:code <http://purl.bioontology.org/ontology/LNC/{loinc}> ."
+TITLE = u'?v dcterms:title "{title}" .'
+STATUS = u"?v sp:status ?s . FILTER(?s = {status})"
+
+
+class CompiledTemplateTests(unittest.TestCase):
+    def test_splits_around_placeholders_by_context(self):
+        self.assertEqual(
+            compileTemplate(u'<http://x/{p}> "{p}" {p} \'{p}\' {q}', u"p"),
+            [u"<http://x/", escapeIRI, u'> "', escapeString, u'" ', escapeBare,
+             u" '", escapeString, u"' {q}"])
+
+    def test_template_without_placeholder(self):
+        self.assertEqual(compileTemplate(u"?v a sp:Medication .", u"p"),
+                         [u"?v a sp:Medication ."])
+
+    def test_escapes(self):
+        self.assertEqual(escapeString(u'a"b\\c\n\''), u'a\\"b\\\\c\\n\\\'')
+        self.assertEqual(escapeIRI(u"2345-7> }"), u"2345-7%3E%20%7D")
+        self.assertEqual(escapeIRI(u"caf\xe9"), u"caf%C3%A9")
+        for v in [u"42", u"-1.5", u"true", u"sp:active"]:
+            self.assertEqual(escapeBare(v), v)
+        self.assertEqual(escapeBare(u"1) } ?s ?p ?o {"), u'"1) } ?s ?p ?o {"')
+
+    def test_rejects_plain_string_templates(self):
+        self.assertRaises(AssertionError, FilterSet,
+                          TypeSpec([CallFilter(u"loinc", LOINC)]))
+
+
+class FilterClauseTests(unittest.TestCase):
+    def setUp(self):
+        self.f = filter_set(loinc=LOINC, status=STATUS, title=TITLE)
+
+    def test_no_filters_used(self):
+        self.assertEqual(self.f.getClauses({'limit': "10"}), u"")
+        self.assertEqual(self.f.getQuery({'limit': "10"}), None)
+
+    def test_one_value(self):
+        self.assertEqual(self.f.getClauses({'loinc': "2345-7"}),
+                         u"{{?v sp:labName ?n . ?n sp:code "
+                         u"<http://purl.bioontology.org/ontology/LNC/2345-7> .}}")
+
+    def test_values_are_a_union_and_filters_a_conjunction(self):
+        self.assertEqual(self.f.getClauses({'status': "sp:active|sp:held", 'title': 'a "b"'}),
+                         u"{{?v sp:status ?s . FILTER(?s = sp:active)}\nUNION\n"
+                         u"{?v sp:status ?s . FILTER(?s = sp:held)}}\n"
+                         u'{{?v dcterms:title "a \\"b\\"" .}}')
+
+    def test_values_cannot_escape_their_placeholder(self):
+        clauses = self.f.getClauses({'loinc': "x> } ?s ?p ?o . { <y",
+                                     'status': "1) } ?s ?p ?o {",
+                                     'title': '" } ?s ?p ?o { "'})
+        self.assertTrue(u"<http://purl.bioontology.org/ontology/LNC/"
+                        u"x%3E%20%7D%20?s%20?p%20?o%20.%20%7B%20%3Cy>" in clauses)
+        self.assertTrue(u'"1) } ?s ?p ?o {"' in clauses)
+        self.assertTrue(u'\\" } ?s ?p ?o { \\"' in clauses)
+
+    def test_shapes_are_shared_by_value(self):
+        self.f.getClauses({'loinc': "2345-7"})
+        self.f.getClauses({'loinc': "2947-0"})
+        self.assertEqual(len(self.f.shapes), 1)
+        self.f.getClauses({'loinc': "2345-7|2947-0"})
+        self.f.getClauses({'loinc': "2345-7", 'status': "sp:active"})
+        self.assertEqual(len(self.f.shapes), 3)
+
+    def test_shape_cache_is_bounded(self):
+        saved = filters.MAX_SHAPES
+        filters.MAX_SHAPES = 2
+        try:
+            for n in range(1, 6):
+                self.f.getClauses({'loinc': "|".join(["1"] * n)})
+                self.assertTrue(len(self.f.shapes) <= 2)
+        finally:
+            filters.MAX_SHAPES = saved
+
+
+LAB_RESULT = FakeObject(URIRef("http://smartplatforms.org/terms#LabResult"))
+
+
+class TypeTablesMixin(TriplestoreSettingsMixin):
+    """Registers LAB_RESULT's filters and paginator for each test"""
+    def setUp(self):
+        TriplestoreSettingsMixin.setUp(self)
+        filters.FILTERS[LAB_RESULT.node] = filter_set(date_from=DATED, loinc=LOINC)
+        filters.PAGINATORS[LAB_RESULT.node] = SimplePaginator("dcterms:date")
+
+    def tearDown(self):
+        del filters.FILTERS[LAB_RESULT.node]
+        del filters.PAGINATORS[LAB_RESULT.node]
+        TriplestoreSettingsMixin.tearDown(self)
+
+
+class QueryPlannerTests(TypeTablesMixin, unittest.TestCase):
+    triplestore_settings = {'query_planner': True, 'date_filter_pushdown': True}
+
+    def test_date_bounds_the_store_cant_evaluate_need_the_step_by_step_path(self):
+        store = FakeStore([], supports_query_planner=False)
+        self.assertEqual(planner.build_plan(store, LAB_RESULT, {'date_from': "2010"}), None)
+
+    def test_date_pushdown_turned_off_needs_the_step_by_step_path(self):
+        settings.TRIPLESTORE['date_filter_pushdown'] = False
+        store = FakeStore([], supports_query_planner=True)
+        self.assertEqual(planner.build_plan(store, LAB_RESULT, {'date_from': "2010"}), None)
+        self.assertEqual(planner.get_objects(store, "/", {'date_from': "2010"}, LAB_RESULT), None)
+        self.assertEqual(store.queries, [])
+
+    def test_pushed_down_date_bounds_are_in_the_plan(self):
+        store = FakeStore([], supports_query_planner=True)
+        plan = planner.build_plan(store, LAB_RESULT, {'date_from': "2010", 'loinc': "2345-7"})
+        date_filter = DateBounds({'date_from': "2010"}).sparqlFilter()
+        self.assertEqual(plan.date_filter, date_filter)
+        self.assertTrue(date_filter in plan.summary_query())
+        self.assertTrue("LNC/2345-7>" in plan.summary_query())
+
+    def test_no_date_bounds(self):
+        store = FakeStore([], supports_query_planner=False)
+        plan = planner.build_plan(store, LAB_RESULT, {'loinc': "2345-7"})
+        self.assertEqual(plan.date_filter, None)
+        self.assertFalse(plan.paged)
+
+
+URIS = [URIRef("http://sandbox-api.smartplatforms.org/records/123/lab_results/%d" % i)
+        for i in range(5)]
+
+
+def counting_store(total, page):
+    """Answers the count query with total, and the page query with page"""
+    def rows(q):
+        if "COUNT" in q:
+            return [{'total': Literal(total)}]
+        return [{'uri': u} for u in page]
+    return FakeStore(rows)
+
+
+class SortedPageTests(unittest.TestCase):
+    def test_store_slices_the_page(self):
+        store = counting_store(5, URIS[2:4])
+        page, total = SimplePaginator("dcterms:date").sortedPage(store, URIS, 2, 2)
+        self.assertEqual((page, total), (URIS[2:4], 5))
+
+        count, page_query = store.queries
+        self.assertFalse("LIMIT" in count)
+        self.assertTrue("LIMIT 2 OFFSET 2" in page_query)
+        self.assertTrue("ORDER BY DESC (?sortParam) ASC (?uri)" in page_query)
+        for q in store.queries:
+            self.assertTrue("BINDINGS ?uri" in q)
+
+    def test_no_page_query_past_the_end(self):
+        store = counting_store(3, [])
+        page, total = SimplePaginator("dcterms:date").sortedPage(store, URIS[:3], 2, 4)
+        self.assertEqual((page, total), ([], 3))
+        self.assertEqual(len(store.queries), 1)
+
+    def test_no_candidates_no_queries(self):
+        store = counting_store(0, [])
+        self.assertEqual(SimplePaginator("dcterms:date").sortedPage(store, [], 2, 0), ([], 0))
+        self.assertEqual(store.queries, [])
+
+    def test_next_page_link(self):
+        paginator = SimplePaginator("dcterms:date")
+        meta = {}
+        paginator(counting_store(5, URIS[:2]), URIS, {'limit': "2"}, PATH, meta)
+        self.assertEqual(meta['resultOrder'], URIS[:2])
+        self.assertTrue(PATH + "?" in meta['nextPageURL'])
+        self.assertTrue("offset=2" in meta['nextPageURL'])
+
+        meta = {}
+        paginator(counting_store(5, URIS[4:]), URIS, {'limit': "2", 'offset': "4"}, PATH, meta)
+        self.assertEqual(meta['resultOrder'], URIS[4:])
+        self.assertFalse('nextPageURL' in meta)
+
+
+XSD_DATE = URIRef("http://www.w3.org/2001/XMLSchema#date")
+
+
+def cursor_of(value, datatype, lang, uri):
+    """A token made by hand, as a client could"""
+    return base64.urlsafe_b64encode(json.dumps([value, datatype, lang, uri])).rstrip("=")
+
+
+class KeysetTests(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        for sort_value in [Literal("2010-05-02", datatype=XSD_DATE),
+                           Literal("Glucose", lang="en"),
+                           Literal(u"caf\xe9")]:
+            token = encodeCursor(URIS[0], sort_value)
+            self.assertFalse("=" in token)
+            value, uri = decodeCursor(token)
+            self.assertEqual(uri, URIS[0])
+            self.assertEqual((value, value.datatype, value.language),
+                             (sort_value, sort_value.datatype, sort_value.language))
+
+    def test_bad_cursors_start_from_the_top(self):
+        for token in ["", "not base64!", "bm90IGpzb24", cursor_of("2010", None, None, None)[:-2]]:
+            self.assertEqual(decodeCursor(token), None)
+
+    def test_tampered_iris_are_refused(self):
+        for uri in ["http://x/> . ?s ?p ?o", 'http://x/"', "http://x/ y", "http://x/{a}"]:
+            self.assertEqual(decodeCursor(cursor_of("2010", None, None, uri)), None)
+        self.assertEqual(decodeCursor(cursor_of("2010", "http://x/>", None, str(URIS[0]))), None)
+
+    def test_empty_cursor_is_absent(self):
+        self.assertFalse(hasCursor({'cursor': ""}))
+        self.assertFalse(hasCursor({}))
+        self.assertTrue(hasCursor({'cursor': "abc"}))
+
+    def test_keyset_filter(self):
+        paginator = SimplePaginator("dcterms:date")
+        self.assertEqual(paginator.keysetFilter(None, "?uri"), "")
+
+        sort_value = Literal("2010", datatype=XSD_DATE)
+        clause = paginator.keysetFilter(decodeCursor(encodeCursor(URIS[1], sort_value)), "?uri")
+        self.assertTrue("?sortParam < %s" % sort_value.n3() in clause)
+        self.assertTrue("STR(?uri) > %s" % Literal(URIS[1]).n3() in clause)
+
+    def test_keyset_filter_escapes_the_sort_value(self):
+        paginator = SimplePaginator("dcterms:date")
+        clause = paginator.keysetFilter(decodeCursor(cursor_of('x") || true || ("', None, None,
+                                                               str(URIS[0]))), "?uri")
+        self.assertFalse('"x")' in clause)
+
+    def test_keyset_page(self):
+        sort_value = Literal("2010", datatype=XSD_DATE)
+        store = FakeStore([{'uri': u, 'sortParam': sort_value} for u in URIS[:3]])
+        page, more = SimplePaginator("dcterms:date").keysetPage(store, URIS, 2)
+        self.assertEqual(page, [(URIS[0], sort_value), (URIS[1], sort_value)])
+        self.assertTrue(more)
+        self.assertTrue("LIMIT 3" in store.queries[0])
+        self.assertTrue("BINDINGS ?uri" in store.queries[0])
+
+    def test_next_cursor_link(self):
+        sort_value = Literal("2010", datatype=XSD_DATE)
+        store = FakeStore([{'uri': u, 'sortParam': sort_value} for u in URIS[:3]])
+        meta = {}
+        params = {'limit': "2", 'cursor': encodeCursor(URIS[0], sort_value), 'offset': "4"}
+        SimplePaginator("dcterms:date")(store, URIS, params, PATH, meta)
+        self.assertEqual(meta['resultOrder'], URIS[:2])
+        self.assertTrue("cursor=%s" % encodeCursor(URIS[1], sort_value) in meta['nextPageURL'])
+        self.assertFalse("offset=" in meta['nextPageURL'])
+
+
+@record_version_etag
+def record_view(request, record_id):
+    return HttpResponse("record %s" % record_id)
+
+
+class RecordVersionTests(TestCase):
+    """Commits bump the versions of the records they touch, which changes
+    the records' ETags"""
+    def setUp(self):
+        self.record = Record.objects.create(id="123", full_name="Bob")
+        Record.objects.create(id="456", full_name="Alice")
+        self.committed = []
+        self.saved_commit = triplestore.engine.connector.transaction_commit
+        triplestore.engine.connector.transaction_commit = \
+            lambda store: self.committed.append(store.touched_record_ids())
+
+    def tearDown(self):
+        triplestore.engine.connector.transaction_commit = self.saved_commit
+
+    def version(self, record_id):
+        return Record.objects.get(id=record_id).version
+
+    def get(self, etag=None):
+        request = RequestFactory().get("/records/123/medications/")
+        if etag:
+            request.META['HTTP_IF_NONE_MATCH'] = etag
+        return record_view(request, record_id="123")
+
+    def commit(self, graph_uri):
+        store = triplestore.TripleStore()
+        cg = ConjunctiveGraph()
+        cg.get_context(URIRef(graph_uri)).add(
+            (URIRef(graph_uri), URIRef("http://purl.org/dc/terms/title"), Literal("x")))
+        store.add_conjunctive_graph(cg)
+        store.transaction_commit()
+
+    def test_commit_bumps_the_touched_record(self):
+        self.commit(settings.SITE_URL_PREFIX + "/records/123/medications/1")
+        self.assertEqual(self.committed, [set(["123"])])
+        self.assertEqual(self.version("123"), 1)
+        self.assertEqual(self.version("456"), 0)
+
+    def test_commit_outside_records_bumps_nothing(self):
+        self.commit(settings.SITE_URL_PREFIX + "/apps/my-app@apps.smartplatforms.org/preferences")
+        self.assertEqual(self.version("123"), 0)
+
+    def test_commit_changes_the_etag(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        self.commit(settings.SITE_URL_PREFIX + "/records/123/medications/1")
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get(response['ETag']).status_code, 304)
+
+
+TITLE_P = URIRef("http://purl.org/dc/terms/title")
+
+
+def graph_uri(name):
+    return URIRef("http://localhost:7000/records/123/%s" % name)
+
+
+class UpdateBatchingTests(TriplestoreSettingsMixin, unittest.TestCase):
+    def setUp(self):
+        TriplestoreSettingsMixin.setUp(self)
+        self.store = SesameConnector("http://localhost:8080/repositories/r")
+        self.store.transaction_begin()
+        self.sent = []
+        self.store._request_stream = lambda url, method, headers, body: \
+            self.sent.append((headers, "".join(body())))
+
+    def add(self, pending, name, n):
+        g = pending.get_context(graph_uri(name))
+        for i in range(n):
+            g.add((graph_uri(name), TITLE_P, Literal("title %d" % i)))
+
+    def requests(self, max_bytes):
+        operations = self.store._update_operations()
+        cursor, ret = [0, None, None], []
+        while cursor[0] is not None:
+            ret.append("".join(self.store._update_text(operations, max_bytes, cursor)))
+        return ret
+
+    def test_operations_are_drop_insert_delete(self):
+        self.add(self.store.pending_removes, "old", 1)
+        self.add(self.store.pending_adds, "new", 1)
+        self.store.clear_context(graph_uri("gone"))
+        [text] = self.requests(0)
+        drop = text.index("DROP GRAPH <%s>" % graph_uri("gone"))
+        insert = text.index("INSERT DATA { GRAPH <%s>" % graph_uri("new"))
+        delete = text.index("DELETE DATA { GRAPH <%s>" % graph_uri("old"))
+        self.assertTrue(drop < insert < delete)
+        self.assertEqual(text.count(";\n"), 2)
+
+    def test_cut_inside_a_graph(self):
+        self.add(self.store.pending_adds, "big", 10)
+        requests = self.requests(200)
+        self.assertTrue(len(requests) > 1)
+        lines = []
+        for text in requests:
+            self.assertTrue(text.startswith("INSERT DATA { GRAPH <%s> {\n" % graph_uri("big")))
+            self.assertTrue(text.endswith(" }}"))
+            self.assertFalse(";" in text)
+            lines += text.splitlines()[1:]
+        # each triple is written once, whole
+        lines = [l.replace(" }}", "") for l in lines]
+        self.assertEqual(sorted(l for l in lines if l),
+                         sorted(nt_line(t).rstrip("\n") for t in self.store.pending_adds))
+
+    def test_drop_at_the_boundary_starts_the_next_request(self):
+        self.add(self.store.pending_adds, "new", 3)
+        self.store.clear_context(graph_uri("a"))
+        self.store.clear_context(graph_uri("b"))
+        first = len("DROP GRAPH <%s>" % graph_uri("a"))
+        requests = self.requests(first + 5)
+        self.assertEqual(requests[0], "DROP GRAPH <%s>" % graph_uri("a"))
+        self.assertEqual(requests[1], "DROP GRAPH <%s>" % graph_uri("b"))
+        self.assertTrue(requests[2].startswith("INSERT DATA"))
+
+    def test_oversized_triple_still_goes_out(self):
+        self.add(self.store.pending_adds, "new", 2)
+        requests = self.requests(1)
+        self.assertEqual(len(requests), 2)
+        for text in requests:
+            self.assertEqual(text.count(" .\n"), 1)
+
+    def test_commit_is_form_encoded(self):
+        settings.TRIPLESTORE['update_batch_bytes'] = 0
+        self.add(self.store.pending_adds, "new", 3)
+        self.store.clear_context(graph_uri("gone"))
+        self.store.transaction_commit()
+        [(headers, body)] = self.sent
+        self.assertEqual(headers["Content-type"], "application/x-www-form-urlencoded")
+        [text] = urlparse.parse_qs(body)["update"]
+        self.assertTrue(text.startswith("DROP GRAPH <%s>;\nINSERT DATA" % graph_uri("gone")))
+        self.assertEqual(text.count(" .\n"), 3)
+
+    def test_commit_in_batches(self):
+        settings.TRIPLESTORE['update_batch_bytes'] = 200
+        self.add(self.store.pending_adds, "new", 10)
+        self.store.transaction_commit()
+        self.assertTrue(len(self.sent) > 1)
+        texts = [urlparse.parse_qs(body)["update"][0] for (headers, body) in self.sent]
+        self.assertEqual(sum(t.count(" .\n") for t in texts), 10)
+        self.assertEqual(len(self.store.pending_adds), 0)
+
+
+STATEMENTS = [graph_uri("lab_results/%d" % i) for i in range(7)]
+
+
+def rows_for_bound(var, uris=None):
+    """Answers each select with a row for every URI in its BINDINGS
+    block (or for each of uris, for a scoped query)"""
+    def rows(q):
+        if "BINDINGS" in q:
+            listed = q.split("BINDINGS")[1].strip().split("{", 1)[1].rsplit("}", 1)[0]
+            return [{var: URIRef(u.strip("(<>)"))} for u in listed.split(")(")]
+        return [{var: u} for u in uris or []]
+    return rows
+
+
+class CandidatesTests(TriplestoreSettingsMixin, unittest.TestCase):
+    triplestore_settings = {'candidate_strategy': 'bindings', 'candidate_chunk_size': 3,
+                            'candidate_parallelism': 2}
+
+    def test_chunked(self):
+        self.assertEqual(candidates.chunked(range(7)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(candidates.chunked(range(6), 2), [[0, 1], [2, 3], [4, 5]])
+        self.assertEqual(candidates.chunked(set([1])), [[1]])
+        self.assertEqual(candidates.chunked([]), [])
+        settings.TRIPLESTORE['candidate_chunk_size'] = 0
+        self.assertEqual(candidates.chunked(range(7)), [range(7)])
+
+    def test_scoped_only_past_the_chunk_size(self):
+        self.assertFalse(candidates.scoped(STATEMENTS))
+        settings.TRIPLESTORE['candidate_strategy'] = 'scoped'
+        self.assertFalse(candidates.scoped(STATEMENTS[:3]))
+        self.assertTrue(candidates.scoped(STATEMENTS[:4]))
+        settings.TRIPLESTORE['candidate_chunk_size'] = 0
+        self.assertFalse(candidates.scoped(STATEMENTS))
+
+    def test_bindings(self):
+        self.assertEqual(candidates.bindings("?g", STATEMENTS[:2]),
+                         " BINDINGS ?g {(<%s>)(<%s>)} " % tuple(STATEMENTS[:2]))
+
+    def test_scope(self):
+        record = "GRAPH $record { $record <http://smartplatforms.org/terms#hasStatement> ?v . }"
+        self.assertEqual(candidates.scope("?v"), record)
+        self.assertEqual(candidates.scope("?v", LAB_RESULT.node),
+                         record + "\nGRAPH ?v { ?v a <%s> . }" % LAB_RESULT.node)
+
+    def test_map_chunks_keeps_the_order(self):
+        threads = set()
+        def run(chunk):
+            threads.add(threading.current_thread())
+            return sum(chunk)
+        self.assertEqual(candidates.map_chunks(run, range(10)), [3, 12, 21, 9])
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_one_chunk_runs_inline(self):
+        threads = []
+        candidates.map_chunks(lambda c: threads.append(threading.current_thread()), range(3))
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(candidates.map_chunks(sum, []), [])
+
+    def test_select(self):
+        store = FakeStore(rows_for_bound("v"))
+        rows = candidates.select(store, "SELECT ?v {?v ?p ?o}", "?v", STATEMENTS)
+        self.assertEqual([r['v'] for r in rows], STATEMENTS)
+        self.assertEqual(len(store.queries), 3)
+        for q in store.queries:
+            self.assertTrue(q.startswith("SELECT ?v {?v ?p ?o} BINDINGS ?v {("))
+            self.assertTrue(q.count(")(") < 3)
+
+    def test_filtering_large_sets_in_chunks(self):
+        store = FakeStore(rows_for_bound("v"))
+        f = filter_set(loinc=LOINC)
+        self.assertEqual(f(store, STATEMENTS, {'loinc': "2345-7"}, LAB_RESULT.node),
+                         set(STATEMENTS))
+        self.assertEqual(len(store.queries), 3)
+
+    def test_filtering_scoped(self):
+        settings.TRIPLESTORE['candidate_strategy'] = 'scoped'
+        other = graph_uri("lab_results/other")
+        store = FakeStore(rows_for_bound("v", STATEMENTS[2:] + [other]))
+        f = filter_set(loinc=LOINC)
+        self.assertEqual(f(store, STATEMENTS, {'loinc': "2345-7"}, LAB_RESULT.node),
+                         set(STATEMENTS[2:]))
+        [q] = store.queries
+        self.assertFalse("BINDINGS" in q)
+        self.assertTrue(candidates.scope("?v", LAB_RESULT.node) in q)
+
+    def test_neighbors_scoped(self):
+        settings.TRIPLESTORE['candidate_strategy'] = 'scoped'
+        other = graph_uri("lab_results/other")
+        store = SesameConnector("http://localhost:8080/repositories/r")
+        store.select = FakeStore(rows_for_bound("g", STATEMENTS[2:] + [other])).select
+        self.assertEqual(store.expand_to_neighboring_statements(STATEMENTS, LAB_RESULT.node),
+                         set(STATEMENTS[2:]))
+
+    def test_neighbors_in_chunks(self):
+        store = SesameConnector("http://localhost:8080/repositories/r")
+        fake = FakeStore(rows_for_bound("g"))
+        store.select = fake.select
+        self.assertEqual(store.expand_to_neighboring_statements(STATEMENTS, LAB_RESULT.node),
+                         set(STATEMENTS))
+        self.assertEqual(len(fake.queries), 3)
+
+    def test_contexts_in_chunks(self):
+        store = SesameConnector("http://localhost:8080/repositories/r")
+        queries = []
+        def sparql(q):
+            queries.append(q)
+            g = ConjunctiveGraph()
+            for u in rows_for_bound("g")(q):
+                g.add((u['g'], TITLE_P, Literal("title")))
+            return g.serialize(format="xml")
+        store.sparql = sparql
+
+        g = ConjunctiveGraph()
+        g.parse(data=store.get_contexts(STATEMENTS), format="xml")
+        self.assertEqual(set(g.subjects()), set(STATEMENTS))
+        self.assertEqual(len(queries), 3)
@@ -5,8 +5,14 @@ Josh Mandel
 """
 
 from base import *
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+from smart.lib import rdf_stream
 
 from filters import runFiltering, runPagination
+import planner
+from cache import RESPONSE_CACHE
 
 engine = "smart.triplestore.%s"%settings.TRIPLESTORE['engine']
 __import__(engine)
@@ -29,7 +35,27 @@ class TripleStore(engine.connector):
         return super(TripleStore, self).transaction_begin()
 
     def transaction_commit(self):
-        return super(TripleStore, self).transaction_commit()
+        touched = self.touched_record_ids()
+        ret = super(TripleStore, self).transaction_commit()
+        if touched:
+            from smart.models.records import Record
+            Record.bump_versions(touched)
+        return ret
+
+    record_uri_pattern = re.compile("^%s/records/([^/]+)" % re.escape(settings.SITE_URL_PREFIX))
+
+    def touched_record_ids(self):
+        """Ids of the records whose graphs the pending transaction changes"""
+        contexts = [g.identifier for g in self.pending_adds.contexts()]
+        contexts += [g.identifier for g in self.pending_removes.contexts()]
+        contexts += self.pending_clears
+
+        ret = set()
+        for c in contexts:
+            m = self.record_uri_pattern.match(unicode(c))
+            if m:
+                ret.add(m.group(1))
+        return ret
 
     def clear_context(self, context):
         return super(TripleStore, self).clear_context(context)
@@ -49,8 +75,9 @@ class TripleStore(engine.connector):
             for k,v in b.iteritems():
                 if v["type"]=="uri":
                     b[k] = URIRef(v["value"])
-                elif v["type"]=="literal":
-                    b[k] = Literal(v["value"])
+                elif v["type"] in ("literal", "typed-literal"):
+                    b[k] = Literal(v["value"], lang=v.get("xml:lang"),
+                                   datatype=v.get("datatype"))
                 elif v["type"]=="blank":
                     b[k] = BNode(v["value"])
                 else:
@@ -74,8 +101,26 @@ class TripleStore(engine.connector):
     def get_contexts(self, contexts):
         return super(TripleStore, self).get_contexts(contexts)
 
+    def invalidate_cache(self):
+        # not scoped to a record: callers invalidate the records they touch
+        pass
+
     def get_objects(self, path, queries, obj, limit_to_statements=None):
+        return "".join(self.get_objects_stream(path, queries, obj, limit_to_statements))
+
+    def get_objects_stream(self, path, queries, obj, limit_to_statements=None):
+        """Like get_objects, but returns an iterator over the RDF/XML's chunks"""
         timeStart = time.time()
+
+        if not limit_to_statements and planner.enabled(self):
+            planned = planner.get_objects(self, path, queries, obj)
+            if planned:
+                res, meta = planned
+                if meta is None:
+                    return res
+                meta['processingTimeMs'] = int((time.time() - timeStart) * 1000)
+                return self.addResponseSummary(res, meta)
+
         meta = {}
    
         matches = super(TripleStore, self).get_clinical_statement_uris(obj)
@@ -97,32 +142,44 @@ class TripleStore(engine.connector):
         print "paged", len(matches)
 
         if matches:
-            matches = super(TripleStore, self).expand_to_neighboring_statements(limit_to_statements or matches)
+            matches = super(TripleStore, self).expand_to_neighboring_statements(limit_to_statements or matches, obj.node)
         print "expanded", len(matches)
 
         if not matches:
-            return Graph().serialize(format="xml")
+            return [Graph().serialize(format="xml")]
 
-        res = self.get_contexts(matches)
+        res = self.get_contexts_stream(matches)
         meta['processingTimeMs'] = int((time.time() - timeStart) * 1000)
         
         return self.addResponseSummary(res, meta)
         
-    def addResponseSummary (self, rdfxml, meta):
-        g = parse_rdf(rdfxml)
+    def addResponseSummary (self, chunks, meta):
+        """Passes the store's RDF/XML through, with the ResponseSummary added
+        at the end, rather than parsing and re-serializing the whole reply"""
+        return rdf_stream.splice_rdfxml(chunks, self.responseSummaryXML(meta))
+
+    def responseSummaryXML(self, meta):
+        """The ResponseSummary node as a self-contained RDF/XML node element"""
+        api = NS['api']
+        lines = ['<rdf:Description xmlns:rdf=%s xmlns:api=%s>' % (
+                     quoteattr(unicode(RDF.uri)), quoteattr(unicode(api))),
+                 '  <rdf:type rdf:resource=%s/>' % quoteattr(unicode(api['ResponseSummary']))]
 
-        rsNode = BNode()
-        g.add((rsNode,RDF.type,NS['api']['ResponseSummary']))
-        
         for key in meta.keys():
             if type(meta[key]) == list:
-                bn = BNode()
-                g.add((rsNode,NS['api'][key],bn))
-                Collection(g, bn, meta[key])
+                items = "".join(['<rdf:Description rdf:about=%s/>' % quoteattr(unicode(x))
+                                 for x in meta[key]])
+                lines.append('  <api:%s rdf:parseType="Collection">%s</api:%s>' % (
+                    key, items, key))
             else:
-                g.add((rsNode,NS['api'][key],Literal(meta[key])))
-        
-        return g.serialize(format="xml")
+                value = Literal(meta[key])
+                datatype = value.datatype and \
+                    ' rdf:datatype=%s' % quoteattr(unicode(value.datatype)) or ''
+                lines.append('  <api:%s%s>%s</api:%s>' % (
+                    key, datatype, escape(unicode(value)), key))
+
+        lines.append('</rdf:Description>\n')
+        return "\n".join(lines).encode("utf-8")
 
 class ContextTripleStore(TripleStore):
     queryparam = "$context"
@@ -134,6 +191,10 @@ class ContextTripleStore(TripleStore):
     def sparql(self, q):
         q = q.replace(self.queryparam, self.context.n3())
         return super(ContextTripleStore, self).sparql(q)
+
+    def sparql_stream(self, q):
+        q = q.replace(self.queryparam, self.context.n3())
+        return super(ContextTripleStore, self).sparql_stream(q)
   
 class RecordTripleStore(ContextTripleStore):
     queryparam = "$record"
@@ -143,3 +204,20 @@ class RecordTripleStore(ContextTripleStore):
                                                    settings.SITE_URL_PREFIX + 
                                                         '/records/' +
                                                         record.id)
+        self.record_id = record.id
+        self.record_version = record.version
+
+    def transaction_commit(self):
+        ret = super(RecordTripleStore, self).transaction_commit()
+        # the version read with the record is out of date now
+        self.record_version = None
+        return ret
+
+    def get_objects_stream(self, path, queries, obj, limit_to_statements=None):
+        fetch = lambda: super(RecordTripleStore, self).get_objects_stream(path, queries, obj, limit_to_statements)
+        return RESPONSE_CACHE.get_objects_stream(self.record_id, self.record_version,
+                                                 path, queries, obj,
+                                                 limit_to_statements, fetch)
+
+    def invalidate_cache(self):
+        RESPONSE_CACHE.invalidate(self.record_id)
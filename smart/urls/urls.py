@@ -45,6 +45,10 @@ urlpatterns += patterns(
                                        'OPTIONS' : allow_options})),
     (r'^apps/(?P<app_id>[^/]+)/credentials', app_oauth_credentials),
     
+    # JSON-LD contexts
+    (r'^jsonld/context$', jsonld_context),
+    (r'^jsonld/context/(?P<type_name>\w+)$', jsonld_context),
+
     # static
     (r'^static/(?P<path>.*)$', 'django.views.static.serve', {'document_root': 'static'}),
 
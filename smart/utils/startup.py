@@ -22,3 +22,16 @@ def check_triplestore():
         r = c.sparql("""CONSTRUCT {<urn:test> a <urn:value>} where {<urn:test> a <urn:value>}""")
     except:
         assert False, "Could not connect to triplestore.  Check settings."    
+
+def start_token_reaper():
+    # reap expired tokens and old nonces in the background, if configured
+    interval = getattr(settings, 'TOKEN_REAPER_INTERVAL', None)
+    if not interval:
+        return None
+    from smart.accesscontrol.reaper import Reaper
+    return Reaper(verbose=False).start(interval)
+
+def warm_jsonld_contexts():
+    # build the per-type JSON-LD contexts once, in the parent process
+    from smart.lib import jsonld
+    return jsonld.warm_type_contexts()
@@ -6,10 +6,10 @@ Josh Mandel
 """
 from string import Template
 from base import *
-from smart.lib import utils
+from smart.lib import utils, jsonld
 from smart.lib.utils import *
 from smart.common.rdf_tools.util import rdf, sp, bound_graph, URIRef, Namespace
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotModified, Http404
 from django.conf import settings
 from smart.models import *
 from smart.models.record_object import RecordObject
@@ -350,6 +350,28 @@ def download_ontology(request, **kwargs):
     return HttpResponse(f, mimetype="application/rdf+xml")
 
 
+JSONLD_CONTEXT_MAX_AGE = 24 * 60 * 60
+
+def jsonld_context(request, type_name=None, **kwargs):
+    """The JSON-LD context record reads of an API type (e.g. Medication)
+    are compacted with; without a type, just the SMART prefixes."""
+    if type_name:
+        context = jsonld.type_context(sp[type_name])
+        if context is None:
+            raise Http404
+    else:
+        context = jsonld.smart_context()
+
+    body, etag = context.document()
+    if etag in [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(",")]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, mimetype="application/ld+json")
+    response['ETag'] = etag
+    response['Cache-Control'] = "public, max-age=%d" % JSONLD_CONTEXT_MAX_AGE
+    return utils.x_domain(response)
+
+
 
 def debug_oauth(request, **kwargs):
     from smart.accesscontrol.oauth_servers import OAUTH_SERVER
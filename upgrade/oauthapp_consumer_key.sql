@@ -0,0 +1,7 @@
+-- Indexes smart_oauthapp.consumer_key, which every signed request looks
+-- up.  Run once on databases created before the index:
+--   psql -U smart -d smart -f upgrade/oauthapp_consumer_key.sql
+BEGIN;
+CREATE INDEX "smart_oauthapp_consumer_key" ON "smart_oauthapp" ("consumer_key");
+CREATE INDEX "smart_oauthapp_consumer_key_like" ON "smart_oauthapp" ("consumer_key" varchar_pattern_ops);
+COMMIT;
@@ -0,0 +1,7 @@
+-- Adds smart_record.version (bumped by each triplestore commit that
+-- touches the record; the record ETags and the response cache keys are
+-- derived from it).  Run once on databases created before the column:
+--   psql -U smart -d smart -f upgrade/record_version.sql
+BEGIN;
+ALTER TABLE "smart_record" ADD COLUMN "version" integer NOT NULL DEFAULT 0;
+COMMIT;
@@ -0,0 +1,12 @@
+-- Indexes the columns the token lookups and the token/nonce reaper
+-- filter and sort on.  Run once on databases created before the indexes:
+--   psql -U smart -d smart -f upgrade/token_indexes.sql
+BEGIN;
+CREATE INDEX "smart_nonce_created_at" ON "smart_nonce" ("created_at");
+CREATE INDEX "smart_sessiontoken_token" ON "smart_sessiontoken" ("token");
+CREATE INDEX "smart_sessiontoken_token_like" ON "smart_sessiontoken" ("token" varchar_pattern_ops);
+CREATE INDEX "smart_sessiontoken_expires_at" ON "smart_sessiontoken" ("expires_at");
+CREATE INDEX "smart_accesstoken_token" ON "smart_accesstoken" ("token");
+CREATE INDEX "smart_accesstoken_token_like" ON "smart_accesstoken" ("token" varchar_pattern_ops);
+CREATE INDEX "smart_accesstoken_expires_at" ON "smart_accesstoken" ("expires_at");
+COMMIT;